@@ -0,0 +1,106 @@
+#!/usr/bin/python
+"""A load test of ThingiverseDataset.retrieve_from_thingiverse against a local stand-in.
+
+For each number of crawler workers, a fresh dataset is filled from a
+thingiverse_server.StandInServer, and the things and bytes retrieved per
+second are reported along with the server's response counts.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from thingset import ThingiverseDataset
+
+from thingiverse_server import make_payloads, start_server
+
+def run_crawl(server, n_things, workers, delay):
+    """Fill a new dataset from the server.
+
+    Parameters
+    ----------
+    server : StandInServer
+        The running server.
+    n_things : int
+        The number of things to retrieve.
+    workers : int
+        The number of crawler threads.
+    delay : float
+        The crawler's delay between requests.
+
+    Returns
+    -------
+    dict
+        The number of things ``saved``, the elapsed ``seconds``, the
+        ``things_per_second`` and ``bytes_per_second`` downloaded, and the
+        server's ``requests`` and ``statuses``.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='thingset-crawl-')
+    try:
+        ds = ThingiverseDataset(os.path.join(tmp_dir, 'dataset'))
+        before = dict(server.stats, statuses=dict(server.stats['statuses']))
+        start = time.time()
+        n_saved = ds.retrieve_from_thingiverse(n_things, os.path.join(tmp_dir, 'cache'), workers=workers,
+                                               delay=delay, base_url=server.url)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    statuses = dict((str(k), v - before['statuses'].get(k, 0)) for k, v in server.stats['statuses'].items())
+    n_bytes = server.stats['bytes'] - before['bytes']
+    return {
+        'saved' : n_saved,
+        'seconds' : elapsed,
+        'things_per_second' : n_saved / elapsed,
+        'bytes_per_second' : n_bytes / elapsed,
+        'requests' : server.stats['requests'] - before['requests'],
+        'statuses' : statuses,
+    }
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Load-test the crawler against a local Thingiverse stand-in',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--things', help='number of things to retrieve', type=int, default=200)
+    parser.add_argument('--workers', help='crawler thread counts to test', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--delay', help='crawler delay between requests', type=float, default=0.0)
+    parser.add_argument('--faces', help='approximate faces per mesh', type=int, default=320)
+    parser.add_argument('--fixtures', help='directory of mesh files to serve', default=None)
+    parser.add_argument('--latency', help='seconds added to each response', type=float, default=0.05)
+    parser.add_argument('--error-rate', help='fraction of requests failing with a 500', type=float, default=0.0)
+    parser.add_argument('--rate-limit', help='requests per second before 429s', type=float, default=None)
+    parser.add_argument('--output', help='results filename', default='crawl_results.json')
+    args = parser.parse_args()
+
+    server = start_server(make_payloads(faces=args.faces, fixtures_dir=args.fixtures), n_things=args.things,
+                          latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    results = {
+        'things' : args.things,
+        'latency' : args.latency,
+        'error_rate' : args.error_rate,
+        'rate_limit' : args.rate_limit,
+        'delay' : args.delay,
+        'workers' : {},
+    }
+    try:
+        for workers in args.workers:
+            result = run_crawl(server, args.things, workers, args.delay)
+            results['workers'][str(workers)] = result
+            logging.log(31, '{:>3} workers: {} things in {:.2f}s, {:.1f} things/s, {:.2f} MB/s, {} requests {}'.format(
+                workers, result['saved'], result['seconds'], result['things_per_second'],
+                result['bytes_per_second'] / 1e6, result['requests'], json.dumps(result['statuses'], sort_keys=True)
+            ))
+    finally:
+        server.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""A benchmark for the core ThingiverseDataset operations on synthetic datasets.
+
+Datasets are generated once per size under the data directory and reused by
+later runs. Results are written as JSON, and a previous results file can be
+given with --compare to print the speedup of each operation.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+from thingset import ThingiverseDataset
+
+from synthetic import make_dataset
+
+def time_op(fn, repeat):
+    """Time a function.
+
+    Parameters
+    ----------
+    fn : callable
+        The function, called with no arguments.
+    repeat : int
+        The number of times to call it.
+
+    Returns
+    -------
+    dict
+        The ``min``, ``median`` and ``max`` time of a call in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return {
+        'min' : float(np.min(times)),
+        'median' : float(np.median(times)),
+        'max' : float(np.max(times)),
+    }
+
+def benchmark_dataset(path, repeat, n_items):
+    """Time each dataset operation on a dataset.
+
+    Parameters
+    ----------
+    path : str
+        The dataset directory.
+    repeat : int
+        The number of times each operation is run.
+    n_items : int
+        The number of things loaded, saved or updated per run of the per-thing operations.
+
+    Returns
+    -------
+    dict
+        A map from operation names to their timings. ``getitem``, ``save``,
+        ``save_forced``, ``update_metadata`` and ``batch_update_metadata`` are
+        timed per thing. ``save`` skips the unchanged meshes; ``save_forced``
+        rewrites them.
+    """
+    results = {}
+    results['init'] = time_op(lambda: ThingiverseDataset(path), repeat)
+    ds = ThingiverseDataset(path)
+    results['keys'] = time_op(lambda: list(ds.keys), repeat)
+    results['categories'] = time_op(lambda: ds.categories, repeat)
+    results['search_by_metadata'] = time_op(lambda: ds.search_by_metadata('score', 1), repeat)
+    results['search_by_keyword'] = time_op(lambda: ds.search_by_keyword('bracket'), repeat)
+    category = ds.metadata(sorted(ds.keys)[0])['category']
+    results['query'] = time_op(lambda: ds.query(category=category, keyword='bracket', metadata={'score' : 1}), repeat)
+
+    keys = sorted(ds.keys)
+    sample = [keys[i] for i in np.random.RandomState(0).choice(len(keys), min(n_items, len(keys)), replace=False)]
+    results['getitem'] = time_op(lambda: [ds[k] for k in sample], repeat)
+    things = [ds[k] for k in sample]
+    results['save'] = time_op(lambda: [ds.save(t) for t in things], repeat)
+    results['save_forced'] = time_op(lambda: [ds.save(t, force=True) for t in things], repeat)
+    patches = dict((k, {sorted(ds.metadata(k)['models'])[0] : {'benchmark' : 1}}) for k in sample)
+    results['update_metadata'] = time_op(lambda: [ds.update_models_metadata({k : p}) for k, p in patches.items()],
+                                         repeat)
+    def batch_update():
+        with ds.batch():
+            for k, p in patches.items():
+                ds.update_models_metadata({k : p})
+    results['batch_update_metadata'] = time_op(batch_update, repeat)
+    for op in ['getitem', 'save', 'save_forced', 'update_metadata', 'batch_update_metadata']:
+        for stat in results[op]:
+            results[op][stat] /= len(sample)
+    return results
+
+def git_revision():
+    """Return the current git revision of the repository, if available.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """Log the speedup of each operation over a baseline.
+    """
+    for size in sorted(results['sizes'], key=int):
+        if size not in baseline['sizes']:
+            continue
+        for op in sorted(results['sizes'][size]):
+            if op not in baseline['sizes'][size]:
+                continue
+            new = results['sizes'][size][op]['median']
+            old = baseline['sizes'][size][op]['median']
+            logging.log(31, '{:>7} things {:<20} {:10.6f}s -> {:10.6f}s ({:.2f}x)'.format(
+                size, op, old, new, old / max(new, 1e-12)
+            ))
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark ThingiverseDataset operations on synthetic datasets',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--sizes', help='numbers of things', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--data-dir', help='directory for generated datasets', default='/tmp/thingset-benchmarks')
+    parser.add_argument('--faces', help='approximate faces per mesh', type=int, default=80)
+    parser.add_argument('--sharded', help='use a sharded layout', action='store_true')
+    parser.add_argument('--repeat', help='runs per operation', type=int, default=5)
+    parser.add_argument('--items', help='things loaded and saved per run', type=int, default=100)
+    parser.add_argument('--workers', help='processes for generating datasets', type=int, default=4)
+    parser.add_argument('--output', help='results filename', default='benchmark_results.json')
+    parser.add_argument('--compare', help='previous results filename to compare against', default=None)
+    args = parser.parse_args()
+
+    layout = {'type' : 'sharded'} if args.sharded else None
+    results = {
+        'revision' : git_revision(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat' : args.repeat,
+        'items' : args.items,
+        'sizes' : {},
+    }
+    for size in args.sizes:
+        path = os.path.join(args.data_dir, '{}{}-{}'.format('sharded-' if args.sharded else '', size, args.faces))
+        logging.log(31, 'Generating {} things in {}...'.format(size, path))
+        spec = make_dataset(path, size, args.faces, layout=layout, workers=args.workers)
+        results['faces'] = spec['faces']
+        results['layout'] = spec['layout']
+        logging.log(31, 'Benchmarking {} things...'.format(size))
+        results['sizes'][str(size)] = benchmark_dataset(path, args.repeat, args.items)
+        for op, timing in sorted(results['sizes'][str(size)].items()):
+            logging.log(31, '\t{:<20} {:10.6f}s'.format(op, timing['median']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""A benchmark of Thing.export for each mesh file format and number of writer threads.
+
+A synthetic thing with many models, like one split into connected
+components, is exported once per format and thread count. The models and
+megabytes written per second and the time to load the models back are
+reported, along with how far the reloaded vertices moved.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from thingset import MESH_FILE_TYPES, Model, Thing
+
+from synthetic import random_mesh
+
+def make_thing(n_models, subdivisions, seed=0):
+    """Make a thing with many random models.
+    """
+    random_state = np.random.RandomState(seed)
+    models = {}
+    for i in range(n_models):
+        model_id = '{}_cc_{}'.format(1000, i)
+        models[model_id] = Model(model_id, 'component {}'.format(i), random_mesh(random_state, subdivisions))
+    return Thing('1', 'Many Components', 'maker', 'Creative Commons - Attribution',
+                 'http://creativecommons.org/licenses/by/3.0/', '3D Printing', '04:20PM on 01 January 2018', models)
+
+def time_export(thing, file_type, workers, repeat):
+    """Time exporting and reloading a thing.
+
+    Returns
+    -------
+    dict
+        The median ``export_seconds`` and ``load_seconds``, the ``bytes``
+        written, and the largest distance from an original vertex to the
+        nearest reloaded one, ``max_error``.
+    """
+    export_times = []
+    load_times = []
+    for _ in range(repeat):
+        tmp_dir = tempfile.mkdtemp(prefix='thingset-export-')
+        try:
+            start = time.time()
+            metadata = thing.export(tmp_dir, file_type=file_type, workers=workers)
+            export_times.append(time.time() - start)
+            n_bytes = sum(os.path.getsize(os.path.join(tmp_dir, m['mesh'])) for m in metadata['models'].values())
+
+            start = time.time()
+            loaded = Thing.load(tmp_dir)
+            load_times.append(time.time() - start)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    max_error = 0.0
+    for model in thing.models:
+        original = model.source_mesh.vertices
+        reloaded = loaded[model.id].source_mesh.vertices
+        if original.shape != reloaded.shape:
+            max_error = float('inf')
+        else:
+            distances, _ = cKDTree(reloaded).query(original)
+            max_error = max(max_error, float(distances.max()))
+    return {
+        'export_seconds' : float(np.median(export_times)),
+        'load_seconds' : float(np.median(load_times)),
+        'bytes' : n_bytes,
+        'max_error' : max_error,
+    }
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark Thing.export for each mesh format and writer thread count',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--models', help='models in the thing', type=int, default=48)
+    parser.add_argument('--subdivisions', help='icosphere subdivisions per model', type=int, default=4)
+    parser.add_argument('--file-types', help='formats to test', nargs='+', default=list(MESH_FILE_TYPES))
+    parser.add_argument('--workers', help='writer thread counts to test', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--repeat', help='exports per configuration', type=int, default=3)
+    parser.add_argument('--output', help='results filename', default='export_results.json')
+    args = parser.parse_args()
+
+    thing = make_thing(args.models, args.subdivisions)
+    results = {
+        'models' : args.models,
+        'faces' : int(sum(len(m.source_mesh.faces) for m in thing.models)),
+        'formats' : {},
+    }
+    baseline = None
+    for file_type in args.file_types:
+        results['formats'][file_type] = {}
+        for workers in args.workers:
+            result = time_export(thing, file_type, workers, args.repeat)
+            results['formats'][file_type][str(workers)] = result
+            if baseline is None:
+                baseline = result['export_seconds']
+            logging.log(31, '{:>4} x{:<2}: {:.1f} models/s, {:.1f} MB/s ({:.2f}x), load {:.3f}s, {:.2f} MB, max error {:.1e}'.format(
+                file_type, workers, args.models / result['export_seconds'],
+                result['bytes'] / result['export_seconds'] / 1e6, baseline / result['export_seconds'],
+                result['load_seconds'], result['bytes'] / 1e6, result['max_error']
+            ))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""A guard on the cost of importing thingset for metadata-only work.
+
+In a fresh interpreter, this imports thingset, opens a dataset and runs the
+metadata searches, then checks that no mesh, crawl or visualization
+dependencies were imported and that the import fit in the time budget. It
+exits with status 1 if either check fails, so it can run in CI.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from synthetic import make_dataset
+
+HEAVY_MODULES = ['trimesh', 'lxml', 'requests', 'visualization', 'scipy', 'autolab_core']
+
+SCRIPT = '''
+import json, sys, time
+start = time.time()
+import thingset
+seconds = time.time() - start
+ds = thingset.ThingiverseDataset(sys.argv[1])
+ds.keys
+ds.categories
+ds.models
+ds.search_by_metadata('score', 1)
+ds.search_by_keyword('bracket')
+ds.query(keyword='bracket', metadata={'score' : 1})
+ds.metadata(sorted(ds.keys)[0])
+heavy = sorted(m for m in json.loads(sys.argv[2]) if m in sys.modules)
+print(json.dumps({'seconds' : seconds, 'heavy' : heavy}))
+'''
+
+def measure(dataset_dir, python):
+    """Run the metadata-only script in a fresh interpreter.
+
+    Returns
+    -------
+    dict
+        The ``seconds`` taken by ``import thingset`` and the ``heavy``
+        modules that were imported.
+    """
+    output = subprocess.check_output([python, '-c', SCRIPT, dataset_dir, json.dumps(HEAVY_MODULES)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Check the import cost of thingset for metadata-only use',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--dataset', help='dataset to browse; a small synthetic one by default', default=None)
+    parser.add_argument('--budget', help='maximum seconds for import thingset', type=float, default=0.5)
+    parser.add_argument('--repeat', help='number of fresh interpreters to time', type=int, default=5)
+    parser.add_argument('--python', help='interpreter to test', default=sys.executable)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    dataset_dir = args.dataset
+    if dataset_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix='thingset-import-')
+        dataset_dir = os.path.join(tmp_dir, 'dataset')
+        make_dataset(dataset_dir, 20)
+
+    try:
+        results = [measure(dataset_dir, args.python) for _ in range(args.repeat)]
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    seconds = min(r['seconds'] for r in results)
+    heavy = sorted(set(m for r in results for m in r['heavy']))
+    logging.log(31, 'import thingset: {:.3f}s (budget {:.3f}s)'.format(seconds, args.budget))
+    failed = False
+    if len(heavy) > 0:
+        logging.log(32, 'Metadata-only use imported heavy modules: {}'.format(', '.join(heavy)))
+        failed = True
+    if seconds > args.budget:
+        logging.log(32, 'import thingset took {:.3f}s, over the {:.3f}s budget.'.format(seconds, args.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""A benchmark for the packager's pose search on the packager's input set.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import trimesh
+
+from autolab_core import RigidTransform, YamlConfig
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+from packager import Packager
+
+def legacy_packaged_pose(mesh):
+    """The original pose search, which copies the mesh for every candidate pose.
+    """
+    mesh = mesh.copy()
+    tfs, _ = mesh.compute_stable_poses()
+    min_z, min_tf = np.infty, None
+    for tf in tfs:
+        m = mesh.copy().apply_transform(tf)
+        z_ext = m.extents[2]
+        if z_ext < min_z:
+            min_z = z_ext
+            min_tf = tf
+    mesh.apply_transform(min_tf)
+
+    theta = 0
+    dtheta = 0.1
+    min_rot = np.eye(4)
+    min_x_ext = mesh.extents[0]
+    while theta < np.pi:
+        rot = np.eye(4)
+        rot[:3,:3] = RigidTransform.z_axis_rotation(theta)
+        m = mesh.copy()
+        m.apply_transform(rot)
+        x_ext = m.extents[0]
+        if x_ext < min_x_ext:
+            min_x_ext = x_ext
+            min_rot = rot
+        theta += dtheta
+    return min_rot.dot(min_tf)
+
+def time_pose_search(fn, mesh, seed):
+    """Time a pose search, returning the elapsed time and the resulting extents.
+    """
+    np.random.seed(seed)
+    start = time.time()
+    pose = fn(mesh)
+    elapsed = time.time() - start
+    return elapsed, mesh.copy().apply_transform(pose).extents
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the packager pose search',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--config', help='config filename', default='cfg/tools/packager.yaml')
+    parser.add_argument('--seed', help='random seed for stable pose sampling', type=int, default=0)
+    args = parser.parse_args()
+
+    config = YamlConfig(args.config)
+    config['orientation_resolution'] = 0.1
+    grid = Packager(config)
+    exact_config = YamlConfig(args.config)
+    exact_config['orientation_resolution'] = 0
+    exact = Packager(exact_config)
+
+    methods = [
+        ('legacy', legacy_packaged_pose),
+        ('batched', grid._get_packaged_pose),
+        ('exact', exact._get_packaged_pose),
+    ]
+    totals = dict((name, 0.0) for name, _ in methods)
+    n_meshes = 0
+
+    for fn in sorted(os.listdir(config['in_dir'])):
+        mesh = trimesh.load_mesh(os.path.join(config['in_dir'], fn))
+        results = [(name,) + time_pose_search(f, mesh, args.seed) for name, f in methods]
+        n_meshes += 1
+        for name, elapsed, extents in results:
+            totals[name] += elapsed
+        logging.log(31, '{} ({} faces): {}'.format(fn, len(mesh.faces), ', '.join(
+            '{} {:.4f}s x={:.5f}'.format(name, elapsed, extents[0]) for name, elapsed, extents in results
+        )))
+
+    if n_meshes == 0:
+        logging.log(31, 'No meshes found in {}'.format(config['in_dir']))
+        return
+    for name, _ in methods:
+        logging.log(31, '{}: {:.4f}s total, {:.4f}s per mesh ({:.2f}x vs legacy)'.format(
+            name, totals[name], totals[name] / n_meshes, totals['legacy'] / max(totals[name], 1e-12)
+        ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""A benchmark of thingset.pages against the lxml tree walk it replaced.
+
+Each saved page in data/fixtures is parsed both ways. The results are
+checked against each other, and the time per page is reported.
+"""
+import argparse
+import logging
+import os
+import time
+
+from lxml import html
+
+from thingset.pages import PageParseError, parse_search_page, parse_thing_page
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'fixtures')
+
+def lxml_search_page(text):
+    """The original extraction of thing ids from a search page.
+    """
+    root = html.fromstring(text)
+    return [x.get('data-id') for x in root.find_class('thing')]
+
+def lxml_thing_page(text):
+    """The original extraction of a thing page's license and files.
+    """
+    root = html.fromstring(text)
+    license_name = root.find_class('thing-license')[0].get('title')
+    license_url = root.find_rel_links('license')[0].get('href')
+    files = [(a.get('data-file-id'), a.get('title')) for a in root.find_class('file-download')]
+    return license_name, license_url, files
+
+def time_parse(fn, text, repeat):
+    """Return the mean seconds per call of a parser, and its result or error.
+    """
+    try:
+        result = fn(text)
+    except (IndexError, PageParseError) as e:
+        result = e
+    start = time.time()
+    for _ in range(repeat):
+        try:
+            fn(text)
+        except (IndexError, PageParseError):
+            pass
+    return (time.time() - start) / repeat, result
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark thingset.pages against lxml on saved pages',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--fixtures', help='directory of saved pages', default=FIXTURES_DIR)
+    parser.add_argument('--repeat', help='parses per page', type=int, default=1000)
+    args = parser.parse_args()
+
+    for fn in sorted(os.listdir(args.fixtures)):
+        if not fn.endswith('.html'):
+            continue
+        with open(os.path.join(args.fixtures, fn)) as f:
+            text = f.read()
+        if fn.startswith('search'):
+            old_fn, new_fn = lxml_search_page, parse_search_page
+        else:
+            old_fn, new_fn = lxml_thing_page, parse_thing_page
+
+        old_time, old_result = time_parse(old_fn, text, args.repeat)
+        new_time, new_result = time_parse(new_fn, text, args.repeat)
+        if isinstance(new_result, tuple):
+            new_result = (new_result.license_name, new_result.license_url,
+                          [(f.file_id, f.file_name) for f in new_result.files])
+        if isinstance(old_result, Exception) or isinstance(new_result, Exception):
+            agree = isinstance(old_result, Exception) and isinstance(new_result, Exception)
+            detail = 'lxml: {!r}, pages: {!r}'.format(old_result, new_result)
+        else:
+            agree = old_result == new_result
+            detail = ''
+        logging.log(31 if agree else 32, '{}: lxml {:.1f}us, pages {:.1f}us ({:.2f}x){}{}'.format(
+            fn, old_time * 1e6, new_time * 1e6, old_time / max(new_time, 1e-12),
+            '' if agree else ', RESULTS DIFFER', ' ' + detail if detail else ''
+        ))
+
+if __name__ == '__main__':
+    main()
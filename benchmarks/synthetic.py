@@ -0,0 +1,174 @@
+#!/usr/bin/python
+"""A generator for synthetic Thingiverse datasets of a controlled size.
+
+Every thing gets one to four random watertight meshes and metadata shaped like
+that written by Thing.export(), with names, licenses, categories and model
+annotations drawn from realistic distributions. Generation is deterministic
+for a given seed, so datasets made on different machines are comparable.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import trimesh
+
+from thingset import LICENSE_IDS, CATEGORY_IDS, Model, Thing, ThingiverseDataset
+from thingset.layout import load_layout
+from thingset.storage import makedirs, write_json
+
+SPEC_FILENAME = 'synthetic.json'
+
+WORDS = [
+    'bracket', 'gear', 'vase', 'holder', 'case', 'mount', 'clip', 'hook', 'knob',
+    'spool', 'stand', 'box', 'lid', 'adapter', 'dragon', 'owl', 'planter', 'whistle',
+    'phone', 'cable', 'filament', 'raspberry', 'pi', 'arduino', 'customizable',
+    'parametric', 'mini', 'large', 'v2', 'improved', 'remix', 'lamp', 'shade',
+]
+
+def random_mesh(random_state, subdivisions):
+    """Make a random watertight mesh by perturbing a sphere.
+
+    Radial noise keeps the surface star-shaped, so it never self-intersects.
+
+    Parameters
+    ----------
+    random_state : numpy.random.RandomState
+        The source of randomness.
+    subdivisions : int
+        The icosphere subdivisions; the mesh has 20 * 4**subdivisions faces.
+
+    Returns
+    -------
+    trimesh.Trimesh
+        The mesh, a few centimeters across.
+    """
+    sphere = trimesh.creation.icosphere(subdivisions=subdivisions)
+    radii = random_state.uniform(0.8, 1.2, len(sphere.vertices))
+    scale = random_state.uniform(0.01, 0.1, 3)
+    return trimesh.Trimesh(sphere.vertices * radii[:,np.newaxis] * scale, sphere.faces)
+
+def random_name(random_state, n_words):
+    """Make a random thing or model name.
+    """
+    return ' '.join(WORDS[i] for i in random_state.randint(len(WORDS), size=n_words)).title()
+
+def random_thing(thing_id, seed, subdivisions):
+    """Make a random thing.
+
+    Parameters
+    ----------
+    thing_id : str
+        The thing's id.
+    seed : int
+        The dataset seed; the thing is seeded from this and its id.
+    subdivisions : int
+        The icosphere subdivisions of each mesh.
+
+    Returns
+    -------
+    Thing
+        The thing.
+    """
+    random_state = np.random.RandomState([seed, int(thing_id)])
+    licenses = sorted(LICENSE_IDS.keys())
+    categories = sorted(CATEGORY_IDS.keys())
+
+    models = {}
+    file_id = int(thing_id) * 10
+    for i in range(random_state.randint(1, 5)):
+        model_id = str(file_id + i)
+        metadata = {}
+        if random_state.rand() < 0.5:
+            metadata['score'] = int(random_state.randint(0, 4))
+        if random_state.rand() < 0.3:
+            metadata['scale'] = float(random_state.uniform(0.5, 2.0))
+        models[model_id] = Model(model_id, random_name(random_state, 2), random_mesh(random_state, subdivisions), metadata)
+
+    return Thing(thing_id, random_name(random_state, random_state.randint(1, 5)), 'maker{}'.format(random_state.randint(1000)),
+                 licenses[random_state.randint(len(licenses))], 'http://creativecommons.org/licenses/by/3.0/',
+                 categories[random_state.randint(len(categories))], '04:20PM on 01 January 2018', models)
+
+def _write_thing(job):
+    root, thing_id, seed, subdivisions = job
+    thingdir = load_layout(root).path(thing_id)
+    makedirs(thingdir)
+    random_thing(thing_id, seed, subdivisions).export(thingdir)
+
+def make_dataset(path, n_things, faces=80, seed=0, layout=None, workers=1):
+    """Generate a synthetic dataset, or reuse one previously made with the same parameters.
+
+    Parameters
+    ----------
+    path : str
+        The dataset directory.
+    n_things : int
+        The number of things.
+    faces : int
+        The approximate number of faces per mesh.
+    seed : int
+        The random seed.
+    layout : dict
+        The dataset layout, as given to ThingiverseDataset.
+    workers : int
+        The number of processes to write things with.
+
+    Returns
+    -------
+    dict
+        The parameters the dataset was made with.
+    """
+    subdivisions = int(max(round(np.log(faces / 20.0) / np.log(4)), 0))
+    spec = {
+        'n_things' : n_things,
+        'faces' : 20 * 4 ** subdivisions,
+        'seed' : seed,
+        'layout' : layout,
+    }
+    spec_filename = os.path.join(path, SPEC_FILENAME)
+    if os.path.exists(spec_filename):
+        with open(spec_filename) as f:
+            if json.load(f) == spec:
+                return spec
+        raise ValueError('{} holds a different dataset; remove it first.'.format(path))
+
+    ThingiverseDataset(path, layout=layout)
+    jobs = [(path, str(100000 + i), seed, subdivisions) for i in range(n_things)]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_write_thing, jobs, chunksize=64)
+    else:
+        results = (_write_thing(job) for job in jobs)
+    for i, _ in enumerate(results):
+        if (i + 1) % 1000 == 0:
+            logging.log(31, '{}/{} things generated.'.format(i + 1, n_things))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    write_json(spec, spec_filename)
+    return spec
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Thingiverse dataset',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('path', help='dataset directory')
+    parser.add_argument('--things', help='number of things', type=int, default=1000)
+    parser.add_argument('--faces', help='approximate faces per mesh', type=int, default=80)
+    parser.add_argument('--seed', help='random seed', type=int, default=0)
+    parser.add_argument('--sharded', help='use a sharded layout', action='store_true')
+    parser.add_argument('--workers', help='number of processes', type=int, default=4)
+    args = parser.parse_args()
+
+    layout = {'type' : 'sharded'} if args.sharded else None
+    make_dataset(args.path, args.things, args.faces, args.seed, layout, args.workers)
+
+if __name__ == '__main__':
+    main()
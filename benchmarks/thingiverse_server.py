@@ -0,0 +1,282 @@
+#!/usr/bin/python
+"""A local stand-in for the parts of Thingiverse that the dataset crawls.
+
+It serves:
+
+- search and explore pages (``/search/page:{n}``, ``/explore/newest/page:{n}``)
+  listing things as ``<div class="thing" data-id=...>``, with an empty page
+  after the last thing,
+- thing file pages (``/thing:{id}/files``) with ``thing-license`` and license
+  rel links and a ``file-download`` link for each file,
+- mesh downloads (``/download:{id}``) as binary STL files in millimeters,
+  generated like benchmarks/synthetic.py or read from a fixtures directory.
+
+Every response can be delayed, and requests can fail at random with a 500 or
+be rate-limited with a 429 and a Retry-After header, to test how the crawler
+copes with a slow or overloaded site.
+"""
+import argparse
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import numpy as np
+import trimesh
+
+from synthetic import random_mesh
+
+LICENSE_NAME = 'Creative Commons - Public Domain Dedication'
+LICENSE_URL = 'http://creativecommons.org/publicdomain/zero/1.0/'
+
+def make_payloads(n_payloads=8, faces=320, seed=0, fixtures_dir=None):
+    """Make the STL files served for downloads.
+
+    Parameters
+    ----------
+    n_payloads : int
+        The number of random meshes to make, if no fixtures are given.
+    faces : int
+        The approximate number of faces in each random mesh.
+    seed : int
+        The random seed.
+    fixtures_dir : str
+        A directory of mesh files to serve instead of random meshes.
+
+    Returns
+    -------
+    list of bytes
+        The STL files.
+    """
+    if fixtures_dir is not None:
+        meshes = [trimesh.load_mesh(os.path.join(fixtures_dir, fn)) for fn in sorted(os.listdir(fixtures_dir))]
+    else:
+        random_state = np.random.RandomState(seed)
+        subdivisions = int(max(round(np.log(faces / 20.0) / np.log(4)), 0))
+        meshes = [random_mesh(random_state, subdivisions) for _ in range(n_payloads)]
+    # Serve millimetres, which Thing._retrieve_models() scales back to metres
+    for m in meshes:
+        m.apply_scale(1000.0)
+    return [m.export(file_type='stl') for m in meshes]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves one request to a StandInServer.
+    """
+
+    def do_GET(self):
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        status = server.admit()
+        if status == 429:
+            self._send(429, b'Too Many Requests', headers={'Retry-After' : str(server.retry_after)})
+            return
+        if status == 500:
+            self._send(500, b'Internal Server Error')
+            return
+
+        path = self.path.split('?', 1)[0]
+        m = re.match(r'^/(?:search|explore/newest)/page:(\d+)$', path)
+        if m is not None:
+            self._send(200, server.listing_page(int(m.group(1))), 'text/html')
+            return
+        m = re.match(r'^/thing:(\d+)/files$', path)
+        if m is not None and server.has_thing(int(m.group(1))):
+            self._send(200, server.thing_page(int(m.group(1))), 'text/html')
+            return
+        m = re.match(r'^/download:(\d+)$', path)
+        if m is not None and server.has_thing(int(m.group(1)) // 10):
+            self._send(200, server.payloads[int(m.group(1)) % len(server.payloads)], 'application/octet-stream')
+            return
+        self._send(404, b'Not Found')
+
+    def _send(self, status, body, content_type='text/plain', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status, len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server standing in for Thingiverse.
+
+    Things have ids from ``first_id``, and thing ``i`` has files with ids
+    ``10 * i + j``. Request counts and bytes sent are kept in ``stats``.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, payloads, n_things=1000, first_id=1000, per_page=12, models_per_thing=3,
+                 latency=0.0, error_rate=0.0, rate_limit=None, retry_after=1, seed=0):
+        """Create the server.
+
+        Parameters
+        ----------
+        address : (str, int)
+            The host and port to listen on; port 0 picks a free port.
+        payloads : list of bytes
+            The STL files served for downloads, as from make_payloads().
+        n_things : int
+            The number of things listed.
+        first_id : int
+            The id of the first thing.
+        per_page : int
+            The number of things on each listing page.
+        models_per_thing : int
+            The maximum number of mesh files per thing.
+        latency : float
+            Seconds added to every response.
+        error_rate : float
+            The fraction of requests that fail with a 500.
+        rate_limit : float
+            The number of requests per second allowed before requests are
+            answered with a 429, or None for no limit.
+        retry_after : int
+            The Retry-After seconds sent with a 429.
+        seed : int
+            The random seed for failures.
+        """
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.payloads = payloads
+        self.n_things = n_things
+        self.first_id = first_id
+        self.per_page = per_page
+        self.models_per_thing = models_per_thing
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._random_state = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._last_refill = time.time()
+        self.stats = {'requests' : 0, 'bytes' : 0, 'statuses' : {}}
+
+    @property
+    def url(self):
+        """str : The base URL of the server.
+        """
+        return 'http://{}:{}'.format(self.server_address[0], self.server_address[1])
+
+    def admit(self):
+        """Decide how to answer a request: 200, 429 if rate-limited or 500 if failing.
+        """
+        with self._lock:
+            if self.rate_limit is not None:
+                now = time.time()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit)
+                self._last_refill = now
+                if self._tokens < 1:
+                    return 429
+                self._tokens -= 1
+            if self._random_state.rand() < self.error_rate:
+                return 500
+        return 200
+
+    def count(self, status, n_bytes):
+        """Record a response.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += n_bytes
+            self.stats['statuses'][status] = self.stats['statuses'].get(status, 0) + 1
+
+    def has_thing(self, thing_id):
+        return self.first_id <= thing_id < self.first_id + self.n_things
+
+    def listing_page(self, page):
+        """Return the HTML of a search or explore page.
+        """
+        start = self.first_id + (page - 1) * self.per_page
+        stop = min(start + self.per_page, self.first_id + self.n_things)
+        things = ''.join('<div class="thing" data-id="{}"><a href="/thing:{}">Thing {}</a></div>\n'.format(i, i, i)
+                         for i in range(start, stop))
+        return '<html><body>\n{}</body></html>\n'.format(things).encode('utf-8')
+
+    def thing_page(self, thing_id):
+        """Return the HTML of a thing's files page.
+        """
+        links = []
+        for j in range(1 + thing_id % self.models_per_thing):
+            file_id = 10 * thing_id + j
+            links.append('<a class="file-download" data-file-id="{}" title="part_{}.stl" href="/download:{}">'
+                         'part_{}.stl</a>'.format(file_id, j, file_id, j))
+        # A file that isn't a mesh, which the crawler should skip
+        links.append('<a class="file-download" data-file-id="{}" title="readme.txt" href="/download:{}">'
+                     'readme.txt</a>'.format(10 * thing_id + 9, 10 * thing_id + 9))
+        return ('<html><body>\n'
+                '<h1>Thing {}</h1>\n'
+                '<a class="thing-license" title="{}" href="{}"></a>\n'
+                '<a rel="license" href="{}">License</a>\n'
+                '{}\n'
+                '</body></html>\n').format(thing_id, LICENSE_NAME, LICENSE_URL, LICENSE_URL, '\n'.join(links)).encode('utf-8')
+
+
+def start_server(payloads, host='127.0.0.1', port=0, **kwargs):
+    """Start a stand-in server in a background thread.
+
+    Parameters
+    ----------
+    payloads : list of bytes
+        The STL files served for downloads.
+    host : str
+        The host to listen on.
+    port : int
+        The port to listen on; 0 picks a free port.
+    **kwargs
+        Passed to StandInServer.
+
+    Returns
+    -------
+    StandInServer
+        The running server; call shutdown() to stop it.
+    """
+    server = StandInServer((host, port), payloads, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Serve a local stand-in for Thingiverse',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--port', help='port to listen on', type=int, default=8000)
+    parser.add_argument('--things', help='number of things', type=int, default=1000)
+    parser.add_argument('--faces', help='approximate faces per mesh', type=int, default=320)
+    parser.add_argument('--fixtures', help='directory of mesh files to serve', default=None)
+    parser.add_argument('--latency', help='seconds added to each response', type=float, default=0.0)
+    parser.add_argument('--error-rate', help='fraction of requests failing with a 500', type=float, default=0.0)
+    parser.add_argument('--rate-limit', help='requests per second before 429s', type=float, default=None)
+    args = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', args.port), make_payloads(faces=args.faces, fixtures_dir=args.fixtures),
+                           n_things=args.things, latency=args.latency, error_rate=args.error_rate,
+                           rate_limit=args.rate_limit)
+    logging.log(31, 'Serving {} things at {}'.format(args.things, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,6 @@ from setuptools import setup
 requirements = [
     'autolab_core',
     'numpy',
-    'lxml',
     'pyyaml',
     'trimesh',
     'visualization',
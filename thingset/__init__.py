@@ -1,3 +1,16 @@
-from .constants import MAX_N_FACES, LICENSE_IDS, CATEGORY_IDS
+"""Thingiverse dataset downloader and parser.
+
+Importing the package only needs the standard library and numpy, so tools that
+just browse or search metadata start quickly. trimesh, requests and
+visualization are imported when meshes are loaded, things are retrieved from
+Thingiverse or models are shown.
+"""
+from .constants import MAX_N_FACES, THINGIVERSE_URL, STABLE_POSES_KEY, TRANSFORM_KEY, MESH_HASH_KEY, EXPORT_HASH_KEY, MESH_FILE_TYPES, LICENSE_IDS, CATEGORY_IDS
 from .thing import Model, Thing
+from .cache import DerivedCache
+from .crawlqueue import CrawlQueue
 from .dataset import ThingiverseDataset
+from .index import ModelIndex
+from .query import QueryIndex
+from .prefetch import Prefetcher, AsyncWriter
+from .archive import ShardArchive, ShardReader, ShardWriter
@@ -0,0 +1,333 @@
+"""Packed shard archives for streaming a dataset at full disk bandwidth.
+
+Each shard file holds many things, each stored as one record containing the
+thing's metadata and the raw vertex and face arrays of its models. Records are
+appended one after another and followed by an offset table, so shards can be
+streamed sequentially or read by key through a memory map.
+
+Shard file layout::
+
+    header    MAGIC, version (uint32), flags (uint32)
+    records   for each thing: header length (uint32), JSON header, array bytes,
+              zlib-compressed as a whole if the shard is compressed
+    table     JSON map from thing ids to record [offset, length]
+    footer    table offset (uint64), MAGIC
+
+An archive directory also holds a ``manifest.json`` listing its shard files,
+so that shards left over from an earlier export are never read.
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .thing import Model, Thing
+
+MAGIC = b'TSHD'
+MANIFEST_FILENAME = 'manifest.json'
+VERSION = 1
+FLAG_COMPRESSED = 1
+
+_HEADER = struct.Struct('<4sII')
+_FOOTER = struct.Struct('<Q4s')
+_LENGTH = struct.Struct('<I')
+
+def encode_record(metadata, meshes, vertex_dtype=np.float32):
+    """Encode a thing as an uncompressed shard record.
+
+    Vertices are stored as float32 by default, which halves their size but
+    rounds them to about seven significant digits, so they won't match the
+    float64 source geometry exactly; pass ``np.float64`` to store them losslessly.
+
+    Parameters
+    ----------
+    metadata : dict
+        The thing's metadata.
+    meshes : dict
+        A map from model ids to trimesh.Trimesh source geometry.
+    vertex_dtype : numpy.dtype
+        The type to store vertices as.
+
+    Returns
+    -------
+    bytes
+        The record.
+    """
+    arrays = []
+    chunks = []
+    offset = 0
+    for model_id in sorted(meshes):
+        vertices = np.ascontiguousarray(meshes[model_id].vertices, dtype=vertex_dtype)
+        faces = np.ascontiguousarray(meshes[model_id].faces, dtype=np.int32)
+        entry = {'model_id' : model_id}
+        for name, array in (('vertices', vertices), ('faces', faces)):
+            entry[name] = [offset, array.shape[0], array.dtype.str]
+            chunks.append(array.tobytes())
+            offset += array.nbytes
+        arrays.append(entry)
+
+    header = json.dumps({'metadata' : metadata, 'arrays' : arrays}, separators=(',', ':')).encode('utf-8')
+    return _LENGTH.pack(len(header)) + header + b''.join(chunks)
+
+def decode_record(buf, base=0):
+    """Decode an uncompressed shard record.
+
+    Parameters
+    ----------
+    buf : buffer
+        A buffer holding the record. Arrays are views into it, not copies.
+    base : int
+        The offset of the record in the buffer.
+
+    Returns
+    -------
+    metadata : dict
+        The thing's metadata.
+    arrays : dict
+        A map from model ids to (vertices, faces) arrays.
+    """
+    header_len, = _LENGTH.unpack_from(buf, base)
+    start = base + _LENGTH.size + header_len
+    header = json.loads(buf[base + _LENGTH.size:start].decode('utf-8'))
+    arrays = {}
+    for entry in header['arrays']:
+        mesh_arrays = []
+        for name in ('vertices', 'faces'):
+            offset, count, dtype = entry[name]
+            array = np.frombuffer(buf, dtype=np.dtype(dtype), count=3 * count, offset=start + offset)
+            mesh_arrays.append(array.reshape(count, 3))
+        arrays[entry['model_id']] = tuple(mesh_arrays)
+    return header['metadata'], arrays
+
+
+class ShardWriter(object):
+    """Appends things to a single shard file.
+    """
+
+    def __init__(self, filename, compress=False):
+        """Create a shard file.
+
+        Parameters
+        ----------
+        filename : str
+            The shard's filename.
+        compress : bool
+            If True, each record is zlib-compressed.
+        """
+        self._filename = filename
+        self._compress = compress
+        dirname, basename = os.path.split(filename)
+        self._tmp_filename = os.path.join(dirname, '.{}.tmp'.format(basename))
+        self._f = open(self._tmp_filename, 'wb')
+        self._f.write(_HEADER.pack(MAGIC, VERSION, FLAG_COMPRESSED if compress else 0))
+        self._table = {}
+
+    def __len__(self):
+        return len(self._table)
+
+    @property
+    def nbytes(self):
+        """int : The number of bytes written so far.
+        """
+        return self._f.tell()
+
+    def write(self, thing_id, record):
+        """Append a record made by encode_record().
+
+        Parameters
+        ----------
+        thing_id : str
+            The key of the thing.
+        record : bytes
+            The uncompressed record.
+        """
+        if self._compress:
+            record = zlib.compress(record)
+        self._table[thing_id] = [self._f.tell(), len(record)]
+        self._f.write(record)
+
+    def close(self):
+        """Write the offset table and move the finished shard into place.
+        """
+        table_offset = self._f.tell()
+        self._f.write(json.dumps(self._table, separators=(',', ':')).encode('utf-8'))
+        self._f.write(_FOOTER.pack(table_offset, MAGIC))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.rename(self._tmp_filename, self._filename)
+
+
+class ShardReader(object):
+    """Reads things from a single shard file through a memory map.
+    """
+
+    def __init__(self, filename):
+        """Open a shard file.
+
+        Parameters
+        ----------
+        filename : str
+            The shard's filename.
+
+        Raises
+        ------
+        ValueError
+            If the file isn't a complete shard.
+        """
+        self._f = open(filename, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags = _HEADER.unpack_from(self._mm, 0)
+        table_offset, end_magic = _FOOTER.unpack_from(self._mm, len(self._mm) - _FOOTER.size)
+        if magic != MAGIC or end_magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a valid shard file.'.format(filename))
+        self._compressed = bool(flags & FLAG_COMPRESSED)
+        table = self._mm[table_offset:len(self._mm) - _FOOTER.size]
+        self._table = json.loads(table.decode('utf-8'))
+
+    @property
+    def keys(self):
+        """list of str : The keys of the things in the shard, in file order.
+        """
+        return sorted(self._table, key=lambda k: self._table[k][0])
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, key):
+        return str(key) in self._table
+
+    def read(self, key):
+        """Read a thing's metadata and mesh arrays.
+
+        Parameters
+        ----------
+        key : str
+            The key of the thing.
+
+        Returns
+        -------
+        metadata : dict
+            The thing's metadata.
+        arrays : dict
+            A map from model ids to (vertices, faces) arrays of the models'
+            source geometry. For uncompressed shards, these are read-only views
+            of the memory map.
+        """
+        key = str(key)
+        if key not in self._table:
+            raise KeyError(key)
+        offset, length = self._table[key]
+        if self._compressed:
+            return decode_record(zlib.decompress(self._mm[offset:offset + length]))
+        return decode_record(self._mm, offset)
+
+    def __iter__(self):
+        """Yield (thing_id, metadata, arrays) for every thing, in file order.
+        """
+        for key in self.keys:
+            metadata, arrays = self.read(key)
+            yield key, metadata, arrays
+
+    def load(self, key):
+        """Load a thing, with models whose transforms are applied lazily as usual.
+
+        Parameters
+        ----------
+        key : str
+            The key of the thing.
+
+        Returns
+        -------
+        Thing
+            The thing.
+        """
+        import trimesh
+        metadata, arrays = self.read(key)
+        models = {}
+        for model_id, (vertices, faces) in arrays.items():
+            model = metadata['models'][model_id]
+            mesh = trimesh.Trimesh(vertices, faces, process=False)
+            models[model_id] = Model(model_id, model['name'], mesh, model['metadata'])
+        return Thing(metadata['id'], metadata['name'], metadata['author'],
+                     metadata['license']['type'], metadata['license']['url'],
+                     metadata['category'], metadata['access_time'], models)
+
+    def close(self):
+        """Close the shard.
+
+        If arrays read from the shard are still alive, the memory map is
+        released when the last of them is freed.
+        """
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+        self._f.close()
+
+
+class ShardArchive(object):
+    """A directory of shard files that together hold a dataset.
+    """
+
+    def __init__(self, path):
+        """Open a shard archive.
+
+        Parameters
+        ----------
+        path : str
+            The archive directory. The shards listed in its manifest are read,
+            or every shard file if it has none.
+        """
+        manifest = os.path.join(path, MANIFEST_FILENAME)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                filenames = json.load(f)['shards']
+        else:
+            filenames = sorted(fn for fn in os.listdir(path) if fn.endswith('.shard'))
+        self._shards = [ShardReader(os.path.join(path, fn)) for fn in filenames]
+        self._shard_of = {}
+        for shard in self._shards:
+            for key in shard.keys:
+                self._shard_of[key] = shard
+
+    @property
+    def keys(self):
+        """list of str : The keys of every thing in the archive.
+        """
+        return list(self._shard_of.keys())
+
+    def __len__(self):
+        return len(self._shard_of)
+
+    def read(self, key):
+        """Read a thing's metadata and mesh arrays. See ShardReader.read().
+        """
+        key = str(key)
+        if key not in self._shard_of:
+            raise KeyError(key)
+        return self._shard_of[key].read(key)
+
+    def __getitem__(self, key):
+        """Load a thing. See ShardReader.load().
+        """
+        key = str(key)
+        if key not in self._shard_of:
+            raise KeyError(key)
+        return self._shard_of[key].load(key)
+
+    def __iter__(self):
+        """Yield (thing_id, metadata, arrays) for every thing, one shard at a time.
+        """
+        for shard in self._shards:
+            for item in shard:
+                yield item
+
+    def close(self):
+        """Close every shard.
+        """
+        for shard in self._shards:
+            shard.close()
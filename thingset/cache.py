@@ -0,0 +1,119 @@
+"""On-disk cache of data derived from model geometry.
+"""
+import json
+import os
+
+import numpy as np
+
+from .storage import makedirs, save_array, write_json
+
+class DerivedCache(object):
+    """A directory of arrays computed from model geometry, e.g. point clouds.
+
+    Entries are named by a hash of the geometry they were computed from, so a
+    model whose mesh or transform changes simply gets new entries rather than
+    stale ones. Entries are written atomically and read back as read-only
+    memory maps, so many processes can share a cache.
+    """
+
+    def __init__(self, root):
+        """Open a cache in a directory, which is created when first written to.
+
+        Parameters
+        ----------
+        root : str
+            The cache directory.
+        """
+        self._root = root
+
+    @property
+    def root(self):
+        """str : The cache directory.
+        """
+        return self._root
+
+    def filename(self, kind, name, ext='.npy'):
+        """Return the file an entry is stored in.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of data, e.g. ``points``.
+        name : str
+            The entry's name, starting with a hex digest.
+        ext : str
+            The file extension; ``.json`` gives the entry's sidecar file.
+
+        Returns
+        -------
+        str
+            The entry's filename.
+        """
+        return os.path.join(self._root, kind, name[:2], '{}{}'.format(name, ext))
+
+    def has(self, kind, name):
+        """Return True if an entry exists.
+        """
+        return os.path.exists(self.filename(kind, name))
+
+    def load(self, kind, name):
+        """Memory-map an entry.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of data.
+        name : str
+            The entry's name.
+
+        Returns
+        -------
+        numpy.memmap
+            A read-only view of the entry, or None if it doesn't exist.
+        """
+        filename = self.filename(kind, name)
+        if not os.path.exists(filename):
+            return None
+        return np.load(filename, mmap_mode='r')
+
+    def load_info(self, kind, name):
+        """Load the sidecar of an entry.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of data.
+        name : str
+            The entry's name.
+
+        Returns
+        -------
+        dict
+            The information saved with the entry, or None if there is none.
+        """
+        filename = self.filename(kind, name, '.json')
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    def save(self, kind, name, array, info=None):
+        """Write an entry.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of data.
+        name : str
+            The entry's name.
+        array : numpy.ndarray
+            The data.
+        info : dict
+            Information needed to interpret the data, e.g. a grid's bounds,
+            which is written to a JSON sidecar before the data itself.
+        """
+        filename = self.filename(kind, name)
+        makedirs(os.path.dirname(filename))
+        if info is not None:
+            write_json(info, self.filename(kind, name, '.json'))
+        save_array(array, filename)
@@ -3,6 +3,17 @@
 
 MAX_N_FACES=500000
 
+THINGIVERSE_URL='https://www.thingiverse.com'
+
+STABLE_POSES_KEY='stable_poses'
+TRANSFORM_KEY='transform'
+MESH_HASH_KEY='mesh_hash'
+# The mesh_hash of the geometry a model's mesh file was written from
+EXPORT_HASH_KEY='export_hash'
+
+# Mesh file formats that can be saved; all but obj are binary
+MESH_FILE_TYPES=('obj', 'ply', 'stl', 'glb')
+
 LICENSE_IDS = {
     "Creative Commons - Attribution" : "cc",
     "Creative Commons - Attribution - Share Alike" : "ccsa",
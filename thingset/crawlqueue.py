@@ -0,0 +1,325 @@
+"""A durable crawl work queue that many crawler processes can share.
+
+The queue is a SQLite database, by default ``crawl.sqlite`` in the dataset
+root. It holds two kinds of task: search pages, keyed by URL, and things,
+keyed by thing id. Because tasks are unique by key, a thing found by
+several searches or workers is only queued once.
+
+A worker leases a task for a limited time and renews the lease with
+heartbeats while working on it. If a worker dies, its lease expires and
+another worker picks the task up. Failed tasks are retried until they have
+been attempted ``max_attempts`` times.
+
+A search is split into ``strides`` interleaved runs of pages, so that
+several workers can page through it at once: page ``p`` is queued with
+pages ``1`` to ``strides``, and when a worker finishes page ``p`` it queues
+page ``p + strides`` unless ``p`` was the last page.
+
+SQLite relies on the filesystem's locks, so for workers on several machines
+the dataset must be on a filesystem with working POSIX locks.
+"""
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from .constants import THINGIVERSE_URL, LICENSE_IDS, CATEGORY_IDS
+
+PAGE = 'page'
+THING = 'thing'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_expires);
+'''
+
+def search_url(params=None, base_url=THINGIVERSE_URL):
+    """Return the URL template of a search, with a ``{}`` placeholder for the page number.
+
+    Parameters
+    ----------
+    params : dict
+        A set of parameters, including 'category', 'license', and 'query'.
+        If None, the newest things are listed.
+    base_url : str
+        The root URL of the site.
+
+    Raises
+    ------
+    ValueError
+        If the category or license is unknown.
+    """
+    if params is None:
+        return base_url + '/explore/newest/page:{}'
+
+    url = base_url + '/search/page:{}?type=things'
+    if 'category' in params:
+        if params['category'] not in CATEGORY_IDS:
+            raise ValueError('{} is an invalid category.'.format(params['category']))
+        url = '{}&category_id={}'.format(url, CATEGORY_IDS[params['category']])
+
+    if 'license' in params:
+        if params['license'] not in LICENSE_IDS:
+            raise ValueError('{} is an invalid license.'.format(params['license']))
+        url = '{}&license={}'.format(url, LICENSE_IDS[params['license']])
+
+    if 'query' in params and params['query'] != '':
+        url = '{}&q={}'.format(url, quote(params['query']))
+    return url
+
+
+class Task(collections.namedtuple('Task', ['kind', 'key', 'payload', 'attempts'])):
+    """A leased unit of crawl work.
+
+    Attributes
+    ----------
+    kind : str
+        PAGE or THING.
+    key : str
+        The page's URL or the thing's id.
+    payload : dict
+        For a page, the search's URL ``template``, the ``page`` number,
+        the ``strides`` and the ``max_pages``. Empty for a thing.
+    attempts : int
+        The number of times the task has been leased, including this one.
+    """
+    __slots__ = ()
+
+
+class CrawlQueue(object):
+    """A queue of search pages and things to crawl, shared through a SQLite file.
+
+    Each thread gets its own connection, so a queue can be used from a
+    crawler's worker threads.
+    """
+
+    def __init__(self, filename, lease_seconds=300.0, max_attempts=3):
+        """Open a queue, creating it if needed.
+
+        Parameters
+        ----------
+        filename : str
+            The SQLite database file.
+        lease_seconds : float
+            How long a lease lasts without a heartbeat.
+        max_attempts : int
+            The number of times a task is tried before it's marked failed.
+        """
+        self._filename = filename
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    @property
+    def lease_seconds(self):
+        """float : How long a lease lasts without a heartbeat.
+        """
+        return self._lease_seconds
+
+    def add_search(self, params=None, base_url=THINGIVERSE_URL, strides=1, max_pages=None):
+        """Queue the first pages of a search.
+
+        Parameters
+        ----------
+        params : dict
+            The search parameters, as given to search_url().
+        base_url : str
+            The root URL of the site.
+        strides : int
+            The number of pages of the search that can be crawled at once.
+        max_pages : int
+            The last page to crawl, or None to crawl until the results end.
+
+        Returns
+        -------
+        int
+            The number of pages added; pages already queued aren't added again.
+        """
+        template = search_url(params, base_url)
+        last = strides if max_pages is None else min(strides, max_pages)
+        return sum(self.add_page(template, page, strides, max_pages) for page in range(1, last + 1))
+
+    def add_page(self, template, page, strides=1, max_pages=None):
+        """Queue a single page of a search.
+
+        Returns
+        -------
+        bool
+            True if the page wasn't already queued.
+        """
+        payload = {'template' : template, 'page' : page, 'strides' : strides, 'max_pages' : max_pages}
+        return self._add(PAGE, template.format(page), payload)
+
+    def add_things(self, thing_ids):
+        """Queue things to retrieve.
+
+        Returns
+        -------
+        int
+            The number of things added; things already queued aren't added again.
+        """
+        return sum(self._add(THING, str(thing_id), {}) for thing_id in thing_ids)
+
+    def lease(self, owner):
+        """Lease the next task. Search pages are handed out before things.
+
+        Parameters
+        ----------
+        owner : str
+            A name for the worker, unique across processes and machines.
+
+        Returns
+        -------
+        Task
+            The task, or None if there's nothing to do right now.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("UPDATE tasks SET state = 'failed', error = 'lease expired' "
+                         "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                         (now, self._max_attempts))
+            row = conn.execute("SELECT kind, key, payload, attempts FROM tasks "
+                               "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                               "ORDER BY kind = ?, rowid LIMIT 1", (now, THING)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            kind, key, payload, attempts = row
+            conn.execute("UPDATE tasks SET state = 'leased', owner = ?, lease_expires = ?, attempts = ? "
+                         "WHERE kind = ? AND key = ?", (owner, now + self._lease_seconds, attempts + 1, kind, key))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return Task(kind, key, json.loads(payload), attempts + 1)
+
+    def heartbeat(self, task, owner):
+        """Renew a lease.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost, e.g. because it expired and another
+            worker took the task over.
+        """
+        return self._finish(task, owner, "lease_expires = ?", (time.time() + self._lease_seconds,))
+
+    def complete(self, task, owner):
+        """Mark a leased task done.
+
+        Returns
+        -------
+        bool
+            False if the lease had been lost.
+        """
+        return self._finish(task, owner, "state = 'done', lease_expires = NULL", ())
+
+    def fail(self, task, owner, error):
+        """Give up a leased task after an error, so that it's retried or marked failed.
+
+        Returns
+        -------
+        bool
+            False if the lease had been lost.
+        """
+        state = 'failed' if task.attempts >= self._max_attempts else 'pending'
+        return self._finish(task, owner, "state = ?, lease_expires = NULL, error = ?", (state, str(error)))
+
+    def counts(self):
+        """Count the tasks of each kind in each state.
+
+        Returns
+        -------
+        dict
+            A map from kinds to maps from states (``pending``, ``leased``,
+            ``done`` and ``failed``) to counts.
+        """
+        counts = {PAGE : {}, THING : {}}
+        for kind, state, count in self._conn().execute(
+                'SELECT kind, state, COUNT(*) FROM tasks GROUP BY kind, state'):
+            counts[kind][state] = count
+        return counts
+
+    def active(self):
+        """Return the number of tasks that are pending or leased, i.e. not done or failed.
+        """
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def _add(self, kind, key, payload):
+        cursor = self._conn().execute('INSERT OR IGNORE INTO tasks (kind, key, payload) VALUES (?, ?, ?)',
+                                      (kind, key, json.dumps(payload)))
+        return cursor.rowcount > 0
+
+    def _finish(self, task, owner, assignments, values):
+        cursor = self._conn().execute(
+            "UPDATE tasks SET {} WHERE kind = ? AND key = ? AND owner = ? AND state = 'leased'".format(assignments),
+            tuple(values) + (task.kind, task.key, owner))
+        return cursor.rowcount > 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._filename, timeout=60.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+
+class Heartbeat(object):
+    """Renews a task's lease on a background thread while the task is worked on::
+
+        with Heartbeat(queue, task, owner, max_seconds=3600.0):
+            ...
+
+    Renewal stops after ``max_seconds``, so a worker stuck on a task only
+    holds it until its lease then runs out, after which another worker can
+    take it over.
+    """
+
+    def __init__(self, queue, task, owner, max_seconds=None):
+        self._queue = queue
+        self._task = task
+        self._owner = owner
+        self._max_seconds = max_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        interval = self._queue.lease_seconds / 3.0
+        start = time.time()
+        while not self._stop.wait(interval):
+            if self._max_seconds is not None and time.time() - start > self._max_seconds:
+                logging.log(32, 'Crawl task {} {} ran for over {}s; no longer renewing its lease.'.format(
+                    self._task.kind, self._task.key, self._max_seconds))
+                return
+            if not self._queue.heartbeat(self._task, self._owner):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
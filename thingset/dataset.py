@@ -1,26 +1,248 @@
 """Dataset for storing and retrieving Thingiverse objects.
 """
 import argparse
+import contextlib
+import copy
 import json
 import logging
-from lxml import html
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import os
 import re
-import requests
+import shutil
+import socket
+import threading
 import time
-import urllib
 import urlparse
 
-from visualization import Visualizer3D as vis
+from .archive import MANIFEST_FILENAME, ShardWriter, encode_record
+from .cache import DerivedCache
+from .crawlqueue import PAGE, Heartbeat, search_url
+from .constants import THINGIVERSE_URL, MESH_HASH_KEY, EXPORT_HASH_KEY, MESH_FILE_TYPES, STABLE_POSES_KEY, TRANSFORM_KEY
+from .index import ModelIndex
+from .layout import ConvertingLayout, begin_conversion, create_layout, load_layout, save_layout
+from .pages import PageParseError, parse_search_page
+from .query import QueryIndex
+from . import profiling
+from .storage import FileLock, NullLock, copy_file, export_mesh, makedirs, save_arrays, write_json, write_json_many
+from .thing import Model, Thing, http_get, remove_stale_meshes, transformed_hash
 
-from .constants import LICENSE_IDS, CATEGORY_IDS
-from .thing import Thing
+_FLUSH_CHUNK = 256
+
+def _copy_json(obj):
+    """Return a deep copy of an object as it would be read back from a JSON file.
+    """
+    return json.loads(json.dumps(obj))
+
+def _compute_thing_stable_poses(thingpath):
+    """Compute the stable poses of every model in a saved thing.
+
+    Parameters
+    ----------
+    thingpath : str
+        The directory the thing is saved in.
+
+    Returns
+    -------
+    str
+        The thing's id.
+    dict
+        A map from the ids of models whose cached poses changed to metadata
+        patches holding the new poses.
+    """
+    thing = Thing.load(thingpath)
+    patches = {}
+    for model in thing.models:
+        cached = model.metadata.get(STABLE_POSES_KEY)
+        model.stable_poses()
+        if model.metadata[STABLE_POSES_KEY] is not cached:
+            patches[model.id] = {STABLE_POSES_KEY : model.metadata[STABLE_POSES_KEY]}
+    return thing.id, patches
+
+def _extract_model(job):
+    """Load a single model and write it out.
+
+    Parameters
+    ----------
+    job : dict
+        The source thing directory (``thingpath``), model id (``model_id``) and
+        metadata entry (``model_dict``), the output filename (``out``), file
+        type (``file_type``), whether to write the source geometry instead of
+        the transformed one (``source``) and an optional ``predicate``.
+
+    Returns
+    -------
+    int
+        The number of bytes written, or None if the predicate rejected the model.
+    """
+    model = Model.load(job['thingpath'], job['model_id'], job['model_dict'])
+    if job['predicate'] is not None and not job['predicate'](model):
+        return None
+    mesh = model.source_mesh if job['source'] else model.mesh
+    export_mesh(mesh, job['out'])
+    return os.path.getsize(job['out'])
+
+def _sample_model_points(job):
+    """Load a single model and cache a point cloud sampled from its surface.
+
+    Parameters
+    ----------
+    job : dict
+        The source thing directory (``thingpath``), model id (``model_id``) and
+        metadata entry (``model_dict``), the geometry hash recorded in its
+        metadata (``geometry_hash``, or None), the number of points (``n``)
+        and seed (``seed``), and the cache directory (``cache_dir``).
+
+    Returns
+    -------
+    str
+        The hash of the model's source geometry.
+    """
+    model = Model.load(job['thingpath'], job['model_id'], job['model_dict'])
+    cache = DerivedCache(job['cache_dir'])
+    name = _point_cloud_name(job['geometry_hash'] or model.geometry_hash, job['n'], job['seed'])
+    cache.save('points', name, model.sample_points(job['n'], job['seed']))
+    return model.mesh_hash
+
+def _point_cloud_name(geometry_hash, n, seed):
+    """Return the cache entry name of a point cloud.
+    """
+    return '{}-{}-{}'.format(geometry_hash, n, seed)
+
+VOXEL_GRID_KINDS = ('occupancy', 'sdf')
+
+def _cache_voxel_grids(model, resolutions, kinds, cache, geometry_hash=None):
+    """Compute and cache a model's occupancy and/or SDF grids where missing.
+
+    Occupancy grids are stored bit-packed. Each entry has a sidecar holding
+    its grid's shape, origin (the center of voxel (0,0,0)), pitch and bounds.
+
+    Parameters
+    ----------
+    model : Model
+        The model.
+    resolutions : list of int
+        The grid resolutions.
+    kinds : list of str
+        The grids to cache, from ``occupancy`` and ``sdf``.
+    cache : DerivedCache
+        The cache.
+    geometry_hash : str
+        The hash to name the entries by, if recorded in the model's
+        metadata. Defaults to the hash of the loaded geometry.
+    """
+    geometry_hash = geometry_hash or model.geometry_hash
+    for resolution in resolutions:
+        name = _voxel_grid_name(geometry_hash, resolution)
+        missing = [k for k in kinds if not cache.has(k, name)]
+        if len(missing) == 0:
+            continue
+
+        occupancy = None
+        if 'sdf' in missing:
+            sdf, origin, pitch = model.signed_distance_field(resolution)
+            occupancy = sdf > 0
+        else:
+            occupancy, origin, pitch = model.voxelize(resolution)
+        info = {
+            'shape' : [resolution] * 3,
+            'origin' : origin.tolist(),
+            'pitch' : float(pitch),
+            'bounds' : [(origin - pitch / 2.0).tolist(), (origin + pitch * (resolution - 0.5)).tolist()],
+        }
+        if 'sdf' in missing:
+            cache.save('sdf', name, sdf, info)
+        if 'occupancy' in missing:
+            cache.save('occupancy', name, np.packbits(occupancy.ravel()), info)
+
+def _voxelize_model(job):
+    """Load a single model and cache its voxel grids.
+
+    Parameters
+    ----------
+    job : dict
+        The source thing directory (``thingpath``), model id (``model_id``) and
+        metadata entry (``model_dict``), the geometry hash recorded in its
+        metadata (``geometry_hash``, or None), the grid ``resolutions`` and
+        ``kinds``, and the cache directory (``cache_dir``).
+
+    Returns
+    -------
+    str
+        The hash of the model's source geometry.
+    """
+    model = Model.load(job['thingpath'], job['model_id'], job['model_dict'])
+    _cache_voxel_grids(model, job['resolutions'], job['kinds'], DerivedCache(job['cache_dir']), job['geometry_hash'])
+    return model.mesh_hash
+
+def _voxel_grid_name(geometry_hash, resolution):
+    """Return the cache entry name of a voxel grid.
+    """
+    return '{}-{}'.format(geometry_hash, resolution)
+
+def _encode_thing(thingpath):
+    """Load a saved thing and encode it as a shard record.
+
+    Parameters
+    ----------
+    thingpath : str
+        The directory the thing is saved in.
+
+    Returns
+    -------
+    str
+        The thing's id.
+    bytes
+        The record.
+    """
+    metadata = Thing.load_metadata(thingpath)
+    meshes = {}
+    for model_id in metadata['models']:
+        meshes[model_id] = Model.load(thingpath, model_id, metadata['models'][model_id]).source_mesh
+    return metadata['id'], encode_record(metadata, meshes)
 
 class ThingiverseDataset(object):
     """A filesystem-based dataset of Thingiverse objects.
+
+    Every file in the dataset is written atomically, so readers in other
+    processes never see a partially-written thing.
+
+    With ``multiprocess=True``, several processes (e.g. crawlers and labelling
+    tools) can write to the same dataset at once. Each thing directory then has
+    a hidden lock file beside it, and the dataset root has an index lock that
+    guards creating thing directories. In this mode:
+
+    - update_model_metadata() and update_models_metadata() re-read each thing's
+      metadata from disk under its lock before applying their patches, so
+      labels written by other processes are never lost.
+    - save() holds the thing's lock while writing. It replaces the whole thing,
+      so it should only be used by the process that owns a thing's geometry.
+    - retrieve_from_thingiverse() skips things that another process is
+      retrieving or has already retrieved.
+    - refresh() picks up things added by other processes.
+
+    Retrievals interrupted by a crash leave hidden staging directories beside
+    their things; recover() finishes or undoes them. Opening a dataset never
+    changes it, so readers can't disturb a crawler that is still running.
+
+    Thing directories are stored under the root according to the dataset's
+    layout, recorded in ``layout.json``. The default flat layout puts every
+    thing directly under the root. A sharded layout nests things in hashed
+    shard directories, optionally spread over several volumes, which keeps
+    directories small for datasets with hundreds of thousands of things.
+
+    Data derived from model geometry, such as sampled point clouds and voxel
+    grids, is cached under ``derived/`` in the root, keyed by a hash of each
+    model's geometry and transform. Models record the hash of their mesh file's geometry in
+    their metadata, so cached data can be found without loading any meshes,
+    and reading it never writes to the dataset.
+
+    Bulk metadata changes can be grouped with batch(), which buffers them in
+    memory and writes every changed thing's metadata file in one pass at the end.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, multiprocess=False, layout=None):
         """Initialize a Thingiverse dataset in a given directory.
         If the dataset exists, load it -- otherwise, initialize one.
 
@@ -28,23 +250,122 @@ class ThingiverseDataset(object):
         ----------
         path : str
             A directory for the dataset.
+        multiprocess : bool
+            If True, lock things while writing them so that other processes
+            can safely write to the dataset at the same time.
+        layout : dict
+            The directory layout for a new dataset, e.g. ``{'type' : 'sharded',
+            'depth' : 2, 'width' : 2, 'roots' : [...]}``, where relative roots
+            are relative to the dataset directory. If None, an existing
+            dataset's recorded layout is used, and new datasets are flat.
+
+        Raises
+        ------
+        ValueError
+            If the given layout differs from that of an existing, non-empty dataset.
         """
         self._root = path
+        self._multiprocess = multiprocess
         self._thing_metadata = {
         }
+        self._model_index = None
+        self._query_index = None
+        self._batch = None
+        self._cache = DerivedCache(os.path.join(path, 'derived'))
 
         # If the Dataset hasn't been opened before, initialize it.
         if not os.path.exists(path):
-            os.makedirs(path)
-            return
+            makedirs(path)
+        self._layout = load_layout(path)
+        self.refresh()
+
+        if layout is not None:
+            layout = create_layout(path, layout)
+            if layout.to_dict() != self._layout.to_dict():
+                if len(self._thing_metadata) > 0:
+                    raise ValueError('Dataset {} already has a {} layout; use convert_layout() to change it.'.format(
+                        path, self._layout.to_dict()['type']
+                    ))
+                save_layout(path, layout)
+                self._layout = layout
+
+    @profiling.timed('dataset.refresh')
+    def refresh(self):
+        """Reload the index from disk, picking up changes made by other processes.
+        """
+        thing_metadata = {}
+        for thingpath in self._layout.thing_dirs():
+            metadata = Thing.load_metadata(thingpath)
+            if metadata:
+                thing_id = metadata['id']
+                thing_metadata[thing_id] = metadata
+        self._thing_metadata = thing_metadata
+        self._model_index = None
+        self._query_index = None
+
+    def recover(self):
+        """Finish or undo every interrupted retrieval and remove its leftovers.
+
+        Retrievals hold their thing's lock file whether or not the dataset is
+        in multi-process mode, and things whose lock is held are skipped, so
+        this is safe to call while crawlers are writing to the dataset.
 
-        for name in os.listdir(self._root):
-            thingpath = os.path.join(self._root, name)
-            if os.path.isdir(thingpath):
-                metadata = Thing.load_metadata(thingpath)
-                if metadata:
-                    thing_id = metadata['id']
-                    self._thing_metadata[thing_id] = metadata
+        Returns
+        -------
+        list of str
+            The ids of the things that were recovered.
+        """
+        recovered = []
+        for thingpath in sorted(set(self._layout.interrupted_dirs())):
+            thing_id = os.path.basename(thingpath)
+            lock = self._thing_lock(thing_id, retrieval=True)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if Thing.recover_retrieval(thingpath):
+                    logging.log(32, 'Recovered interrupted retrieval of {}.'.format(thingpath))
+                    recovered.append(thing_id)
+            finally:
+                lock.release()
+        self.refresh()
+        return recovered
+
+    def convert_layout(self, layout):
+        """Move every thing into a new directory layout.
+
+        The new layout is recorded as pending before any thing moves, and
+        until the conversion finishes the dataset finds each thing in
+        whichever layout it's in, so an interrupted conversion loses
+        nothing. Calling this again with the same layout resumes it.
+
+        Parameters
+        ----------
+        layout : dict
+            The new layout, as given to the constructor.
+
+        Raises
+        ------
+        ValueError
+            If a conversion to a different layout is still unfinished.
+        """
+        layout = create_layout(self._root, layout)
+        with self._index_lock():
+            current = load_layout(self._root)
+            if isinstance(current, ConvertingLayout):
+                if current.target.to_dict() != layout.to_dict():
+                    raise ValueError('Dataset {} is part way through a conversion to {}; finish it first.'.format(
+                        self._root, current.target.to_dict()
+                    ))
+            else:
+                begin_conversion(self._root, layout)
+                current = ConvertingLayout(current, layout)
+            self._layout = current
+            for i, thing_id in enumerate(sorted(self.keys)):
+                current.move(thing_id)
+                if (i + 1) % 1000 == 0:
+                    logging.log(31, '{}/{} things moved.'.format(i + 1, len(self.keys)))
+            save_layout(self._root, layout)
+            self._layout = layout
 
     @property
     def keys(self):
@@ -52,46 +373,344 @@ class ThingiverseDataset(object):
         """
         return self._thing_metadata.keys()
 
+    @property
+    def models(self):
+        """ModelIndex : A flat, integer-indexed list of every (thing_id, model_id) pair.
+        """
+        if self._model_index is None:
+            self._model_index = ModelIndex.from_metadata(self._thing_metadata)
+        return self._model_index
+
     @property
     def categories(self):
         """list of str : A list of categories available in the dataset.
         """
         return set([x['category'] for x in self._thing_metadata.itervalues()])
 
+    @profiling.timed('search.category')
     def category_keys(self, category):
         """list of str : A list of keys for things in the given category.
         """
-        keys = []
-        for thing_id in self.keys:
-            thing_category = self._thing_metadata[thing_id]['category']
-            if thing_category == category:
-                keys.append(thing_id)
-        return keys
+        return sorted(self._queries.category_things(category))
+
+    @profiling.timed('search.query')
+    def query(self, category=None, keyword=None, metadata=None, where=None):
+        """Return the models matching every given filter.
+
+        Filters are answered from posting lists kept up to date as metadata
+        changes, most selective first, so compound queries stay fast on large
+        datasets. Use explain() to see how a query is run.
+
+        Parameters
+        ----------
+        category : str
+            The category of the models' things.
+        keyword : str
+            A regular expression searched for, ignoring case, in the names of
+            the models and their things. A model matches if its own name or
+            its thing's name does.
+        metadata : dict
+            Model metadata keys and the values they must have.
+        where : dict
+            Model metadata keys and predicates their values must satisfy,
+            e.g. ``{'scale' : lambda s: s > 1.0}``. Models without a key don't match.
+
+        Returns
+        -------
+        list of (str, str)
+            The sorted (thing_id, model_id) pairs of the matching models.
+        """
+        return self._queries.query(category=category, keyword=keyword, metadata=metadata, where=where)
+
+    def explain(self, category=None, keyword=None, metadata=None, where=None):
+        """Describe how query() would run a query.
+
+        Returns
+        -------
+        list of str
+            The posting lists intersected, smallest first, and the filters
+            checked against each remaining model.
+        """
+        return self._queries.explain(category=category, keyword=keyword, metadata=metadata, where=where)
+
+    @property
+    def _queries(self):
+        """QueryIndex : The posting lists over the dataset's metadata, built on first use.
+        """
+        if self._query_index is None:
+            self._query_index = QueryIndex(self._thing_metadata)
+        return self._query_index
 
     def metadata(self, key):
         """Return metadata for a Thing in the database.
         """
         key = str(key)
+        if self._batch is not None and key in self._batch['metadata']:
+            return self._batch['metadata'][key]
         if key not in self._thing_metadata:
             raise KeyError(key)
         return self._thing_metadata[key]
 
+    def model_filename(self, thing_id, model_id):
+        """Return the path to the mesh file of a model in the database.
+
+        Parameters
+        ----------
+        thing_id : str
+            The key of the thing containing the model.
+        model_id : str
+            The key of the model.
+
+        Returns
+        -------
+        str
+            The model's mesh filename.
+        """
+        thing_id = str(thing_id)
+        model = self.metadata(thing_id)['models'][model_id]
+        return os.path.join(self._thing_path(thing_id), model['mesh'])
+
+    @profiling.timed('dataset.load_model')
+    def load_model(self, thing_id, model_id):
+        """Load a single model without loading the rest of its thing.
+
+        Parameters
+        ----------
+        thing_id : str
+            The key of the thing containing the model.
+        model_id : str
+            The key of the model.
+
+        Returns
+        -------
+        Model
+            The model, with a copy of its metadata.
+        """
+        thing_id = str(thing_id)
+        model_dict = copy.deepcopy(self.metadata(thing_id)['models'][model_id])
+        return Model.load(self._thing_path(thing_id), model_id, model_dict)
+
+    def update_model_metadata(self, thing_id, model_id, patch):
+        """Update the metadata of a model without loading or rewriting its mesh.
+
+        Parameters
+        ----------
+        thing_id : str
+            The key of the thing containing the model.
+        model_id : str
+            The key of the model.
+        patch : dict
+            Metadata keys and values to set on the model.
+        """
+        self.update_models_metadata({thing_id : {model_id : patch}})
+
+    @profiling.timed('dataset.update_metadata')
+    def update_models_metadata(self, patches):
+        """Update the metadata of many models without loading or rewriting their meshes.
+
+        Each affected thing's metadata file is rewritten once, atomically.
+
+        Parameters
+        ----------
+        patches : dict
+            A map from thing keys to maps from model keys to metadata patches.
+        """
+        for thing_id, model_patches in patches.items():
+            thing_id = str(thing_id)
+            with self._thing_lock(thing_id):
+                metadata = None
+                if self._batch is not None:
+                    # Buffered metadata is private to the batch, so it's patched in place
+                    metadata = self._batch['metadata'].get(thing_id)
+                elif self._multiprocess:
+                    metadata = Thing.load_metadata(self._thing_path(thing_id))
+                if metadata is None:
+                    metadata = copy.deepcopy(self.metadata(thing_id))
+                for model_id in model_patches:
+                    if model_id not in metadata['models']:
+                        raise KeyError(model_id)
+                for model_id, patch in model_patches.items():
+                    metadata['models'][model_id]['metadata'].update(patch)
+                if self._batch is not None:
+                    thing_patches = self._batch['patches'].setdefault(thing_id, {})
+                    for model_id, patch in model_patches.items():
+                        thing_patches.setdefault(model_id, {}).update(patch)
+                self._write_metadata(thing_id, metadata)
+
+    def extract(self, out_dir, selection, file_type='obj', predicate=None, as_dataset=False, workers=1):
+        """Write a selection of models out of the dataset.
+
+        Only the selected models are loaded, in a pool of worker processes.
+
+        Parameters
+        ----------
+        out_dir : str
+            The directory to write to.
+        selection : list of (str, str)
+            The (thing_id, model_id) pairs of the models to extract, e.g. from query().
+        file_type : str
+            The mesh format to write, as understood by trimesh. With
+            ``as_dataset``, it must be one of MESH_FILE_TYPES; the binary
+            ``ply``, ``stl`` and ``glb`` formats are much faster than ``obj``.
+        predicate : callable
+            A function that takes a loaded Model and returns False if the model
+            should be skipped, for filtering on geometry. It must be picklable,
+            i.e. defined at the top level of a module.
+        as_dataset : bool
+            If True, the models are written as a new dataset in out_dir with
+            their source geometry and filtered metadata. Otherwise, each model's
+            transformed mesh is written directly to out_dir.
+        workers : int
+            The number of processes to load and write models with.
+
+        Returns
+        -------
+        dict
+            The number of models ``written`` and ``skipped``, the number of
+            ``bytes`` written and the elapsed ``seconds``.
+
+        Raises
+        ------
+        ValueError
+            If ``as_dataset`` is True and the file type isn't supported.
+        """
+        if as_dataset and file_type not in MESH_FILE_TYPES:
+            raise ValueError('Unsupported mesh file type {}; use one of {}.'.format(file_type, MESH_FILE_TYPES))
+        dsnew = None
+        if as_dataset:
+            dsnew = ThingiverseDataset(out_dir)
+        makedirs(out_dir)
+
+        jobs = []
+        for thing_id, model_id in selection:
+            thing_id = str(thing_id)
+            model_dict = self.metadata(thing_id)['models'][model_id]
+            basename = '{}.{}'.format(model_id, file_type)
+            if as_dataset:
+                out = os.path.join(dsnew._make_thing_dir(thing_id), basename)
+            else:
+                out = os.path.join(out_dir, basename)
+            jobs.append({
+                'thingpath' : self._thing_path(thing_id),
+                'thing_id' : thing_id,
+                'model_id' : model_id,
+                'model_dict' : model_dict,
+                'out' : out,
+                'file_type' : file_type,
+                'source' : as_dataset,
+                'predicate' : predicate,
+            })
+
+        start = time.time()
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_extract_model, jobs)
+        else:
+            results = (_extract_model(job) for job in jobs)
+
+        n_bytes = 0
+        written = {}
+        for i, (job, size) in enumerate(zip(jobs, results)):
+            if size is not None:
+                n_bytes += size
+                written.setdefault(job['thing_id'], []).append(job['model_id'])
+            elapsed = max(time.time() - start, 1e-6)
+            logging.log(31, '{}/{} models extracted ({:.1f} models/s, {:.2f} MB/s)'.format(
+                i + 1, len(jobs), (i + 1) / elapsed, n_bytes / elapsed / 1e6
+            ))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        # Write filtered metadata for the new dataset
+        if as_dataset:
+            for thing_id, model_ids in written.items():
+                metadata = copy.deepcopy(self.metadata(thing_id))
+                metadata['models'] = dict((mid, metadata['models'][mid]) for mid in model_ids)
+                for model_id in model_ids:
+                    metadata['models'][model_id]['mesh'] = '{}.{}'.format(model_id, file_type)
+                    metadata['models'][model_id]['metadata'].pop(MESH_HASH_KEY, None)
+                    metadata['models'][model_id]['metadata'].pop(EXPORT_HASH_KEY, None)
+                write_json(metadata, os.path.join(dsnew._thing_path(thing_id), 'metadata.json'))
+            for thing_id in set(job['thing_id'] for job in jobs) - set(written):
+                thingdir = dsnew._thing_path(thing_id)
+                if len(os.listdir(thingdir)) == 0:
+                    os.rmdir(thingdir)
+
+        n_written = sum(len(v) for v in written.values())
+        return {
+            'written' : n_written,
+            'skipped' : len(jobs) - n_written,
+            'bytes' : n_bytes,
+            'seconds' : time.time() - start,
+        }
+
+    def materialize_subset(self, dest, selection, layout=None):
+        """Create a new dataset containing a subset of this one's models.
+
+        Mesh files are hard-linked into the new dataset rather than rewritten,
+        falling back to a copy when linking isn't possible (e.g. across
+        filesystems). Only the filtered metadata files are written.
+
+        Parameters
+        ----------
+        dest : str
+            The directory for the new dataset.
+        selection : list of (str, str) or dict
+            The (thing_id, model_id) pairs of the models to include, or a map
+            from thing ids to lists of model ids as from search_by_metadata().
+        layout : dict
+            The directory layout of the new dataset. If None, it is flat.
+
+        Returns
+        -------
+        ThingiverseDataset
+            The new dataset.
+        """
+        if isinstance(selection, dict):
+            selection = [(t, m) for t in selection for m in selection[t]]
+        model_ids = {}
+        for thing_id, model_id in selection:
+            model_ids.setdefault(str(thing_id), []).append(model_id)
+        dsnew = ThingiverseDataset(dest, layout=layout)
+
+        for thing_id in model_ids:
+            metadata = copy.deepcopy(self.metadata(thing_id))
+            metadata['models'] = dict((mid, metadata['models'][mid]) for mid in model_ids[thing_id])
+
+            thingdir = dsnew._make_thing_dir(thing_id)
+            for model_id in model_ids[thing_id]:
+                src = self.model_filename(thing_id, model_id)
+                dst = os.path.join(thingdir, metadata['models'][model_id]['mesh'])
+                if os.path.exists(dst):
+                    os.remove(dst)
+                try:
+                    os.link(src, dst)
+                except (OSError, AttributeError):
+                    copy_file(src, dst)
+            write_json(metadata, os.path.join(thingdir, 'metadata.json'))
+
+        dsnew.refresh()
+        return dsnew
+
+    @profiling.timed('search.metadata')
     def search_by_metadata(self, key, value):
         """Return tuples of (thing_id, model_id) for all models that have a particular
         metadata key/value pair.
+
+        Returns
+        -------
+        dict
+            A map from the keys of matching things to lists of their matching model keys.
         """
         matches = {}
-        for thing_id in self.keys:
-            thing_metadata = self._thing_metadata[thing_id]
-            model_ids = []
-            for model_id in thing_metadata['models']:
-                model_metadata = thing_metadata['models'][model_id]['metadata']
-                if key in model_metadata and model_metadata[key] == value:
-                    model_ids.append(model_id)
-            if len(model_ids) > 0:
-                matches[thing_id] = model_ids
+        for thing_id, model_id in self.query(metadata={key : value}):
+            matches.setdefault(thing_id, []).append(model_id)
         return matches
 
+    @profiling.timed('search.keyword')
     def search_by_keyword(self, keyword):
         """Return the keys of all things which match a keyword.
 
@@ -105,23 +724,18 @@ class ThingiverseDataset(object):
         list of str
             The keys of the matching things.
         """
-        matching_keys = []
-        for thing_id in self.keys:
-            thing_metadata = self._thing_metadata[thing_id]
-            if re.search(keyword.lower(), thing_metadata['name'], re.IGNORECASE):
-                matching_keys.append(thing_id)
-                continue
+        return sorted(self._queries.keyword_things(keyword))
 
-            for model_id in thing_metadata['models']:
-                model_metadata = thing_metadata['models'][model_id]
-                if re.search(keyword.lower(), model_metadata['name'], re.IGNORECASE):
-                    matching_keys.append(thing_id)
-                    break
-        return matching_keys
-
-    def save(self, thing, only_metadata=False, model_keys=None):
+    @profiling.timed('dataset.save')
+    def save(self, thing, only_metadata=False, model_keys=None, file_type=None, workers=1, force=False):
         """Save a modified Thing out to the database.
 
+        A model's mesh file is only rewritten if its source geometry differs
+        from that in the file, as recorded by the ``export_hash`` and
+        ``mesh_hash`` in its saved metadata, so saving a thing after changing
+        one model, or only transforms and metadata, writes just the metadata
+        and the changed meshes.
+
         Parameters
         ----------
         thing : Thing
@@ -130,12 +744,599 @@ class ThingiverseDataset(object):
             If True, only the metadata is written (not the mesh filenames).
         model_keys : list of str
             The keys of the models to save. If None, all models are saved.
+        file_type : str
+            The mesh format, one of MESH_FILE_TYPES. If None, each model keeps
+            the format it was loaded from, or ``obj`` if it's new.
+        workers : int
+            The number of threads to write meshes with.
+        force : bool
+            If True, every mesh file is rewritten, even if it's unchanged.
+
+        A model saved in a new format has its file in the old format
+        removed only once the new metadata is written, which in a batch is
+        when the batch exits.
+
+        Returns
+        -------
+        list of str
+            The keys of the models whose mesh files were written.
+        """
+        with self._thing_lock(thing.id):
+            thingpath = self._make_thing_dir(thing.id)
+            written = []
+            stale = []
+            saved = None
+            if not only_metadata:
+                if self._batch is not None:
+                    saved = self._batch['metadata'].get(thing.id)
+                if saved is None and self._multiprocess:
+                    saved = Thing.load_metadata(thingpath)
+                if saved is None:
+                    saved = self._thing_metadata.get(thing.id)
+                # Other processes may have rewritten meshes since the thing was loaded
+                written, stale = thing.export_meshes(thingpath, model_keys, file_type, workers,
+                                                     skip_unchanged=not force,
+                                                     saved_models=saved['models'] if saved is not None else None,
+                                                     trust_loaded=not self._multiprocess)
+            metadata = _copy_json(thing.to_dict())
+            if saved is not None:
+                # Files the saved metadata refers to, e.g. from an earlier save in a batch
+                for model_id, model_dict in saved['models'].items():
+                    if model_id in metadata['models'] and model_dict['mesh'] != metadata['models'][model_id]['mesh']:
+                        stale.append(os.path.join(thingpath, model_dict['mesh']))
+            self._write_metadata(thing.id, metadata)
+            if self._batch is not None:
+                self._batch['saved'].add(thing.id)
+                self._batch['stale'].setdefault(thing.id, []).extend(stale)
+            else:
+                remove_stale_meshes(metadata, stale)
+            return written
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffer metadata writes until the end of a with block, then write them in bulk.
+
+        Inside the block, save(), update_model_metadata() and
+        update_models_metadata() keep each thing's new metadata in memory
+        instead of writing it. Mesh files are still written immediately, but
+        files left in a model's previous format are only removed afterwards. When
+        the block exits, even with an error, every changed thing's
+        metadata file is written once, in compact JSON, and the index is updated once::
+
+            with ds.batch():
+                for thing_id in ds.keys:
+                    ds.update_model_metadata(thing_id, ...)
+
+        metadata() returns buffered metadata, but things first saved in the
+        block only appear in keys, models and searches once it exits. Other
+        processes see none of the changes until then. In multi-process mode,
+        the patches made to each thing are replayed onto its latest metadata
+        on disk under its lock, unless the thing was saved in the block.
+        Nested batches join the outermost one.
         """
-        thingpath = os.path.join(self._root, thing.id)
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = {
+            'metadata' : {},
+            'patches' : {},
+            'saved' : set(),
+            'stale' : {},
+        }
+        try:
+            yield self
+        finally:
+            batch, self._batch = self._batch, None
+            self._flush_batch(batch)
+
+    def compute_stable_poses(self, thing_ids=None, workers=1, verify=False):
+        """Compute and cache the stable poses of every model in the dataset.
+
+        Parameters
+        ----------
+        thing_ids : list of str
+            The keys of the things to process. If None, all things are processed.
+        workers : int
+            The number of processes to compute poses with.
+        verify : bool
+            If True, things whose models all have cached poses are also loaded
+            to check that the poses match the current geometry. Otherwise, they
+            are skipped.
+
+        Returns
+        -------
+        int
+            The number of things whose cached poses were updated.
+        """
+        if thing_ids is None:
+            thing_ids = self.keys
+        thing_ids = [str(t) for t in thing_ids]
+        if not verify:
+            thing_ids = [t for t in thing_ids if any(
+                STABLE_POSES_KEY not in m['metadata'] for m in self.metadata(t)['models'].values()
+            )]
+        thingpaths = [self._thing_path(t) for t in thing_ids]
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(_compute_thing_stable_poses, thingpaths)
+        else:
+            results = (_compute_thing_stable_poses(p) for p in thingpaths)
+
+        n_updated = 0
+        for i, (thing_id, patches) in enumerate(results):
+            if len(patches) > 0:
+                self.update_models_metadata({thing_id : patches})
+                n_updated += 1
+            logging.log(31, '{}/{} things checked for stable poses.'.format(i + 1, len(thingpaths)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return n_updated
+
+    def point_cloud(self, thing_id, model_id, n, seed=0):
+        """Return points sampled from the surface of a model, using the cache.
+
+        If the points have been cached, e.g. by precompute_point_clouds(),
+        they are memory-mapped without loading the model's mesh. Otherwise
+        they are sampled and cached.
+
+        Parameters
+        ----------
+        thing_id : str
+            The key of the thing containing the model.
+        model_id : str
+            The key of the model.
+        n : int
+            The number of points.
+        seed : int
+            The random seed for sampling.
+
+        Returns
+        -------
+        (n,3) float32
+            A read-only array of the points.
+        """
+        thing_id = str(thing_id)
+        geometry_hash = self._geometry_hash(thing_id, model_id)
+        if geometry_hash is not None:
+            points = self._cache.load('points', _point_cloud_name(geometry_hash, n, seed))
+            if points is not None:
+                return points
+
+        model = self.load_model(thing_id, model_id)
+        name = _point_cloud_name(geometry_hash or model.geometry_hash, n, seed)
+        points = self._cache.load('points', name)
+        if points is None:
+            self._cache.save('points', name, model.sample_points(n, seed))
+            points = self._cache.load('points', name)
+        return points
+
+    def precompute_point_clouds(self, n, seed=0, workers=1):
+        """Sample and cache a point cloud for every model in the dataset.
+
+        Models whose point clouds are already cached are skipped.
+
+        Parameters
+        ----------
+        n : int
+            The number of points per model.
+        seed : int
+            The random seed for sampling.
+        workers : int
+            The number of processes to sample points with.
+
+        Returns
+        -------
+        int
+            The number of point clouds computed.
+        """
+        jobs = []
+        for thing_id in sorted(self.keys):
+            for model_id, model_dict in self.metadata(thing_id)['models'].items():
+                geometry_hash = self._geometry_hash(thing_id, model_id)
+                if geometry_hash is not None and self._cache.has('points', _point_cloud_name(geometry_hash, n, seed)):
+                    continue
+                jobs.append({
+                    'thing_id' : thing_id,
+                    'thingpath' : self._thing_path(thing_id),
+                    'model_id' : model_id,
+                    'model_dict' : model_dict,
+                    'geometry_hash' : geometry_hash,
+                    'n' : n,
+                    'seed' : seed,
+                    'cache_dir' : self._cache.root,
+                })
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_sample_model_points, jobs)
+        else:
+            results = (_sample_model_points(job) for job in jobs)
+
+        patches = {}
+        for i, (job, mesh_hash) in enumerate(zip(jobs, results)):
+            if job['geometry_hash'] is None:
+                patches.setdefault(job['thing_id'], {})[job['model_id']] = {MESH_HASH_KEY : mesh_hash}
+            if (i + 1) % 1000 == 0:
+                logging.log(31, '{}/{} point clouds sampled.'.format(i + 1, len(jobs)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self.update_models_metadata(patches)
+        return len(jobs)
+
+    def voxel_grid(self, thing_id, model_id, resolution, kind='occupancy'):
+        """Return an occupancy or signed distance grid for a model, using the cache.
+
+        If the grid has been cached, e.g. by precompute_voxel_grids(), it is
+        loaded without loading the model's mesh. Otherwise it is computed and
+        cached. See Model.voxelize() and Model.signed_distance_field().
+
+        Parameters
+        ----------
+        thing_id : str
+            The key of the thing containing the model.
+        model_id : str
+            The key of the model.
+        resolution : int
+            The number of voxels along each edge of the grid.
+        kind : str
+            ``occupancy`` for a boolean occupancy grid, or ``sdf`` for a
+            float32 grid of signed distances (positive inside the model).
+
+        Returns
+        -------
+        grid : (resolution,resolution,resolution) bool or float32
+            The grid. SDF grids are read-only memory maps.
+        origin : (3,) float
+            The center of voxel (0,0,0).
+        pitch : float
+            The edge length of a voxel.
+        """
+        if kind not in VOXEL_GRID_KINDS:
+            raise ValueError('{} is an invalid voxel grid kind.'.format(kind))
+        thing_id = str(thing_id)
+        geometry_hash = self._geometry_hash(thing_id, model_id)
+        if geometry_hash is None or not self._cache.has(kind, _voxel_grid_name(geometry_hash, resolution)):
+            model = self.load_model(thing_id, model_id)
+            geometry_hash = geometry_hash or model.geometry_hash
+            _cache_voxel_grids(model, [resolution], [kind], self._cache, geometry_hash)
+
+        name = _voxel_grid_name(geometry_hash, resolution)
+        grid = self._cache.load(kind, name)
+        info = self._cache.load_info(kind, name)
+        shape = tuple(info['shape'])
+        if kind == 'occupancy':
+            grid = np.unpackbits(grid)[:np.prod(shape)].astype(bool)
+        return grid.reshape(shape), np.array(info['origin']), info['pitch']
+
+    def precompute_voxel_grids(self, resolutions, kinds=('occupancy',), workers=1):
+        """Compute and cache voxel grids for every model in the dataset.
+
+        Models whose grids are already cached are skipped.
+
+        Parameters
+        ----------
+        resolutions : list of int
+            The grid resolutions to compute.
+        kinds : list of str
+            The grids to compute, from ``occupancy`` and ``sdf``. Occupancy
+            grids come for free when SDF grids are computed.
+        workers : int
+            The number of processes to compute grids with.
+
+        Returns
+        -------
+        int
+            The number of models processed.
+        """
+        for kind in kinds:
+            if kind not in VOXEL_GRID_KINDS:
+                raise ValueError('{} is an invalid voxel grid kind.'.format(kind))
+        jobs = []
+        for thing_id in sorted(self.keys):
+            for model_id, model_dict in self.metadata(thing_id)['models'].items():
+                geometry_hash = self._geometry_hash(thing_id, model_id)
+                if geometry_hash is not None and all(
+                    self._cache.has(k, _voxel_grid_name(geometry_hash, r)) for k in kinds for r in resolutions
+                ):
+                    continue
+                jobs.append({
+                    'thing_id' : thing_id,
+                    'thingpath' : self._thing_path(thing_id),
+                    'model_id' : model_id,
+                    'model_dict' : model_dict,
+                    'geometry_hash' : geometry_hash,
+                    'resolutions' : list(resolutions),
+                    'kinds' : list(kinds),
+                    'cache_dir' : self._cache.root,
+                })
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(_voxelize_model, jobs)
+        else:
+            results = (_voxelize_model(job) for job in jobs)
+
+        patches = {}
+        for i, (job, mesh_hash) in enumerate(zip(jobs, results)):
+            if job['geometry_hash'] is None:
+                patches.setdefault(job['thing_id'], {})[job['model_id']] = {MESH_HASH_KEY : mesh_hash}
+            logging.log(31, '{}/{} models voxelized.'.format(i + 1, len(jobs)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self.update_models_metadata(patches)
+        return len(jobs)
+
+    def _geometry_hash(self, thing_id, model_id):
+        """Return a model's geometry hash from its metadata, or None if it isn't recorded.
+
+        Either the hash of the geometry read from the model's mesh file or
+        that of the geometry written to it identifies the file's contents,
+        so cache entries are named by whichever is recorded.
+        """
+        model_metadata = self.metadata(thing_id)['models'][model_id]['metadata']
+        mesh_hash = model_metadata.get(MESH_HASH_KEY, model_metadata.get(EXPORT_HASH_KEY))
+        if mesh_hash is None:
+            return None
+        return transformed_hash(mesh_hash, model_metadata.get(TRANSFORM_KEY, np.eye(4)))
+
+    def _write_metadata(self, thing_id, metadata):
+        """Write a thing's metadata file and update the in-memory index, or buffer it in a batch.
+        """
+        if self._batch is not None:
+            self._batch['metadata'][thing_id] = metadata
+            return
+        write_json(metadata, os.path.join(self._thing_path(thing_id), 'metadata.json'))
+        self._set_metadata(thing_id, metadata)
+
+    @profiling.timed('dataset.flush_batch')
+    def _flush_batch(self, batch):
+        """Write the metadata buffered by a batch and update the in-memory index.
+
+        Things are written in chunks, holding the locks of every thing in a
+        chunk, and the index is updated after each chunk, so it matches the
+        disk even if a later chunk fails. If a chunk fails part way, its
+        things are re-read from disk.
+        """
+        items = sorted(batch['metadata'].items())
+        for start in range(0, len(items), _FLUSH_CHUNK):
+            chunk = items[start:start + _FLUSH_CHUNK]
+            flushed = {}
+            written = False
+            locks = []
+            try:
+                for thing_id, _ in chunk:
+                    lock = self._thing_lock(thing_id)
+                    lock.acquire()
+                    locks.append(lock)
+                writes = []
+                for thing_id, metadata in chunk:
+                    if self._multiprocess and thing_id not in batch['saved']:
+                        latest = Thing.load_metadata(self._thing_path(thing_id))
+                        if latest is not None:
+                            for model_id, patch in batch['patches'].get(thing_id, {}).items():
+                                latest['models'][model_id]['metadata'].update(patch)
+                            metadata = latest
+                    flushed[thing_id] = metadata
+                    writes.append((metadata, os.path.join(self._thing_path(thing_id), 'metadata.json')))
+                write_json_many(writes)
+                written = True
+                for thing_id, _ in chunk:
+                    remove_stale_meshes(flushed[thing_id], batch['stale'].get(thing_id, []))
+            finally:
+                for lock in locks:
+                    lock.release()
+                if not written:
+                    flushed = {}
+                    for thing_id, _ in chunk:
+                        metadata = Thing.load_metadata(self._thing_path(thing_id))
+                        if metadata is not None:
+                            flushed[thing_id] = metadata
+                self._set_metadata_many(flushed)
+
+    def _set_metadata(self, thing_id, metadata):
+        """Update the in-memory indexes for a thing's new metadata.
+        """
+        self._set_metadata_many({thing_id : metadata})
+
+    def _set_metadata_many(self, thing_metadata):
+        """Update the in-memory indexes for many things' new metadata at once.
+
+        Parameters
+        ----------
+        thing_metadata : dict
+            A map from thing keys to their new metadata.
+        """
+        models_changed = False
+        for thing_id, metadata in thing_metadata.items():
+            old = self._thing_metadata.get(thing_id)
+            if old is None or set(old['models']) != set(metadata['models']):
+                models_changed = True
+        self._thing_metadata.update(thing_metadata)
+        if models_changed:
+            self._model_index = None
+        if self._query_index is not None:
+            for thing_id in thing_metadata:
+                self._query_index.update(thing_id)
+
+    def _thing_path(self, thing_id):
+        """Return a thing's directory.
+        """
+        return self._layout.path(thing_id)
+
+    def _make_thing_dir(self, thing_id):
+        """Create a thing's directory if needed and return it.
+        """
+        thingpath = self._thing_path(thing_id)
         if not os.path.exists(thingpath):
-            os.makedirs(thingpath)
-        thing.export(thingpath, only_metadata, model_keys)
-        self._thing_metadata[thing.id] = Thing.load_metadata(thingpath)
+            with self._index_lock():
+                makedirs(thingpath)
+        return thingpath
+
+    def _lock(self, name):
+        """Return a named dataset lock, or a null lock outside multi-process mode.
+        """
+        if not self._multiprocess:
+            return NullLock()
+        lockdir = os.path.join(self._root, '.locks')
+        makedirs(lockdir)
+        return FileLock(os.path.join(lockdir, '{}.lock'.format(name)))
+
+    def _thing_lock(self, thing_id, retrieval=False):
+        """Return the lock for writing a thing, or a null lock outside multi-process mode.
+
+        Lock files are kept beside the thing directories rather than in one
+        directory, which would grow to an entry per thing. Retrievals always
+        take the real lock, so that recover() can tell a running retrieval
+        from an interrupted one.
+        """
+        if not self._multiprocess and not retrieval:
+            return NullLock()
+        filename = self._layout.lock_path(thing_id)
+        makedirs(os.path.dirname(filename))
+        return FileLock(filename)
+
+    def _index_lock(self):
+        """Return the lock for changing the set of things in the dataset.
+        """
+        return self._lock('index')
+
+    def split(self, name, fractions=None, seed=0):
+        """Return a named, persisted train/val/test style split of the models.
+
+        The first call with a given name partitions the models and saves the
+        partition under ``splits/`` in the dataset, so that every later call,
+        in any process, gets the same models in each split, even if models
+        have since been added to the dataset.
+
+        Parameters
+        ----------
+        name : str
+            The name of the split.
+        fractions : dict
+            A map from split names to the fraction of models in each. Only
+            needed when the split is first created.
+        seed : int
+            The seed for the partition when it is first created.
+
+        Returns
+        -------
+        dict
+            A map from split names to sorted arrays of indices into ``models``.
+
+        Raises
+        ------
+        KeyError
+            If the split doesn't exist and no fractions are given.
+        """
+        split_filename = os.path.join(self._root, 'splits', '{}.npz'.format(name))
+        with self._index_lock():
+            if not os.path.exists(split_filename):
+                if fractions is None:
+                    raise KeyError(name)
+                splits = self.models.split(fractions, seed)
+                arrays = {}
+                for split_name, inds in splits.items():
+                    arrays['{}/thing_ids'.format(split_name)] = self.models.thing_ids[inds]
+                    arrays['{}/model_ids'.format(split_name)] = self.models.model_ids[inds]
+                makedirs(os.path.dirname(split_filename))
+                save_arrays(arrays, split_filename)
+                return splits
+
+        splits = {}
+        with np.load(split_filename) as saved:
+            for key in saved.files:
+                split_name, field = key.rsplit('/', 1)
+                if field == 'thing_ids':
+                    splits[split_name] = self.models.positions(saved[key], saved['{}/model_ids'.format(split_name)])
+        return splits
+
+    def export_shards(self, out_dir, max_things=1000, max_bytes=1 << 30, compress=False, workers=1):
+        """Pack the dataset into shard files for fast sequential reads.
+
+        Read the result with thingset.ShardArchive. Vertices are stored as
+        float32; see thingset.archive.encode_record(). Once every shard is
+        written, the archive's manifest is replaced to list only the new
+        shards, and shard files from an earlier export are removed.
+
+        Parameters
+        ----------
+        out_dir : str
+            The directory to write shard files to.
+        max_things : int
+            The maximum number of things in each shard.
+        max_bytes : int
+            The size at which a shard is closed and a new one started.
+        compress : bool
+            If True, each thing's record is zlib-compressed.
+        workers : int
+            The number of processes to load and encode things with.
+
+        Returns
+        -------
+        int
+            The number of shards written.
+        """
+        makedirs(out_dir)
+        thingpaths = [self._thing_path(t) for t in sorted(self.keys)]
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            records = pool.imap(_encode_thing, thingpaths)
+        else:
+            records = (_encode_thing(p) for p in thingpaths)
+
+        writer = None
+        n_shards = 0
+        for i, (thing_id, record) in enumerate(records):
+            if writer is not None and (len(writer) >= max_things or writer.nbytes >= max_bytes):
+                writer.close()
+                writer = None
+            if writer is None:
+                writer = ShardWriter(os.path.join(out_dir, 'shard-{:05d}.shard'.format(n_shards)), compress)
+                n_shards += 1
+            writer.write(thing_id, record)
+            if (i + 1) % 1000 == 0:
+                logging.log(31, '{}/{} things packed.'.format(i + 1, len(thingpaths)))
+        if writer is not None:
+            writer.close()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        shards = ['shard-{:05d}.shard'.format(i) for i in range(n_shards)]
+        write_json({'shards' : shards}, os.path.join(out_dir, MANIFEST_FILENAME))
+        for fn in os.listdir(out_dir):
+            if fn.endswith('.shard') and fn not in shards:
+                os.remove(os.path.join(out_dir, fn))
+        return n_shards
+
+    def stats(self):
+        """Return timing statistics for dataset operations in this process.
+
+        Operations are only timed while an Aggregator is enabled in
+        thingset.profiling, e.g. by setting the THINGSET_PROFILE environment
+        variable.
+
+        Returns
+        -------
+        dict
+            A map from operation names (e.g. ``mesh.parse``, ``search.keyword``)
+            to their ``count``, ``total``, ``mean``, ``p50``, ``p90``, ``p99``
+            and ``max`` durations in seconds.
+        """
+        return profiling.stats()
 
     def vis(self, key):
         """Show all the models for a given Thing.
@@ -145,12 +1346,14 @@ class ThingiverseDataset(object):
         key : str
             The key for the target Thing.
         """
+        from visualization import Visualizer3D as vis
         for model in self[key].models:
             vis.figure()
             vis.mesh(model.mesh, style='surface')
             vis.show()
 
-    def retrieve_from_thingiverse(self, n, cache_dir, params=None, thing_ids=None):
+    def retrieve_from_thingiverse(self, n, cache_dir, params=None, thing_ids=None,
+                                  workers=1, delay=0.5, base_url=THINGIVERSE_URL):
         """Retrieve things from Thingiverse and save them to the dataset.
 
         Parameters
@@ -161,31 +1364,27 @@ class ThingiverseDataset(object):
             A cache directory for temporary mesh conversions
         params : dict
             A set of parameters, including 'category', 'license', and 'query'. Optional.
+        thing_ids : list of str
+            The ids of the things to retrieve. If given, no search is done.
+        workers : int
+            The number of things to retrieve at once, in separate threads.
+        delay : float
+            The number of seconds each thread waits before each request for a
+            search page or thing, to avoid overloading the site.
+        base_url : str
+            The root URL of the site to retrieve from, e.g. a local stand-in for testing.
+
+        Returns
+        -------
+        int
+            The number of things saved.
         """
 
         all_thing_ids = []
         if thing_ids is not None:
             all_thing_ids = thing_ids
         else:
-            baseurl = 'http://www.thingiverse.com/search/page:{}?type=things'
-
-            if params is None:
-                baseurl = 'http://www.thingiverse.com/explore/newest/page:{}'
-            else:
-                if 'category' in params:
-                    if params['category'] not in CATEGORY_IDS:
-                        raise ValueError('{} is an invalid category.'.format(params['category']))
-                    category_id = CATEGORY_IDS[params['category']]
-                    baseurl = '{}&category_id={}'.format(baseurl, category_id)
-
-                if 'license' in params:
-                    if params['license'] not in LICENSE_IDS:
-                        raise ValueError('{} is an invalid license.'.format(params['license']))
-                    license_id = LICENSE_IDS[params['license']]
-                    baseurl = '{}&license={}'.format(baseurl, license_id)
-
-                if 'query' in params and params['query'] != '':
-                    baseurl = '{}&q={}'.format(baseurl, urllib.quote(params['query']))
+            baseurl = search_url(params, base_url)
 
             logging.log(31, 'Retrieving up to {} items from Thingiverse with parameters:'.format(n))
             logging.log(31, '\t{}'.format(json.dumps(params, indent=4)))
@@ -193,66 +1392,250 @@ class ThingiverseDataset(object):
             # Iterate through available pages
             page = 1
             prev_path = ''
-            num_imports = 0
 
             while True:
                 # Load search page
                 url = baseurl.format(page)
                 page += 1
-
-                # Prevent DDOS
-                time.sleep(0.5)
-
-                r = requests.get(url)
-
-                logging.log(31, 'Retrieving page {}...'.format(page - 1))
-
-                if r.status_code != 200:
-                    logging.log(32, 'Page {} retrieval failed.')
-                    logging.log(32, '\tQuery URL: {}'.format(url))
-                    logging.log(32, '\tStatus Code: {}'.format(r.status_code))
+                result = self._fetch_search_page(url, delay)
+                if result is None:
                     continue
 
                 # If prev url is same as new one, stop
-                path = urlparse.urlparse(r.url).path
+                thing_ids, path = result
                 if prev_path == path:
                     break
                 prev_path = path
 
-                # Extract thing IDs
-                root = html.fromstring(r.text)
-                thing_ids = [x.get('data-id') for x in root.find_class('thing')]
                 logging.log(31, '{} things retrieved on page {}.'.format(len(thing_ids), page - 1))
                 if len(thing_ids) == 0:
                     break
                 all_thing_ids.extend(thing_ids)
 
-        # Retrieve and save things
-        num_imports = 0
+        # Search listings shift between pages, so the same thing can be listed twice
+        unique_ids = []
+        seen = set()
         for thing_id in all_thing_ids:
-            if thing_id in self.keys:
-                continue
+            thing_id = str(thing_id)
+            if thing_id not in seen:
+                seen.add(thing_id)
+                unique_ids.append(thing_id)
+        all_thing_ids = unique_ids
 
-            # Retrieve the thing
-            time.sleep(0.5)
-            t = Thing.retrieve(thing_id, cache_dir)
-            if t is None:
-                continue
+        # Retrieve and save things. A thread only starts on a thing while the
+        # things already saved or in progress number fewer than n, so that no
+        # more than n are saved.
+        # Each id is claimed before it's retrieved, since the thing locks only
+        # exclude other processes, and two threads would share a staging directory.
+        counts = {'started' : 0, 'saved' : 0}
+        claimed = set()
+        cond = threading.Condition()
+
+        def retrieve(thing_id):
+            with cond:
+                while counts['started'] >= n and counts['saved'] < n:
+                    cond.wait()
+                if counts['saved'] >= n or thing_id in claimed:
+                    return
+                claimed.add(thing_id)
+                counts['started'] += 1
+            saved = False
+            try:
+                saved = self._retrieve_thing(thing_id, cache_dir, delay, base_url)
+            finally:
+                with cond:
+                    if saved:
+                        counts['saved'] += 1
+                        logging.log(31, '{}/{} things retrieved.'.format(counts['saved'], n))
+                    else:
+                        counts['started'] -= 1
+                    cond.notify_all()
 
-            # Export the thing, then lazy-load a copy to reduce memory usage.
-            thingdir = os.path.join(self._root, t.id)
-            if not os.path.exists(thingdir):
-                os.makedirs(thingdir)
-            t.export(thingdir)
-            self._thing_metadata[thing_id] = Thing.load_metadata(thingdir)
+        if workers > 1:
+            pool = ThreadPool(workers)
+            pool.map(retrieve, all_thing_ids, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            for thing_id in all_thing_ids:
+                retrieve(thing_id)
+                if counts['saved'] >= n:
+                    break
+        return counts['saved']
+
+    def crawl(self, queue, cache_dir, workers=1, delay=0.5, base_url=THINGIVERSE_URL, owner=None, poll=5.0,
+              max_task_seconds=3600.0):
+        """Work on a shared crawl queue until it has no pending or leased tasks left.
+
+        Several processes, possibly on different machines, can crawl the same
+        queue into the same dataset at once. The dataset should then be
+        opened with ``multiprocess=True``. Each search page's things, and the
+        search's next page, are added to the queue; each thing is retrieved
+        and saved unless it's already in the dataset. Tasks that raise,
+        including things whose page or files couldn't be retrieved or parsed,
+        are retried by the queue; a thing is only marked done once it's saved,
+        found in the dataset, or found to have no valid models.
+
+        Parameters
+        ----------
+        queue : CrawlQueue
+            The queue, e.g. ``CrawlQueue(os.path.join(root, 'crawl.sqlite'))``.
+        cache_dir : str
+            A cache directory for temporary mesh conversions.
+        workers : int
+            The number of tasks to work on at once, in separate threads.
+        delay : float
+            The number of seconds each thread waits before each request.
+        base_url : str
+            The root URL of the site to retrieve from, e.g. a local stand-in for testing.
+        owner : str
+            A name for this process in the queue. Defaults to the host name and process id.
+        poll : float
+            The number of seconds to wait for other workers to add tasks when none are pending.
+        max_task_seconds : float
+            The longest a task's lease is renewed for. A task still running
+            after this is handed to another worker once its lease expires.
+
+        Returns
+        -------
+        int
+            The number of things this process saved.
+        """
+        if owner is None:
+            owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        saved = [0]
+        lock = threading.Lock()
+
+        def work(i):
+            worker = '{}:{}'.format(owner, i)
+            while True:
+                task = queue.lease(worker)
+                if task is None:
+                    if queue.active() == 0:
+                        return
+                    time.sleep(poll)
+                    continue
+                try:
+                    with Heartbeat(queue, task, worker, max_task_seconds):
+                        if task.kind == PAGE:
+                            self._crawl_page(queue, task, delay)
+                        elif self._retrieve_thing(task.key, cache_dir, delay, base_url, raise_on_error=True):
+                            with lock:
+                                saved[0] += 1
+                except Exception as e:
+                    logging.log(32, 'Crawl task {} {} failed (attempt {}): {}'.format(task.kind, task.key,
+                                                                                      task.attempts, e))
+                    queue.fail(task, worker, e)
+                    continue
+                queue.complete(task, worker)
 
-            num_imports += 1
+        if workers > 1:
+            pool = ThreadPool(workers)
+            pool.map(work, range(workers), chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            work(0)
+        logging.log(31, 'Crawl finished; {} things saved by this process. Queue: {}'.format(
+            saved[0], json.dumps(queue.counts(), sort_keys=True)))
+        return saved[0]
+
+    def _crawl_page(self, queue, task, delay):
+        """Queue the things on a search page and, unless it was the last, the next page of its stride.
+
+        Raises
+        ------
+        IOError
+            If the page couldn't be retrieved or parsed, so that it's retried.
+        """
+        result = self._fetch_search_page(task.key, delay)
+        if result is None:
+            raise IOError('Search page {} could not be retrieved.'.format(task.key))
+        thing_ids, path = result
+        payload = task.payload
+        # Past the last page, the site redirects to an earlier one
+        if len(thing_ids) == 0 or path != urlparse.urlparse(task.key).path:
+            return
+        n_added = queue.add_things(thing_ids)
+        logging.log(31, '{} things on page {}, {} new.'.format(len(thing_ids), payload['page'], n_added))
+        next_page = payload['page'] + payload['strides']
+        if payload['max_pages'] is None or next_page <= payload['max_pages']:
+            queue.add_page(payload['template'], next_page, payload['strides'], payload['max_pages'])
+
+    def _fetch_search_page(self, url, delay):
+        """Retrieve a search page and extract its thing ids.
+
+        Returns
+        -------
+        (list of str, str)
+            The thing ids on the page and the path of the URL that was finally
+            retrieved, after any redirects, or None if the page couldn't be
+            retrieved or parsed.
+        """
+        # Prevent DDOS
+        time.sleep(delay)
+
+        r = http_get(url)
+
+        logging.log(31, 'Retrieving {}...'.format(url))
+
+        if r.status_code != 200:
+            logging.log(32, 'Page retrieval failed.')
+            logging.log(32, '\tQuery URL: {}'.format(url))
+            logging.log(32, '\tStatus Code: {}'.format(r.status_code))
+            return None
+
+        # Extract thing IDs
+        try:
+            with profiling.span('page.parse'):
+                thing_ids = parse_search_page(r.text)
+        except PageParseError as e:
+            logging.log(32, 'Page could not be parsed: {}'.format(e))
+            logging.log(32, '\tQuery URL: {}'.format(url))
+            return None
+        return thing_ids, urlparse.urlparse(r.url).path
+
+    @profiling.timed('dataset.retrieve_thing')
+    def _retrieve_thing(self, thing_id, cache_dir, delay, base_url, raise_on_error=False):
+        """Retrieve a single thing and save it, unless it's already in the dataset.
+
+        Parameters are as for Thing.retrieve_to(); with raise_on_error set,
+        failed requests and unparseable pages raise rather than return False.
+
+        Returns
+        -------
+        bool
+            True if the thing was saved.
+        """
+        if thing_id in self._thing_metadata:
+            return False
 
-            logging.log(31, '{}/{} things retrieved.'.format(num_imports, n))
+        # Skip things that another process is retrieving or has retrieved
+        lock = self._thing_lock(thing_id, retrieval=True)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            metadata = Thing.load_metadata(self._thing_path(thing_id))
+            if metadata is not None:
+                self._set_metadata(thing_id, metadata)
+                return False
 
-            if num_imports >= n:
-                return num_imports
+            # Stream the thing's models into its directory, keeping only metadata in memory
+            thingpath = self._thing_path(thing_id)
+            if not os.path.exists(os.path.dirname(thingpath)):
+                with self._index_lock():
+                    makedirs(os.path.dirname(thingpath))
+            time.sleep(delay)
+            metadata = Thing.retrieve_to(thing_id, thingpath, cache_dir, base_url=base_url,
+                                         raise_on_error=raise_on_error)
+            if metadata is None:
+                return False
+            self._set_metadata(thing_id, _copy_json(metadata))
+        finally:
+            lock.release()
+        return True
 
+    @profiling.timed('dataset.getitem')
     def __getitem__(self, key):
         """Load a thing, including its objects.
 
@@ -264,5 +1647,4 @@ class ThingiverseDataset(object):
         key = str(key)
         if key not in self._thing_metadata:
             raise KeyError(key)
-        thingpath = os.path.join(self._root, key)
-        return Thing.load(thingpath)
+        return Thing.load(self._thing_path(key))
@@ -0,0 +1,120 @@
+"""A flat, integer-indexed view of every model in a dataset.
+"""
+import numpy as np
+
+_SEP = u'\x01'
+
+class ModelIndex(object):
+    """Every (thing_id, model_id) pair in a dataset, in a fixed sorted order.
+
+    Pairs are held in compact NumPy string arrays, so indexing, shuffling and
+    splitting are cheap even for millions of models.
+    """
+
+    def __init__(self, pairs):
+        """Create an index.
+
+        Parameters
+        ----------
+        pairs : iterable of (str, str)
+            The (thing_id, model_id) pairs to index, in any order.
+        """
+        keys = sorted(u'{}{}{}'.format(t, _SEP, m) for t, m in pairs)
+        split = [k.split(_SEP) for k in keys]
+        self._keys = np.array(keys, dtype='U')
+        self._thing_ids = np.array([s[0] for s in split], dtype='U')
+        self._model_ids = np.array([s[1] for s in split], dtype='U')
+
+    @staticmethod
+    def from_metadata(thing_metadata):
+        """Build an index from a map of thing ids to thing metadata.
+        """
+        return ModelIndex((t, m) for t in thing_metadata for m in thing_metadata[t]['models'])
+
+    @property
+    def thing_ids(self):
+        """(n,) str : The thing id of each model.
+        """
+        return self._thing_ids
+
+    @property
+    def model_ids(self):
+        """(n,) str : The id of each model.
+        """
+        return self._model_ids
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, i):
+        """Return the (thing_id, model_id) pair at an index.
+        """
+        return str(self._thing_ids[i]), str(self._model_ids[i])
+
+    def positions(self, thing_ids, model_ids):
+        """Find the indices of a set of models.
+
+        Parameters
+        ----------
+        thing_ids : (n,) str
+            The thing id of each model.
+        model_ids : (n,) str
+            The id of each model.
+
+        Returns
+        -------
+        (m,) int
+            The sorted indices of the models that are in the index. Models that
+            are not in the index are dropped.
+        """
+        if len(thing_ids) == 0 or len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        keys = np.char.add(np.char.add(np.asarray(thing_ids, dtype='U'), _SEP),
+                           np.asarray(model_ids, dtype='U'))
+        pos = np.searchsorted(self._keys, keys)
+        pos = np.minimum(pos, len(self) - 1)
+        return np.sort(pos[self._keys[pos] == keys]).astype(np.int64)
+
+    def shuffle(self, seed, epoch=0):
+        """Return a reproducible permutation of the index.
+
+        Parameters
+        ----------
+        seed : int
+            The base seed.
+        epoch : int
+            The epoch, so that each epoch gets a different permutation.
+
+        Returns
+        -------
+        (n,) int
+            A permutation of range(len(self)).
+        """
+        return np.random.RandomState([seed, epoch]).permutation(len(self))
+
+    def split(self, fractions, seed):
+        """Randomly partition the index.
+
+        Parameters
+        ----------
+        fractions : dict
+            A map from split names (e.g. ``train``, ``val``, ``test``) to the
+            fraction of models in each. Fractions are normalized to sum to one.
+        seed : int
+            The seed for the partition.
+
+        Returns
+        -------
+        dict
+            A map from split names to sorted arrays of indices.
+        """
+        names = sorted(fractions)
+        weights = np.array([fractions[n] for n in names], dtype=np.float64)
+        bounds = np.round(np.cumsum(weights) / weights.sum() * len(self)).astype(np.int64)
+        perm = np.random.RandomState(seed).permutation(len(self))
+        splits = {}
+        start = 0
+        for name, end in zip(names, bounds):
+            splits[name] = np.sort(perm[start:end])
+            start = end
+        return splits
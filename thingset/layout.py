@@ -0,0 +1,358 @@
+"""Directory layouts mapping thing ids to directories in a dataset.
+
+A dataset's layout is recorded in ``layout.json`` in its root. While a
+dataset is being converted to a new layout, the new one is recorded in
+``layout.pending.json`` until every thing has moved, and things are looked
+for in both layouts in the meantime.
+"""
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from .storage import makedirs, write_json
+
+LAYOUT_FILENAME = 'layout.json'
+PENDING_LAYOUT_FILENAME = 'layout.pending.json'
+
+# The staging and previous directories of Thing.retrieve_to()
+_LEFTOVER_RE = re.compile(r'^\.(.+)\.(partial|old)$')
+
+def _interrupted_dirs(d):
+    """Yield the thing directories in a directory that have leftover
+    retrieval directories beside them, whether or not they exist.
+    """
+    for name in os.listdir(d):
+        m = _LEFTOVER_RE.match(name)
+        if m is not None and os.path.isdir(os.path.join(d, name)):
+            yield os.path.join(d, m.group(1))
+
+def _moving_dir(path):
+    """Return the staging directory a thing is copied into when it moves to another volume.
+    """
+    return os.path.join(os.path.dirname(path), '.{}.moving'.format(os.path.basename(path)))
+
+def _remove_lock(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+class FlatLayout(object):
+    """Every thing directory sits directly under the dataset root.
+    """
+
+    def __init__(self, root):
+        """Create a flat layout.
+
+        Parameters
+        ----------
+        root : str
+            The dataset root.
+        """
+        self._root = root
+
+    def path(self, thing_id):
+        """Return the directory for a thing.
+        """
+        return os.path.join(self._root, thing_id)
+
+    def lock_path(self, thing_id):
+        """Return the lock file for a thing, kept beside its directory so that
+        lock files are spread over the layout like the things themselves.
+        """
+        path = self.path(thing_id)
+        return os.path.join(os.path.dirname(path), '.{}.lock'.format(os.path.basename(path)))
+
+    def thing_dirs(self):
+        """Yield every candidate thing directory in the layout.
+        """
+        for name in os.listdir(self._root):
+            if name.startswith('.'):
+                continue
+            thingpath = os.path.join(self._root, name)
+            if os.path.isdir(thingpath):
+                yield thingpath
+
+    def interrupted_dirs(self):
+        """Yield the thing directories with leftovers from an interrupted retrieval.
+        """
+        for thingpath in _interrupted_dirs(self._root):
+            yield thingpath
+
+    def cleanup(self, thing_id):
+        """Remove a thing's lock file after the thing has moved away.
+        """
+        _remove_lock(self.lock_path(thing_id))
+
+    def to_dict(self):
+        return {'type' : 'flat'}
+
+
+class ShardedLayout(object):
+    """Thing directories are spread over nested shard directories named by a
+    hash of the thing id (e.g. ``ab/cd/<thing_id>``), and optionally over
+    several root volumes, so that no directory holds too many entries.
+    """
+
+    def __init__(self, root, roots=None, depth=2, width=2):
+        """Create a sharded layout.
+
+        Parameters
+        ----------
+        root : str
+            The dataset root.
+        roots : list of str
+            The volumes to spread things over. Relative paths are relative
+            to the dataset root, not the working directory, and must be
+            inside it; volumes elsewhere must be given as absolute paths.
+            Defaults to the dataset root alone.
+        depth : int
+            The number of nested shard directories.
+        width : int
+            The number of hex digits in each shard directory's name.
+
+        Raises
+        ------
+        ValueError
+            If a relative root is outside the dataset root.
+        """
+        if roots is None:
+            roots = ['.']
+        for r in roots:
+            if not os.path.isabs(r) and os.path.normpath(r).split(os.sep)[0] == os.pardir:
+                raise ValueError('Layout root {} is outside the dataset root; give it as an absolute path.'.format(r))
+        self._roots = list(roots)
+        self._paths = [os.path.normpath(os.path.join(root, r)) for r in roots]
+        self._depth = depth
+        self._width = width
+
+    def path(self, thing_id):
+        """Return the directory for a thing.
+        """
+        h = hashlib.md5(thing_id.encode('utf-8')).hexdigest()
+        root = self._paths[int(h[-8:], 16) % len(self._paths)]
+        shards = [h[i*self._width:(i+1)*self._width] for i in range(self._depth)]
+        return os.path.join(root, *(shards + [thing_id]))
+
+    def lock_path(self, thing_id):
+        """Return the lock file for a thing, kept beside its directory so that
+        lock files are spread over the layout like the things themselves.
+        """
+        path = self.path(thing_id)
+        return os.path.join(os.path.dirname(path), '.{}.lock'.format(os.path.basename(path)))
+
+    def thing_dirs(self):
+        """Yield every candidate thing directory in the layout.
+        """
+        for d in self._leaf_dirs():
+            for name in os.listdir(d):
+                if name.startswith('.'):
+                    continue
+                thingpath = os.path.join(d, name)
+                if os.path.isdir(thingpath):
+                    yield thingpath
+
+    def interrupted_dirs(self):
+        """Yield the thing directories with leftovers from an interrupted retrieval.
+        """
+        for d in self._leaf_dirs():
+            for thingpath in _interrupted_dirs(d):
+                yield thingpath
+
+    def _leaf_dirs(self):
+        """Return the innermost shard directories, which hold the thing directories.
+        """
+        leaves = []
+        for root in self._paths:
+            if not os.path.isdir(root):
+                continue
+            dirs = [root]
+            for _ in range(self._depth):
+                dirs = [os.path.join(d, name) for d in dirs for name in os.listdir(d)
+                        if len(name) == self._width and not name.startswith('.')
+                        and os.path.isdir(os.path.join(d, name))]
+            leaves.extend(dirs)
+        return leaves
+
+    def cleanup(self, thing_id):
+        """Remove a thing's lock file, and shard directories left empty, after
+        the thing has moved away.
+        """
+        _remove_lock(self.lock_path(thing_id))
+        d = os.path.dirname(self.path(thing_id))
+        for _ in range(self._depth):
+            try:
+                os.rmdir(d)
+            except OSError:
+                return
+            d = os.path.dirname(d)
+
+    def to_dict(self):
+        return {
+            'type' : 'sharded',
+            'roots' : self._roots,
+            'depth' : self._depth,
+            'width' : self._width,
+        }
+
+
+class ConvertingLayout(object):
+    """The layout of a dataset part way through a conversion, in which each
+    thing is in either the previous layout or the new one.
+
+    Things that have already moved, and new things, are in the new layout.
+    """
+
+    def __init__(self, previous, target):
+        """Create a converting layout.
+
+        Parameters
+        ----------
+        previous : FlatLayout or ShardedLayout
+            The layout being converted from.
+        target : FlatLayout or ShardedLayout
+            The layout being converted to.
+        """
+        self._previous = previous
+        self._target = target
+
+    @property
+    def target(self):
+        """FlatLayout or ShardedLayout : The layout being converted to.
+        """
+        return self._target
+
+    def path(self, thing_id):
+        """Return the directory for a thing: its directory in the previous
+        layout if it hasn't moved yet, and otherwise that in the new layout.
+        """
+        path = self._target.path(thing_id)
+        if not self._moved(thing_id):
+            previous = self._previous.path(thing_id)
+            if os.path.isdir(previous):
+                return previous
+        return path
+
+    def move(self, thing_id):
+        """Move a thing into the new layout, resuming any interrupted move.
+
+        Within a volume the thing's directory is renamed. Across volumes it's
+        copied into a hidden staging directory beside its new place, which is
+        renamed into place once complete, and the original is then removed,
+        so an interrupted move never leaves a partial copy in the new layout.
+        """
+        src = self._previous.path(thing_id)
+        dst = self._target.path(thing_id)
+        if src != dst and os.path.isdir(src):
+            if not self._moved(thing_id):
+                staging = _moving_dir(dst)
+                if os.path.exists(staging):
+                    shutil.rmtree(staging)
+                makedirs(os.path.dirname(dst))
+                try:
+                    os.rename(src, dst)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copytree(src, staging, symlinks=True)
+                    os.rename(staging, dst)
+            if os.path.isdir(src):
+                shutil.rmtree(src)
+        self._previous.cleanup(thing_id)
+
+    def _moved(self, thing_id):
+        """Return whether a thing has a complete directory in the new layout.
+        """
+        path = self._target.path(thing_id)
+        return os.path.isdir(path) and not os.path.exists(_moving_dir(path))
+
+    def lock_path(self, thing_id):
+        """Return the lock file for a thing, which is that of the new layout
+        so that it doesn't change when the thing moves.
+        """
+        return self._target.lock_path(thing_id)
+
+    def thing_dirs(self):
+        """Yield every candidate thing directory in either layout.
+        """
+        seen = set()
+        for layout in (self._target, self._previous):
+            for thingpath in layout.thing_dirs():
+                if thingpath not in seen and self.path(os.path.basename(thingpath)) == thingpath:
+                    seen.add(thingpath)
+                    yield thingpath
+
+    def interrupted_dirs(self):
+        """Yield the thing directories with leftovers from an interrupted retrieval, in either layout.
+        """
+        seen = set()
+        for layout in (self._target, self._previous):
+            for thingpath in layout.interrupted_dirs():
+                if thingpath not in seen:
+                    seen.add(thingpath)
+                    yield thingpath
+
+    def to_dict(self):
+        return dict(self._target.to_dict(), converting_from=self._previous.to_dict())
+
+
+def create_layout(root, spec=None):
+    """Create a layout from its description.
+
+    Parameters
+    ----------
+    root : str
+        The dataset root.
+    spec : dict
+        The layout's ``type`` (``flat`` or ``sharded``) and, for sharded
+        layouts, its ``roots``, ``depth`` and ``width``. Sharded layouts
+        default to a single volume at the dataset root; relative roots are
+        relative to the dataset root. If None, a flat layout is created.
+
+    Returns
+    -------
+    FlatLayout or ShardedLayout
+        The layout.
+    """
+    if spec is None or spec['type'] == 'flat':
+        return FlatLayout(root)
+    if spec['type'] == 'sharded':
+        return ShardedLayout(root, spec.get('roots'), spec.get('depth', 2), spec.get('width', 2))
+    raise ValueError('{} is an invalid layout type.'.format(spec['type']))
+
+def load_layout(root):
+    """Load a dataset's layout, which is flat if the dataset doesn't record one.
+
+    If a conversion to a new layout was started but not finished, a
+    ConvertingLayout over both layouts is returned.
+    """
+    layout = FlatLayout(root)
+    filename = os.path.join(root, LAYOUT_FILENAME)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            layout = create_layout(root, json.load(f))
+    pending = os.path.join(root, PENDING_LAYOUT_FILENAME)
+    if os.path.exists(pending):
+        with open(pending) as f:
+            layout = ConvertingLayout(layout, create_layout(root, json.load(f)))
+    return layout
+
+def begin_conversion(root, layout):
+    """Record that a dataset is being converted to a new layout.
+
+    Until save_layout() records the new layout, load_layout() returns a
+    ConvertingLayout, so things that have already moved aren't lost if the
+    conversion is interrupted.
+    """
+    write_json(layout.to_dict(), os.path.join(root, PENDING_LAYOUT_FILENAME))
+
+def save_layout(root, layout):
+    """Record a dataset's layout, finishing any conversion in progress.
+    """
+    write_json(layout.to_dict(), os.path.join(root, LAYOUT_FILENAME))
+    pending = os.path.join(root, PENDING_LAYOUT_FILENAME)
+    if os.path.exists(pending):
+        os.remove(pending)
@@ -0,0 +1,185 @@
+"""Extraction of the fields the crawler needs from Thingiverse pages.
+
+Rather than building a full document tree, the extractors search the page for
+the class and rel names they want and only parse the tags around them,
+ignoring any inside comments, scripts and styles. Missing
+fields raise PageParseError instead of failing later with an IndexError.
+"""
+import collections
+import re
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+class FileLink(collections.namedtuple('FileLink', ['file_id', 'file_name'])):
+    """A downloadable file on a thing's files page.
+
+    Attributes
+    ----------
+    file_id : str
+        The id used in the file's ``download:{id}`` URL.
+    file_name : str
+        The file's name, including its extension.
+    """
+    __slots__ = ()
+
+
+class ThingPage(collections.namedtuple('ThingPage', ['license_name', 'license_url', 'files'])):
+    """The fields of a thing's files page.
+
+    Attributes
+    ----------
+    license_name : str
+        The license's name, e.g. ``Creative Commons - Attribution``.
+    license_url : str
+        A URL linking to the license.
+    files : list of FileLink
+        The thing's downloadable files, in page order.
+    """
+    __slots__ = ()
+
+
+class PageParseError(ValueError):
+    """Raised when a page doesn't contain the expected fields, e.g. because
+    the site's markup changed.
+    """
+    pass
+
+_SKIP_START_RE = re.compile(r'<(!--|script\b|style\b)', re.IGNORECASE)
+_SKIP_END_RES = {
+    '!--' : re.compile(r'-->'),
+    'script' : re.compile(r'</script\s*>', re.IGNORECASE),
+    'style' : re.compile(r'</style\s*>', re.IGNORECASE),
+}
+_TAG_RE = re.compile(r'<([a-zA-Z][a-zA-Z0-9:-]*)\s((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+_ATTR_RES = {}
+
+def _skipped_spans(text):
+    """Return the sorted (start, end) spans of comments, scripts and styles.
+    """
+    spans = []
+    pos = 0
+    while True:
+        m = _SKIP_START_RE.search(text, pos)
+        if m is None:
+            return spans
+        end = _SKIP_END_RES[m.group(1).lower()].search(text, m.end())
+        pos = len(text) if end is None else end.end()
+        spans.append((m.start(), pos))
+
+def _start_tags(text, needles):
+    """Yield the (name, attribute text) of every start tag whose attributes contain one of some substrings.
+
+    Rather than scanning every tag, this finds each occurrence of the
+    substrings and takes the tag around it, if there is one.
+    """
+    starts = set()
+    for needle in needles:
+        pos = text.find(needle)
+        while pos != -1:
+            start = text.rfind('<', 0, pos)
+            if start != -1 and text.find('>', start, pos) == -1:
+                starts.add(start)
+            pos = text.find(needle, pos + len(needle))
+
+    skipped = _skipped_spans(text) if starts else []
+    i = 0
+    for start in sorted(starts):
+        while i < len(skipped) and skipped[i][1] <= start:
+            i += 1
+        if i < len(skipped) and skipped[i][0] <= start:
+            continue
+        m = _TAG_RE.match(text, start)
+        if m is not None:
+            yield m.group(1).lower(), m.group(2)
+
+def _attr(attr_text, name):
+    """Return the unescaped value of an attribute, or None if it's missing or empty.
+    """
+    attr_re = _ATTR_RES.get(name)
+    if attr_re is None:
+        attr_re = re.compile(r'(?:^|\s){}\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))'.format(re.escape(name)),
+                             re.IGNORECASE)
+        _ATTR_RES[name] = attr_re
+    m = attr_re.search(attr_text)
+    if m is None:
+        return None
+    value = m.group(1) or m.group(2) or m.group(3)
+    if value and '&' in value:
+        value = unescape(value)
+    return value or None
+
+def _has_token(attr_text, name, token):
+    value = _attr(attr_text, name)
+    return value is not None and token in value.lower().split()
+
+def _required(attr_text, name, what):
+    value = _attr(attr_text, name)
+    if value is None:
+        raise PageParseError('{} has no {} attribute.'.format(what, name))
+    return value
+
+def parse_search_page(text):
+    """Extract the thing ids listed on a search or explore page.
+
+    Parameters
+    ----------
+    text : str
+        The page's HTML.
+
+    Returns
+    -------
+    list of str
+        The ids of the listed things, in page order. Empty past the last page.
+
+    Raises
+    ------
+    PageParseError
+        If an element of class ``thing`` has no ``data-id``.
+    """
+    thing_ids = []
+    for tag, attr_text in _start_tags(text, ('thing',)):
+        if _has_token(attr_text, 'class', 'thing'):
+            thing_ids.append(_required(attr_text, 'data-id', 'A thing listing'))
+    return thing_ids
+
+def parse_thing_page(text):
+    """Extract the license and downloadable files from a thing's files page.
+
+    Parameters
+    ----------
+    text : str
+        The page's HTML.
+
+    Returns
+    -------
+    ThingPage
+        The extracted fields.
+
+    Raises
+    ------
+    PageParseError
+        If the page has no ``thing-license`` element with a title, no
+        ``rel="license"`` link with a URL, or a ``file-download`` link
+        without a file id or title.
+    """
+    license_name = None
+    license_url = None
+    files = []
+    for tag, attr_text in _start_tags(text, ('license', 'file-download')):
+        if license_name is None and _has_token(attr_text, 'class', 'thing-license'):
+            license_name = _required(attr_text, 'title', 'The thing-license element')
+        if _has_token(attr_text, 'class', 'file-download'):
+            files.append(FileLink(_required(attr_text, 'data-file-id', 'A file-download link'),
+                                  _required(attr_text, 'title', 'A file-download link')))
+        if license_url is None and tag in ('a', 'link') and _has_token(attr_text, 'rel', 'license'):
+            license_url = _required(attr_text, 'href', 'The license link')
+
+    if license_name is None:
+        raise PageParseError('No thing-license element found.')
+    if license_url is None:
+        raise PageParseError('No license link found.')
+    return ThingPage(license_name, license_url, files)
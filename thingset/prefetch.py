@@ -0,0 +1,152 @@
+"""Background loading and saving for interactive tools.
+"""
+import logging
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = object()
+
+class Prefetcher(object):
+    """Iterates over loaded items while the next few are loaded on a background thread.
+    """
+
+    def __init__(self, keys, load_fn, depth=2):
+        """Create a prefetcher.
+
+        Parameters
+        ----------
+        keys : iterable
+            The keys of the items to load, in order.
+        load_fn : callable
+            A function that loads the item for a key.
+        depth : int
+            The maximum number of loaded items waiting to be consumed.
+        """
+        self._keys = keys
+        self._load_fn = load_fn
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        for key in self._keys:
+            if self._stop.is_set():
+                return
+            try:
+                item = (key, self._load_fn(key), None)
+            except Exception:
+                item = (key, None, sys.exc_info())
+            if not self._put(item):
+                return
+        self._put((None, None, _DONE))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        """Yield (key, item) pairs in key order.
+
+        An exception raised while loading an item is re-raised here, when the
+        consumer reaches that item.
+        """
+        try:
+            while True:
+                key, item, error = self._queue.get()
+                if error is _DONE:
+                    return
+                if error is not None:
+                    logging.log(32, 'Failed to load {}.'.format(key))
+                    raise error[1]
+                yield key, item
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop loading items.
+        """
+        self._stop.set()
+
+
+class AsyncWriter(object):
+    """Runs write operations one at a time, in order, on a background thread.
+    """
+
+    def __init__(self, maxsize=0):
+        """Create a writer.
+
+        Parameters
+        ----------
+        maxsize : int
+            The maximum number of pending writes before submit() blocks. If
+            zero, the number of pending writes is unbounded.
+        """
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is _DONE:
+                return
+            fn, args, kwargs = task
+            if self._error is not None:
+                continue
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                self._error = sys.exc_info()
+                logging.log(32, 'Background write failed: {}'.format(self._error[1]))
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error[1]
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a call to run on the writer thread.
+
+        Raises
+        ------
+        Exception
+            If a previously submitted write failed. Writes after a failure
+            are dropped.
+        """
+        self._check()
+        self._queue.put((fn, args, kwargs))
+
+    def close(self):
+        """Wait for all pending writes to finish.
+
+        Raises
+        ------
+        Exception
+            If any of the writes failed.
+        """
+        self._queue.put(_DONE)
+        self._thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._queue.put(_DONE)
+            self._thread.join()
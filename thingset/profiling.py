@@ -0,0 +1,266 @@
+"""Timing spans around dataset operations, reported to pluggable sinks.
+
+Code that might be slow is wrapped in a named span::
+
+    with profiling.span('mesh.parse'):
+        mesh = trimesh.load_mesh(filename)
+
+or, for whole functions, decorated with ``@profiling.timed('search.keyword')``.
+
+Spans do nothing unless a sink is enabled, so they cost well under a
+microsecond when profiling is off. To see where time goes, enable a sink::
+
+    agg = profiling.enable(profiling.Aggregator())
+    ...
+    print(ds.stats())
+
+Setting the ``THINGSET_PROFILE`` environment variable enables an Aggregator
+at import, which is handy for worker processes.
+"""
+import array
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+_sinks = []
+
+class Sink(object):
+    """A destination for span timings. Subclasses override enter() and/or exit().
+    """
+
+    def enter(self, name):
+        """Called when a span starts.
+        """
+        pass
+
+    def exit(self, name, start, seconds):
+        """Called when a span ends.
+
+        Parameters
+        ----------
+        name : str
+            The span's name.
+        start : float
+            The wall-clock time the span started at.
+        seconds : float
+            The span's duration.
+        """
+        pass
+
+
+class Aggregator(Sink):
+    """Keeps the duration of every span in memory, for summary statistics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+
+    def exit(self, name, start, seconds):
+        with self._lock:
+            if name not in self._durations:
+                self._durations[name] = array.array('d')
+            self._durations[name].append(seconds)
+
+    def stats(self):
+        """Summarize the spans recorded so far.
+
+        Returns
+        -------
+        dict
+            A map from span names to their ``count``, ``total``, ``mean``,
+            ``p50``, ``p90``, ``p99`` and ``max`` durations in seconds.
+        """
+        with self._lock:
+            durations = dict((name, np.array(d)) for name, d in self._durations.items())
+        stats = {}
+        for name, d in durations.items():
+            p50, p90, p99 = np.percentile(d, [50, 90, 99])
+            stats[name] = {
+                'count' : len(d),
+                'total' : float(d.sum()),
+                'mean' : float(d.mean()),
+                'p50' : float(p50),
+                'p90' : float(p90),
+                'p99' : float(p99),
+                'max' : float(d.max()),
+            }
+        return stats
+
+    def reset(self):
+        """Forget every recorded span.
+        """
+        with self._lock:
+            self._durations = {}
+
+
+class JsonLinesSink(Sink):
+    """Writes each span as a line of JSON, for offline analysis.
+    """
+
+    def __init__(self, filename):
+        """Open the output file, appending to it if it exists.
+
+        Parameters
+        ----------
+        filename : str
+            The output filename.
+        """
+        self._lock = threading.Lock()
+        self._file = open(filename, 'a')
+
+    def exit(self, name, start, seconds):
+        line = json.dumps({
+            'name' : name,
+            'start' : start,
+            'seconds' : seconds,
+            'pid' : os.getpid(),
+            'thread' : threading.current_thread().name,
+        })
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class CProfileSink(Sink):
+    """Runs cProfile inside spans, so that the profile only covers instrumented operations.
+
+    The profiler runs from the start of the outermost span to its end in the
+    thread that enabled it. Spans in other threads are ignored.
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self._thread = threading.current_thread()
+        self._depth = 0
+
+    def enter(self, name):
+        if threading.current_thread() is not self._thread:
+            return
+        if self._depth == 0:
+            self._profile.enable()
+        self._depth += 1
+
+    def exit(self, name, start, seconds):
+        if threading.current_thread() is not self._thread:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            self._profile.disable()
+
+    def dump_stats(self, filename):
+        """Write the profile for pstats or snakeviz.
+        """
+        self._profile.dump_stats(filename)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+class _Span(object):
+    __slots__ = ('_name', '_sinks', '_start', '_clock')
+
+    def __init__(self, name, sinks):
+        self._name = name
+        self._sinks = sinks
+
+    def __enter__(self):
+        for sink in self._sinks:
+            sink.enter(self._name)
+        self._start = time.time()
+        self._clock = _timer()
+        return self
+
+    def __exit__(self, *args):
+        seconds = _timer() - self._clock
+        for sink in self._sinks:
+            sink.exit(self._name, self._start, seconds)
+        return False
+
+def span(name):
+    """Return a context manager that times the code inside it.
+
+    Parameters
+    ----------
+    name : str
+        The operation's name, e.g. ``mesh.parse``.
+    """
+    if not _sinks:
+        return _NULL_SPAN
+    return _Span(name, _sinks)
+
+def timed(name):
+    """Return a decorator that wraps every call of a function in a span.
+
+    Parameters
+    ----------
+    name : str
+        The operation's name, e.g. ``search.keyword``.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return fn(*args, **kwargs)
+            with _Span(name, _sinks):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def enable(sink):
+    """Start sending spans to a sink.
+
+    Parameters
+    ----------
+    sink : Sink
+        The sink, e.g. an Aggregator, JsonLinesSink or CProfileSink.
+
+    Returns
+    -------
+    Sink
+        The sink.
+    """
+    global _sinks
+    _sinks = _sinks + [sink]
+    return sink
+
+def disable(sink=None):
+    """Stop sending spans to a sink, or to every sink if None.
+    """
+    global _sinks
+    if sink is None:
+        _sinks = []
+    else:
+        _sinks = [s for s in _sinks if s is not sink]
+
+def stats():
+    """Return the statistics of the first enabled Aggregator.
+
+    Returns
+    -------
+    dict
+        See Aggregator.stats(); empty if no Aggregator is enabled.
+    """
+    for sink in _sinks:
+        if isinstance(sink, Aggregator):
+            return sink.stats()
+    return {}
+
+if os.environ.get('THINGSET_PROFILE'):
+    enable(Aggregator())
@@ -0,0 +1,247 @@
+"""Posting-list indexes over dataset metadata, and a planner that combines them.
+
+A QueryIndex maps categories, model metadata values and the words in thing
+and model names to the things or models that have them. A query looks up
+the posting list of each filter it can answer from the index, starts from
+the smallest and intersects the rest into it, and only then checks the
+remaining filters (regular-expression keywords, unhashable metadata values
+and ``where`` predicates) against the surviving models' metadata.
+"""
+import re
+
+_WORD_RE = re.compile(r'^\w+$', re.UNICODE)
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def _tokens(name):
+    """Return the set of lowercase words in a name.
+    """
+    return set(_TOKEN_RE.findall((name or u'').lower()))
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+class QueryIndex(object):
+    """Inverted indexes over the metadata of every thing in a dataset.
+
+    The index holds a reference to the dataset's map of thing metadata, and
+    update() must be called with a thing's id whenever its entry changes.
+    """
+
+    def __init__(self, thing_metadata):
+        """Index a map of thing ids to thing metadata.
+
+        Parameters
+        ----------
+        thing_metadata : dict
+            The map, which is referenced rather than copied.
+        """
+        self._metadata = thing_metadata
+        self._models = {}
+        self._categories = {}
+        self._values = {}
+        self._keys = {}
+        self._thing_tokens = {}
+        self._model_tokens = {}
+        self._postings = {}
+        self._modelless = set()
+        self._n_models = 0
+        for thing_id in thing_metadata:
+            self.update(thing_id)
+
+    def update(self, thing_id):
+        """Re-index a thing after its metadata changed, was added or was removed.
+        """
+        for index, key, member in self._postings.pop(thing_id, []):
+            members = index[key]
+            members.discard(member)
+            if len(members) == 0:
+                del index[key]
+        self._n_models -= len(self._models.pop(thing_id, ()))
+        self._modelless.discard(thing_id)
+
+        metadata = self._metadata.get(thing_id)
+        if metadata is None:
+            return
+        postings = []
+        def add(index, key, member):
+            index.setdefault(key, set()).add(member)
+            postings.append((index, key, member))
+
+        add(self._categories, metadata['category'], thing_id)
+        for token in _tokens(metadata['name']):
+            add(self._thing_tokens, token, thing_id)
+        for model_id, model in metadata['models'].items():
+            pair = (thing_id, model_id)
+            for token in _tokens(model['name']):
+                add(self._model_tokens, token, pair)
+            for key, value in model['metadata'].items():
+                add(self._keys, key, pair)
+                if _hashable(value):
+                    add(self._values, (key, value), pair)
+        self._models[thing_id] = tuple(metadata['models'])
+        if len(metadata['models']) == 0:
+            self._modelless.add(thing_id)
+        self._n_models += len(metadata['models'])
+        self._postings[thing_id] = postings
+
+    @property
+    def categories(self):
+        """set of str : The categories of the indexed things.
+        """
+        return set(self._categories)
+
+    def category_things(self, category):
+        """Return the set of ids of the things in a category.
+        """
+        return set(self._categories.get(category, ()))
+
+    def keyword_things(self, keyword):
+        """Return the set of ids of the things whose names, or whose models'
+        names, match a keyword, including things without any models.
+
+        Parameters
+        ----------
+        keyword : str
+            A regular expression searched for, ignoring case.
+        """
+        things = set(thing_id for thing_id, _ in self.query(keyword=keyword))
+        pattern = re.compile(keyword.lower(), re.IGNORECASE)
+        things.update(t for t in self._modelless if pattern.search(self._metadata[t]['name']) is not None)
+        return things
+
+    def query(self, category=None, keyword=None, metadata=None, where=None):
+        """Find the models matching every given filter.
+
+        Parameters
+        ----------
+        category : str
+            The category of the models' things.
+        keyword : str
+            A regular expression searched for, ignoring case, in the names of
+            the models and their things. A model matches if its own name or
+            its thing's name does. Plain words are answered from the index.
+        metadata : dict
+            Model metadata keys and the values they must have.
+        where : dict
+            Model metadata keys and predicates their values must satisfy,
+            e.g. ``{'scale' : lambda s: s > 1.0}``. Models without a key don't match.
+
+        Returns
+        -------
+        list of (str, str)
+            The sorted (thing_id, model_id) pairs of the matching models.
+        """
+        steps, residuals = self._plan(category, keyword, metadata, where)
+        if len(steps) == 0:
+            candidates = set((t, m) for t, model_ids in self._models.items() for m in model_ids)
+        else:
+            candidates = None
+            for _, _, level, members in steps:
+                if candidates is None:
+                    candidates = self._expand(members) if level == 'thing' else set(members)
+                elif level == 'thing':
+                    candidates = set(p for p in candidates if p[0] in members)
+                else:
+                    candidates = candidates.intersection(members)
+                if len(candidates) == 0:
+                    return []
+        for _, predicate in residuals:
+            candidates = set(p for p in candidates if predicate(p))
+        return sorted(candidates)
+
+    def explain(self, category=None, keyword=None, metadata=None, where=None):
+        """Describe how a query would be run, for tuning and debugging.
+
+        Parameters are as for query().
+
+        Returns
+        -------
+        list of str
+            The index lookups in the order they're intersected, with the
+            size of each posting list, followed by the filters checked
+            against each candidate model.
+        """
+        steps, residuals = self._plan(category, keyword, metadata, where)
+        lines = ['index {}: {} {}s'.format(name, len(members), level) for _, name, level, members in steps]
+        if len(steps) == 0:
+            lines.append('scan: {} models'.format(self._n_models))
+        lines.extend('check {}'.format(name) for name, _ in residuals)
+        return lines
+
+    def _plan(self, category, keyword, metadata, where):
+        """Split a query's filters into index lookups, sorted by their estimated
+        number of models, and predicates checked against each candidate.
+
+        Returns
+        -------
+        steps : list of (float, str, str, set)
+            The estimated size, description, level (``thing`` or ``model``)
+            and members of each posting list.
+        residuals : list of (str, callable)
+            A description and predicate on a (thing_id, model_id) pair for
+            every filter that can't be answered from the index.
+        """
+        models_per_thing = float(self._n_models) / max(len(self._models), 1)
+        steps = []
+        residuals = []
+
+        def thing_step(name, members):
+            steps.append((len(members) * models_per_thing, name, 'thing', members))
+
+        def model_step(name, members):
+            steps.append((len(members), name, 'model', members))
+
+        if category is not None:
+            thing_step('category={!r}'.format(category), self._categories.get(category, set()))
+
+        if keyword is not None:
+            if _WORD_RE.match(keyword):
+                word = keyword.lower()
+                things = set()
+                for token, members in self._thing_tokens.items():
+                    if word in token:
+                        things.update(members)
+                pairs = self._expand(things)
+                for token, members in self._model_tokens.items():
+                    if word in token:
+                        pairs.update(members)
+                model_step('keyword={!r}'.format(keyword), pairs)
+            else:
+                pattern = re.compile(keyword.lower(), re.IGNORECASE)
+                def matches_keyword(pair):
+                    thing = self._metadata[pair[0]]
+                    return (pattern.search(thing['name']) is not None or
+                            pattern.search(thing['models'][pair[1]]['name']) is not None)
+                residuals.append(('keyword={!r}'.format(keyword), matches_keyword))
+
+        for key, value in sorted((metadata or {}).items()):
+            name = '{}={!r}'.format(key, value)
+            if _hashable(value):
+                model_step(name, self._values.get((key, value), set()))
+            else:
+                model_step('has {}'.format(key), self._keys.get(key, set()))
+                residuals.append((name, self._metadata_predicate(key, lambda v, value=value: v == value)))
+
+        for key, predicate in sorted((where or {}).items()):
+            model_step('has {}'.format(key), self._keys.get(key, set()))
+            residuals.append(('where {}'.format(key), self._metadata_predicate(key, predicate)))
+
+        steps.sort(key=lambda step: step[0])
+        return steps, residuals
+
+    def _metadata_predicate(self, key, predicate):
+        """Wrap a predicate on a metadata value as one on a (thing_id, model_id) pair.
+        """
+        def check(pair):
+            model_metadata = self._metadata[pair[0]]['models'][pair[1]]['metadata']
+            return key in model_metadata and predicate(model_metadata[key])
+        return check
+
+    def _expand(self, thing_ids):
+        """Return the set of (thing_id, model_id) pairs of every model of some things.
+        """
+        return set((t, m) for t in thing_ids for m in self._models.get(t, ()))
@@ -0,0 +1,282 @@
+"""Helpers for writing dataset files safely.
+
+Every file is written to a temporary file in its target directory and then
+renamed over the target, so readers never see a partially-written file and a
+crash never leaves one behind. Renaming also replaces the directory entry rather
+than the file's contents, so files hard-linked into other datasets are untouched.
+"""
+import binascii
+import errno
+import fcntl
+import json
+import numpy as np
+import os
+import shutil
+import stat
+
+from .profiling import span
+
+def _atomic_target(filename, suffix=''):
+    """Create a temporary file beside a target, with the mode a plain write would give it.
+
+    The file is created with mode 0666 so that the kernel applies the
+    process umask, as it would to a new target, and is then given the
+    target's current mode if the target exists.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    while True:
+        tmp_filename = os.path.join(dirname, '.{}.{}{}'.format(basename, binascii.hexlify(os.urandom(6)).decode('ascii'), suffix))
+        try:
+            fd = os.open(tmp_filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        os.fchmod(fd, stat.S_IMODE(os.stat(filename).st_mode))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            os.close(fd)
+            os.remove(tmp_filename)
+            raise
+    return fd, tmp_filename
+
+def _commit(tmp_filename, filename):
+    try:
+        with open(tmp_filename, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+
+def write_json(obj, filename):
+    """Atomically write an object to a JSON file.
+
+    Parameters
+    ----------
+    obj : dict
+        The object to write.
+    filename : str
+        The target filename.
+    """
+    fd, tmp_filename = _atomic_target(filename)
+    try:
+        with span('metadata.write'), os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, sort_keys=True, indent=4, separators=(',', ': '))
+    except:
+        os.remove(tmp_filename)
+        raise
+    _commit(tmp_filename, filename)
+
+def write_json_many(items):
+    """Atomically write many objects to compact JSON files in one pass.
+
+    Every file is written and fsynced before any is renamed into place, and
+    each directory containing a target is then fsynced once, so that the
+    renames are durable without syncing anything else on the machine. Each
+    file is still replaced atomically, but a crash can leave some files
+    updated and others not.
+
+    Parameters
+    ----------
+    items : list of (dict, str)
+        The objects to write and their target filenames.
+    """
+    tmp_filenames = []
+    n_renamed = 0
+    try:
+        with span('metadata.write_many'):
+            for obj, filename in items:
+                fd, tmp_filename = _atomic_target(filename)
+                tmp_filenames.append(tmp_filename)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(obj, f, sort_keys=True, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+            for tmp_filename, (obj, filename) in zip(tmp_filenames, items):
+                os.rename(tmp_filename, filename)
+                n_renamed += 1
+            for dirname in sorted(set(os.path.dirname(os.path.abspath(filename)) for _, filename in items)):
+                _fsync_dir(dirname)
+    except:
+        for tmp_filename in tmp_filenames[n_renamed:]:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        raise
+
+def _fsync_dir(dirname):
+    """Flush a directory's entries, e.g. after renaming files into it.
+    """
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def save_array(array, filename):
+    """Atomically write an array to a .npy file.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        The array to write.
+    filename : str
+        The target filename.
+    """
+    fd, tmp_filename = _atomic_target(filename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+    except:
+        os.remove(tmp_filename)
+        raise
+    _commit(tmp_filename, filename)
+
+def save_arrays(arrays, filename):
+    """Atomically write named arrays to a .npz file.
+
+    Parameters
+    ----------
+    arrays : dict
+        The arrays to write, by name.
+    filename : str
+        The target filename.
+    """
+    fd, tmp_filename = _atomic_target(filename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+    except:
+        os.remove(tmp_filename)
+        raise
+    _commit(tmp_filename, filename)
+
+def export_mesh(mesh, filename):
+    """Atomically export a mesh, with its format given by the file extension.
+
+    Parameters
+    ----------
+    mesh : trimesh.Trimesh
+        The mesh to write.
+    filename : str
+        The target filename.
+    """
+    ext = os.path.splitext(filename)[1]
+    fd, tmp_filename = _atomic_target(filename, suffix=ext)
+    os.close(fd)
+    try:
+        with span('mesh.export'):
+            mesh.export(tmp_filename, file_type=ext.lstrip('.').lower())
+    except:
+        os.remove(tmp_filename)
+        raise
+    _commit(tmp_filename, filename)
+
+def copy_file(src, dst):
+    """Atomically copy a file.
+
+    Parameters
+    ----------
+    src : str
+        The source filename.
+    dst : str
+        The target filename.
+    """
+    fd, tmp_filename = _atomic_target(dst)
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp_filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+    _commit(tmp_filename, dst)
+
+def makedirs(path):
+    """Create a directory and its parents, tolerating concurrent creation.
+
+    Parameters
+    ----------
+    path : str
+        The directory to create.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+class FileLock(object):
+    """An advisory, exclusive lock on a file, shared between processes.
+
+    The lock is released automatically if the holding process dies.
+    """
+
+    def __init__(self, filename):
+        """Create a lock. The lock file is created on first acquisition.
+
+        Parameters
+        ----------
+        filename : str
+            The lock file.
+        """
+        self._filename = filename
+        self._f = None
+
+    def acquire(self, blocking=True):
+        """Acquire the lock.
+
+        Parameters
+        ----------
+        blocking : bool
+            If True, wait for the lock. Otherwise, return immediately.
+
+        Returns
+        -------
+        bool
+            True if the lock was acquired.
+        """
+        f = open(self._filename, 'a')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except IOError as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._f = f
+        return True
+
+    def release(self):
+        """Release the lock.
+        """
+        if self._f is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class NullLock(object):
+    """A lock that is always free, for datasets with a single writer.
+    """
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
@@ -2,15 +2,139 @@
 """
 import copy
 import datetime
+import errno
+import hashlib
 import json
 import logging
-from lxml import html
+import numpy as np
 import os
 import re
-import requests
-import trimesh
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+
+from .constants import MAX_N_FACES, THINGIVERSE_URL, MESH_HASH_KEY, EXPORT_HASH_KEY, MESH_FILE_TYPES, STABLE_POSES_KEY, TRANSFORM_KEY
+from .pages import PageParseError, parse_thing_page
+from .profiling import span
+from .storage import export_mesh, makedirs, write_json
+
+def transformed_hash(mesh_hash, transform):
+    """Combine a hash of a model's source geometry with its transform.
+
+    Parameters
+    ----------
+    mesh_hash : str
+        A hex digest of the source geometry, as from Model.mesh_hash.
+    transform : (4,4) float
+        The model's transform.
+
+    Returns
+    -------
+    str
+        A hex digest of the transformed geometry.
+    """
+    h = hashlib.sha1()
+    h.update(mesh_hash.encode('ascii'))
+    h.update(np.asarray(transform, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def remove_stale_meshes(metadata, filenames):
+    """Remove mesh files written in a model's previous format.
+
+    This must only be called once metadata pointing at the new files has
+    been written, so that a crash never leaves a thing referring to a
+    missing mesh.
+
+    Parameters
+    ----------
+    metadata : dict
+        The thing's metadata, as written. Files it still refers to are kept.
+    filenames : list of str
+        The stale mesh filenames, as returned by Thing.export_meshes().
+    """
+    current = set(m['mesh'] for m in metadata['models'].values())
+    for filename in filenames:
+        if os.path.basename(filename) in current:
+            continue
+        try:
+            os.remove(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def _retrieval_dirs(path):
+    """Return the staging directory Thing.retrieve_to() writes a thing to, and
+    the directory it moves the copy being replaced to.
+    """
+    parent, name = os.path.split(os.path.abspath(path))
+    return os.path.join(parent, '.{}.partial'.format(name)), os.path.join(parent, '.{}.old'.format(name))
 
-from .constants import MAX_N_FACES
+def _same_file(model, saved, mesh_name):
+    """Return True if a model's saved entry still describes the file the model
+    was loaded from, i.e. the file hasn't been rewritten since.
+    """
+    if saved is None or saved['mesh'] != mesh_name:
+        return False
+    hashes = [(saved['metadata'].get(key), model.metadata.get(key)) for key in (EXPORT_HASH_KEY, MESH_HASH_KEY)]
+    return all(a == b for a, b in hashes) and any(a is not None for a, _ in hashes)
+
+def http_get(url, retries=3, timeout=60.0, **kwargs):
+    """GET a URL, retrying while the server is rate-limiting or failing.
+
+    Responses with status 429 or 5xx are retried after the delay given by
+    their Retry-After header, or with exponential backoff if there is none.
+
+    Parameters
+    ----------
+    url : str
+        The URL.
+    retries : int
+        The maximum number of retries.
+    timeout : float
+        The number of seconds to wait to connect, and between bytes of the
+        response, before raising requests.Timeout, so a hung connection
+        can't block a worker forever. None waits indefinitely.
+    **kwargs
+        Passed to requests.get().
+
+    Returns
+    -------
+    requests.Response
+        The first successful response, or the last one if every attempt failed.
+    """
+    import requests
+    for attempt in range(retries + 1):
+        with span('network.get'):
+            r = requests.get(url, timeout=timeout, **kwargs)
+        if (r.status_code != 429 and r.status_code < 500) or attempt == retries:
+            return r
+        try:
+            wait = float(r.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            wait = 2.0 ** attempt
+        logging.log(32, '\tStatus Code {} for {}, retrying in {}s.'.format(r.status_code, url, wait))
+        r.close()
+        time.sleep(wait)
+
+def _grid_points(mesh, resolution):
+    """Return the centers of a cubic grid of voxels enclosing a mesh.
+
+    The grid has a margin of one voxel around the mesh's bounding box.
+
+    Returns
+    -------
+    points : (resolution**3,3) float
+        The voxel centers, in C order.
+    origin : (3,) float
+        The center of voxel (0,0,0).
+    pitch : float
+        The edge length of a voxel.
+    """
+    lo, hi = mesh.bounds
+    pitch = (hi - lo).max() / max(resolution - 2, 1)
+    origin = (lo + hi) / 2.0 - pitch * (resolution - 1) / 2.0
+    inds = np.indices((resolution, resolution, resolution)).reshape(3, -1).T
+    return origin + inds * pitch, origin, pitch
 
 class Model(object):
     """A single model from a Thingiverse Thing.
@@ -26,16 +150,23 @@ class Model(object):
         model_name : str
             A human-readable name for the model.
         mesh : trimesh.Trimesh
-            The geometry of the model.
+            The source geometry of the model, before its transform is applied.
         metadata : dict
-            Annotated metadata for the model.
+            Annotated metadata for the model. The model's transform, if any, is
+            stored here as a nested list under the ``transform`` key.
         """
         self._model_id = model_id
         self._model_name = model_name
-        self._mesh = mesh
+        self._source_mesh = mesh
+        self._mesh = None
+        self._mesh_transform = None
         if metadata is None:
             metadata = {}
         self._metadata = metadata
+        self._file_type = None
+        # The absolute filename of the mesh file the model was last loaded from
+        # or saved to, and the mesh_hash of the geometry it was loaded or saved as
+        self._mesh_file = None
 
     @property
     def id(self):
@@ -49,10 +180,54 @@ class Model(object):
         """
         return self._model_name
 
+    @property
+    def file_type(self):
+        """str : The format of the model's saved mesh file, e.g. ``obj``, or None if it hasn't been saved.
+        """
+        return self._file_type
+
+    @property
+    def source_mesh(self):
+        """trimesh.Trimesh : The geometry of the model, without its transform.
+
+        This is the geometry that's saved. To change the model's geometry,
+        assign a new mesh, or edit this one in place and then assign it back
+        so that mesh is rebuilt.
+        """
+        return self._source_mesh
+
+    @source_mesh.setter
+    def source_mesh(self, mesh):
+        self._source_mesh = mesh
+        self._mesh = None
+
+    @property
+    def transform(self):
+        """(4,4) float : The transform from the source geometry to the model's geometry.
+        """
+        if TRANSFORM_KEY not in self._metadata:
+            return np.eye(4)
+        return np.array(self._metadata[TRANSFORM_KEY], dtype=np.float64)
+
     @property
     def mesh(self):
-        """trimesh.Trimesh : The geometry of the model.
+        """trimesh.Trimesh : The geometry of the model, with its transform applied.
+
+        This is always a copy of the source geometry, made when it's first
+        accessed and again whenever the transform changes or source_mesh is
+        assigned, even if the transform is the identity. Its vertices and
+        faces are read-only, so editing them in place raises an error rather
+        than being silently lost; change source_mesh or the transform instead.
         """
+        transform = self.transform
+        if self._mesh is None or not np.array_equal(transform, self._mesh_transform):
+            mesh = self._source_mesh.copy()
+            if not np.allclose(transform, np.eye(4)):
+                mesh.apply_transform(transform)
+            mesh.vertices.flags.writeable = False
+            mesh.faces.flags.writeable = False
+            self._mesh = mesh
+            self._mesh_transform = transform
         return self._mesh
 
     @property
@@ -61,6 +236,152 @@ class Model(object):
         """
         return self._metadata
 
+    @property
+    def mesh_hash(self):
+        """str : A hex digest of the source geometry's vertices and faces.
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self._source_mesh.vertices, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(self._source_mesh.faces, dtype=np.int64).tobytes())
+        return h.hexdigest()
+
+    @property
+    def geometry_hash(self):
+        """str : A hex digest of the model's geometry, including its transform.
+        """
+        return transformed_hash(self.mesh_hash, self.transform)
+
+    def set_transform(self, matrix):
+        """Set the transform from the source geometry to the model's geometry.
+
+        The source geometry is left untouched; only the model's metadata changes.
+
+        Parameters
+        ----------
+        matrix : (4,4) float
+            The new transform.
+        """
+        self._metadata[TRANSFORM_KEY] = np.asarray(matrix, dtype=np.float64).tolist()
+
+    def apply_transform(self, matrix):
+        """Compose a transform onto the model's current transform.
+
+        Parameters
+        ----------
+        matrix : (4,4) float
+            The transform to apply after the current one.
+        """
+        self.set_transform(np.asarray(matrix).dot(self.transform))
+
+    def stable_poses(self):
+        """Return the stable poses of the model and their probabilities.
+
+        The poses are cached in the model's metadata along with the hash of the
+        geometry they were computed for, so they are only recomputed when the
+        geometry changes.
+
+        Returns
+        -------
+        transforms : (n,4,4) float
+            The transforms that put the model in each of its stable poses.
+        probs : (n,) float
+            The probability of the model landing in each stable pose.
+        """
+        geometry_hash = self.geometry_hash
+        cached = self._metadata.get(STABLE_POSES_KEY)
+        if cached is None or cached['mesh_hash'] != geometry_hash:
+            transforms, probs = self.mesh.compute_stable_poses()
+            cached = {
+                'mesh_hash' : geometry_hash,
+                'transforms' : np.asarray(transforms).tolist(),
+                'probabilities' : np.asarray(probs).tolist()
+            }
+            self._metadata[STABLE_POSES_KEY] = cached
+        return np.array(cached['transforms']), np.array(cached['probabilities'])
+
+    def sample_points(self, n, seed=0):
+        """Sample points uniformly from the surface of the model.
+
+        Faces are chosen with probability proportional to their area, and a
+        point is then drawn uniformly from each chosen face.
+
+        Parameters
+        ----------
+        n : int
+            The number of points.
+        seed : int
+            The random seed, so that the same points are returned every time.
+
+        Returns
+        -------
+        (n,3) float32
+            The points.
+        """
+        mesh = self.mesh
+        random_state = np.random.RandomState(seed)
+        cdf = np.cumsum(mesh.area_faces)
+        faces = np.searchsorted(cdf, random_state.rand(n) * cdf[-1])
+        faces = np.minimum(faces, len(cdf) - 1)
+        tris = mesh.vertices[mesh.faces[faces]]
+
+        # Reflect samples from the far half of the unit square into the triangle
+        uv = random_state.rand(n, 2)
+        flip = uv.sum(axis=1) > 1.0
+        uv[flip] = 1.0 - uv[flip]
+        points = (tris[:,0] +
+                  uv[:,0:1] * (tris[:,1] - tris[:,0]) +
+                  uv[:,1:2] * (tris[:,2] - tris[:,0]))
+        return points.astype(np.float32)
+
+    def voxelize(self, resolution):
+        """Compute an occupancy grid for the model.
+
+        The grid is cubic, with a margin of one voxel around the model's
+        bounding box. A voxel is occupied if its center is inside the mesh.
+
+        Parameters
+        ----------
+        resolution : int
+            The number of voxels along each edge of the grid.
+
+        Returns
+        -------
+        occupancy : (resolution,resolution,resolution) bool
+            True for occupied voxels.
+        origin : (3,) float
+            The center of voxel (0,0,0).
+        pitch : float
+            The edge length of a voxel.
+        """
+        points, origin, pitch = _grid_points(self.mesh, resolution)
+        occupancy = self.mesh.contains(points)
+        return occupancy.reshape((resolution,) * 3), origin, pitch
+
+    def signed_distance_field(self, resolution):
+        """Compute the signed distance to the model's surface on a grid.
+
+        The grid is the same as that of voxelize().
+
+        Parameters
+        ----------
+        resolution : int
+            The number of voxels along each edge of the grid.
+
+        Returns
+        -------
+        sdf : (resolution,resolution,resolution) float32
+            The distance from each voxel center to the surface, positive
+            inside the mesh and negative outside.
+        origin : (3,) float
+            The center of voxel (0,0,0).
+        pitch : float
+            The edge length of a voxel.
+        """
+        import trimesh
+        points, origin, pitch = _grid_points(self.mesh, resolution)
+        sdf = trimesh.proximity.signed_distance(self.mesh, points)
+        return np.asarray(sdf, dtype=np.float32).reshape((resolution,) * 3), origin, pitch
+
     def copy(self):
         """Returns a copy of the Model.
 
@@ -69,7 +390,63 @@ class Model(object):
         Model
             The copy.
         """
-        return Model(self.id, self.name, self.mesh.copy(), copy.copy(self.metadata))
+        model = Model(self.id, self.name, self.source_mesh.copy(), copy.copy(self.metadata))
+        model._file_type = self._file_type
+        model._mesh_file = self._mesh_file
+        return model
+
+    def to_dict(self):
+        """Return the model's entry in its thing's metadata.
+
+        Returns
+        -------
+        dict
+            The model's ``name``, mesh filename (``mesh``), ``metadata`` and
+            download ``link``. The metadata dict is shared, not copied.
+        """
+        baseid = re.search('(.*)_cc_[0-9]*$', self.id)
+        if baseid is None:
+            baseid = self.id
+        else:
+            baseid = baseid.group(1)
+        return {
+            'name' : self.name,
+            'mesh' : '{}.{}'.format(self.id, self.file_type or 'obj'),
+            'metadata' : self.metadata,
+            'link' : 'https://www.thingiverse.com/download:{}'.format(baseid)
+        }
+
+    @staticmethod
+    def load(path, model_id, model_dict):
+        """Load a single model of a saved thing.
+
+        Parameters
+        ----------
+        path : str
+            The directory in which the thing was saved.
+        model_id : str
+            The id key for the model.
+        model_dict : dict
+            The model's entry in the thing's metadata.
+
+        Returns
+        -------
+        Model
+            The loaded model.
+        """
+        import trimesh
+        mesh_filename = os.path.join(path, model_dict['mesh'])
+        with span('mesh.parse'):
+            mesh = trimesh.load_mesh(mesh_filename)
+            # GLB files may load as a scene, even with a single mesh
+            if isinstance(mesh, trimesh.Scene):
+                mesh = mesh.dump()
+            if isinstance(mesh, list):
+                mesh = mesh[0] if len(mesh) == 1 else trimesh.util.concatenate(mesh)
+        model = Model(model_id, model_dict['name'], mesh, model_dict['metadata'])
+        model._file_type = os.path.splitext(model_dict['mesh'])[1].lstrip('.').lower()
+        model._mesh_file = (os.path.abspath(mesh_filename), model.mesh_hash)
+        return model
 
 
 class Thing(object):
@@ -146,17 +523,15 @@ class Thing(object):
     def meshes(self):
         return [m.mesh for m in self.models]
 
-    def export(self, path, only_metadata=False, model_keys=None):
-        """Save the thing to the given directory.
+    def to_dict(self):
+        """Return the thing's metadata, as written to its metadata.json file.
 
-        Parameters
-        ----------
-        path : str
-            A directory in which to save the thing.
-        only_metadata : bool
-            If True, only the metadata is written (not the mesh filenames).
-        model_keys : list of str
-            The keys of the models to save. If None, all models are saved.
+        The returned dict shares the models' metadata dicts rather than copying them.
+
+        Returns
+        -------
+        dict
+            The thing's metadata.
         """
         json_dict = {
             'id'            : self._id,
@@ -168,30 +543,142 @@ class Thing(object):
             'access_time'   : self._access_time,
             'models'        : {}
         }
-        if model_keys is None:
-            model_keys = [m.id for m in self.models]
-
-        # Export models
         for model in self.models:
-            basename = '{}.obj'.format(model.id)
-            mesh_filename = os.path.join(path, basename)
-            if not only_metadata and model.id in model_keys:
-                model.mesh.export(mesh_filename)
-            baseid = re.search('(.*)_cc_[0-9]*$', model.id)
-            if baseid is None:
-                baseid = model.id
-            else:
-                baseid = baseid.group(1)
-            json_dict['models'][model.id] = {
-                'name' : model.name,
-                'mesh' : basename,
-                'metadata' : model.metadata,
-                'link' : 'https://www.thingiverse.com/download:{}'.format(baseid)
-            }
+            json_dict['models'][model.id] = model.to_dict()
+        return json_dict
 
-        # Export metadata
-        json_filename = os.path.join(path, 'metadata.json')
-        json.dump(json_dict, open(json_filename, 'w'), sort_keys=True, indent=4, separators=(',', ': '))
+    def export_meshes(self, path, model_keys=None, file_type=None, workers=1, skip_unchanged=False, saved_models=None,
+                      trust_loaded=True):
+        """Write the mesh files of the thing's models to the given directory.
+
+        Parameters
+        ----------
+        path : str
+            A directory in which to save the meshes.
+        model_keys : list of str
+            The keys of the models to save. If None, all models are saved.
+        file_type : str
+            The mesh format, one of MESH_FILE_TYPES. The binary ``ply``,
+            ``stl`` and ``glb`` formats are much faster to write and read than
+            ``obj``, but ``stl`` doesn't store shared vertices, so they're
+            merged when the mesh is loaded. If None, each model keeps the
+            format it was loaded from, or ``obj`` if it's new.
+        workers : int
+            The number of threads to write meshes with.
+        skip_unchanged : bool
+            If True, a model isn't written if its mesh file already exists
+            and holds the same geometry: either the model was loaded from or
+            saved to that file and its source geometry hasn't changed since,
+            or its mesh_hash matches the ``export_hash`` or ``mesh_hash``
+            recorded for the file in ``saved_models``.
+        saved_models : dict
+            The ``models`` entry of the metadata last saved to the directory,
+            if any, used to recognize unchanged geometry when skip_unchanged is set.
+        trust_loaded : bool
+            If False, e.g. when other processes may have rewritten the files
+            since the models were loaded, a model's record of the file it was
+            loaded from is only trusted if the file's entry in saved_models
+            still has the hashes the model was loaded with.
+
+        Returns
+        -------
+        written : list of str
+            The keys of the models whose mesh files were written.
+        stale : list of str
+            The files of models whose format changed, in their previous
+            format. They aren't removed here, since the thing's metadata
+            still refers to them; pass them to remove_stale_meshes() once
+            the new metadata is written.
+
+        Raises
+        ------
+        ValueError
+            If the file type isn't supported.
+        """
+        if file_type is not None and file_type not in MESH_FILE_TYPES:
+            raise ValueError('Unsupported mesh file type {}; use one of {}.'.format(file_type, MESH_FILE_TYPES))
+        models = [m for m in self.models if model_keys is None or m.id in model_keys]
+        saved_models = saved_models or {}
+        written = []
+        stale = []
+
+        def export_model(model):
+            model_file_type = file_type or model.file_type or 'obj'
+            mesh_name = '{}.{}'.format(model.id, model_file_type)
+            filename = os.path.abspath(os.path.join(path, mesh_name))
+            mesh_hash = model.mesh_hash
+
+            if skip_unchanged and os.path.exists(filename):
+                saved = saved_models.get(model.id)
+                if model._mesh_file == (filename, mesh_hash) and (trust_loaded or _same_file(model, saved, mesh_name)):
+                    model._file_type = model_file_type
+                    return
+                if saved is not None and saved['mesh'] == mesh_name:
+                    saved_metadata = saved['metadata']
+                    if mesh_hash in (saved_metadata.get(EXPORT_HASH_KEY), saved_metadata.get(MESH_HASH_KEY)):
+                        # Keep the hashes describing the file that's already there
+                        for key in (EXPORT_HASH_KEY, MESH_HASH_KEY):
+                            if key in saved_metadata:
+                                model.metadata[key] = saved_metadata[key]
+                            else:
+                                model.metadata.pop(key, None)
+                        model._file_type = model_file_type
+                        model._mesh_file = (filename, mesh_hash)
+                        return
+
+            export_mesh(model.source_mesh, filename)
+            # The file written in the model's previous format, if any, is now stale
+            if model.file_type is not None and model.file_type != model_file_type:
+                old_filename = os.path.join(path, '{}.{}'.format(model.id, model.file_type))
+                if os.path.exists(old_filename):
+                    stale.append(old_filename)
+            model._file_type = model_file_type
+            model._mesh_file = (filename, mesh_hash)
+            model.metadata[EXPORT_HASH_KEY] = mesh_hash
+            # The recorded hash was of the geometry parsed from the old file
+            model.metadata.pop(MESH_HASH_KEY, None)
+            written.append(model.id)
+
+        if workers > 1 and len(models) > 1:
+            pool = ThreadPool(min(workers, len(models)))
+            try:
+                pool.map(export_model, models)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for model in models:
+                export_model(model)
+        return sorted(written), sorted(stale)
+
+    def export(self, path, only_metadata=False, model_keys=None, file_type=None, workers=1):
+        """Save the thing to the given directory.
+
+        Parameters
+        ----------
+        path : str
+            A directory in which to save the thing.
+        only_metadata : bool
+            If True, only the metadata is written (not the mesh filenames).
+        model_keys : list of str
+            The keys of the models to save. If None, all models are saved.
+        file_type : str
+            The mesh format; see export_meshes().
+        workers : int
+            The number of threads to write meshes with.
+
+        Returns
+        -------
+        dict
+            The metadata written, as returned by to_dict().
+        """
+        stale = []
+        if not only_metadata:
+            _, stale = self.export_meshes(path, model_keys, file_type, workers)
+        json_dict = self.to_dict()
+        write_json(json_dict, os.path.join(path, 'metadata.json'))
+        remove_stale_meshes(json_dict, stale)
+        return json_dict
 
     def copy(self, model_keys=None):
         """Get a copy of the Thing.
@@ -245,7 +732,8 @@ class Thing(object):
         """
         json_filename = os.path.join(path, 'metadata.json')
         try:
-            json_dict = json.load(open(json_filename))
+            with span('metadata.load'):
+                json_dict = json.load(open(json_filename))
         except:
             return None
         return json_dict
@@ -271,19 +759,19 @@ class Thing(object):
         # Load mesh models
         models = {}
         for model_id in json_dict['models']:
-            model = json_dict['models'][model_id]
-            mesh_filename = os.path.join(path, '{}.obj'.format(model_id))
-            mesh = trimesh.load_mesh(mesh_filename)
-            models[model_id] = Model(model_id, model['name'], mesh, model['metadata'])
+            models[model_id] = Model.load(path, model_id, json_dict['models'][model_id])
 
         return Thing(json_dict['id'], json_dict['name'], json_dict['author'],
                      json_dict['license']['type'], json_dict['license']['url'],
                      json_dict['category'], json_dict['access_time'], models)
 
     @staticmethod
-    def retrieve(thing_id, cache_dir, max_faces=MAX_N_FACES):
+    def retrieve(thing_id, cache_dir, max_faces=MAX_N_FACES, base_url=THINGIVERSE_URL):
         """Load a thing from Thingiverse.
 
+        Every model is kept in memory; to write a large thing straight to
+        disk instead, use retrieve_to().
+
         Parameters
         ----------
         thing_id : str
@@ -293,6 +781,8 @@ class Thing(object):
         max_faces : int
             A threshold on the number of faces allowed in a single model (doesn't save
             any models larger than this).
+        base_url : str
+            The root URL of the site to retrieve from, e.g. a local stand-in for testing.
 
         Returns
         -------
@@ -300,62 +790,222 @@ class Thing(object):
             The thing downloaded from Thingiverse, or None if no such thing exists or if
             none of the Thing's models were valid.
         """
+        retrieved = Thing._retrieve_page(thing_id, cache_dir, base_url)
+        if retrieved is None:
+            return None
+        thing, files = retrieved
+        for model in Thing._retrieve_models(files, cache_dir, max_faces, base_url):
+            thing._models[model.id] = model
+
+        if len(thing._models) > 0:
+            return thing
+        else:
+            return None
+
+    @staticmethod
+    def retrieve_to(thing_id, path, cache_dir, max_faces=MAX_N_FACES, base_url=THINGIVERSE_URL, file_type=None,
+                    raise_on_error=False):
+        """Download a thing from Thingiverse straight into a directory.
 
+        Each model is written to disk as soon as it's processed, so only one
+        downloaded file's meshes are in memory at a time. The models are
+        written to a hidden staging directory next to the target, which is
+        renamed to the target once the metadata is written, so a partially
+        retrieved thing is never visible. A thing already in the target is replaced,
+        after cleaning up any interrupted earlier retrieval with recover_retrieval().
+
+        Parameters
+        ----------
+        thing_id : str
+            An ID for the thing.
+        path : str
+            The directory to save the thing in.
+        cache_dir : str
+            Path to a cache directory for temporary 3D model conversion.
+        max_faces : int
+            A threshold on the number of faces allowed in a single model (doesn't save
+            any models larger than this).
+        base_url : str
+            The root URL of the site to retrieve from, e.g. a local stand-in for testing.
+        file_type : str
+            The mesh format, one of MESH_FILE_TYPES. Defaults to ``obj``.
+        raise_on_error : bool
+            If True, a failed request for the thing's page or one of its
+            files, other than a 404, or a page that can't be parsed raises
+            instead of being skipped, so that the caller can retry.
+
+        Returns
+        -------
+        dict
+            The metadata written, as from Thing.to_dict(), or None if no such
+            thing exists or if none of the Thing's models were valid.
+
+        Raises
+        ------
+        ValueError
+            If the file type isn't supported.
+        IOError
+            If raise_on_error is set and a request failed.
+        PageParseError
+            If raise_on_error is set and the thing's page couldn't be parsed.
+        """
+        file_type = file_type or 'obj'
+        if file_type not in MESH_FILE_TYPES:
+            raise ValueError('Unsupported mesh file type {}; use one of {}.'.format(file_type, MESH_FILE_TYPES))
+        retrieved = Thing._retrieve_page(thing_id, cache_dir, base_url, raise_on_error)
+        if retrieved is None:
+            return None
+        thing, files = retrieved
+
+        path = os.path.abspath(path)
+        Thing.recover_retrieval(path)
+        staging, old = _retrieval_dirs(path)
+        makedirs(staging)
+        try:
+            json_dict = thing.to_dict()
+            for model in Thing._retrieve_models(files, cache_dir, max_faces, base_url, raise_on_error):
+                model._file_type = file_type
+                export_mesh(model.source_mesh, os.path.join(staging, '{}.{}'.format(model.id, file_type)))
+                model.metadata[EXPORT_HASH_KEY] = model.mesh_hash
+                json_dict['models'][model.id] = model.to_dict()
+
+            if len(json_dict['models']) == 0:
+                shutil.rmtree(staging)
+                return None
+
+            write_json(json_dict, os.path.join(staging, 'metadata.json'))
+            replaced = os.path.exists(path)
+            if replaced:
+                os.rename(path, old)
+            # A crash here leaves the thing in old and staging; recover_retrieval() finishes the move
+            os.rename(staging, path)
+        except:
+            if not os.path.exists(path) and os.path.exists(old):
+                os.rename(old, path)
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if replaced:
+            shutil.rmtree(old)
+        return json_dict
+
+    @staticmethod
+    def recover_retrieval(path):
+        """Finish or undo an interrupted retrieve_to() into a directory.
+
+        If the thing's directory is missing and the retrieved copy was
+        completely written, it's moved into place; otherwise the copy it
+        was replacing, if any, is restored. Any leftover staging or
+        previous copy is then removed.
+
+        Parameters
+        ----------
+        path : str
+            The thing's directory.
+
+        Returns
+        -------
+        bool
+            True if there was anything to recover or remove.
+        """
+        staging, old = _retrieval_dirs(path)
+        found = os.path.exists(staging) or os.path.exists(old)
+        if not os.path.exists(path):
+            if os.path.exists(os.path.join(staging, 'metadata.json')):
+                os.rename(staging, path)
+            elif os.path.exists(old):
+                os.rename(old, path)
+        for d in (staging, old):
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        return found
+
+    @staticmethod
+    def _retrieve_page(thing_id, cache_dir, base_url, raise_on_error=False):
+        """Retrieve a thing's files page.
+
+        Returns
+        -------
+        (Thing, list of FileLink)
+            The thing, without any models, and the files to download, or None
+            if the page couldn't be retrieved or parsed. If raise_on_error is
+            set, only a 404 returns None; other failures raise.
+        """
         # Make cache dir
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
+        makedirs(cache_dir)
 
         # Retrieve a page for the thing
-        url = 'https://www.thingiverse.com/thing:{}/files'.format(thing_id)
+        url = '{}/thing:{}/files'.format(base_url, thing_id)
 
         logging.log(31, 'Retrieving thing {}...'.format(thing_id))
 
-        r = requests.get(url)
+        r = http_get(url)
         if r.status_code != 200:
             logging.log(32, 'Thing retrieval failed.')
             logging.log(32, '\tQuery URL: {}'.format(url))
             logging.log(32, '\tStatus Code: {}'.format(r.status_code))
+            if raise_on_error and r.status_code != 404:
+                raise IOError('Thing page {} returned status code {}.'.format(url, r.status_code))
             return None
         access_time = datetime.datetime.now().strftime("%I:%M%p on %d %B %Y")
-        root = html.fromstring(r.text)
+        try:
+            with span('page.parse'):
+                page = parse_thing_page(r.text)
+        except PageParseError as e:
+            logging.log(32, 'Thing page could not be parsed: {}'.format(e))
+            logging.log(32, '\tQuery URL: {}'.format(url))
+            if raise_on_error:
+                raise
+            return None
 
         # Retrieve basic metadata about the thing
-        thing_name = 'none'#root.find_class('item-page-info')[0].text
-        author_name = 'none'#root.find_class('creator-name')[0][0].text
-        license_name = root.find_class('thing-license')[0].get('title')
-        license_url = root.find_rel_links('license')[0].get('href')
-        #_, category = os.path.split(root.find_class('thing-category')[0].get('href'))
+        thing_name = 'none'
+        author_name = 'none'
         category = 'none'
+        thing = Thing(thing_id, thing_name, author_name,
+                      page.license_name, page.license_url, category,
+                      access_time, {})
+        return thing, page.files
 
-        # Retrieve the individual cad files
-        models = {}
-        links = root.find_class('file-download')
-        for a in links:
+    @staticmethod
+    def _retrieve_models(files, cache_dir, max_faces, base_url, raise_on_error=False):
+        """Download and process a thing's mesh files, yielding each model as it's finished.
+
+        A file with several connected components yields the whole mesh and
+        then each component. A file that can't be downloaded is skipped, or
+        raises an IOError if raise_on_error is set.
+        """
+        import trimesh
+
+        for link in files:
             # Retrieve metadata
-            file_id = a.get('data-file-id')
-            file_name = a.get('title')
+            file_id = link.file_id
+            file_name = link.file_name
             base_name, ext = os.path.splitext(file_name)
             if ext.lower() not in [".stl", ".obj", ".ply", ".off"]:
                 continue
 
             # Download mesh
-            link = 'https://www.thingiverse.com/download:{}'.format(file_id)
+            link = '{}/download:{}'.format(base_url, file_id)
             logging.log(31, '\tRetrieving mesh {}.'.format(file_id))
-            r = requests.get(link, stream=True)
+            r = http_get(link, stream=True)
             if r.status_code != 200:
                 logging.log(32, '\tMesh retrieval failed.')
                 logging.log(32, '\t\tQuery URL: {}'.format(link))
                 logging.log(32, '\t\tStatus Code: {}'.format(r.status_code))
+                if raise_on_error:
+                    raise IOError('Mesh file {} returned status code {}.'.format(link, r.status_code))
                 continue
 
-            output_filename = os.path.join(cache_dir, file_name)
-            with open(output_filename, 'wb') as fout:
+            # Prefix the file id, as different things often have files of the same name
+            output_filename = os.path.join(cache_dir, '{}_{}'.format(file_id, file_name))
+            with span('network.download'), open(output_filename, 'wb') as fout:
                 for chunk in r.iter_content(chunk_size=1024):
                     if chunk:
                         fout.write(chunk)
 
             try:
-                mesh = trimesh.load_mesh(output_filename, validate=True)
+                with span('mesh.parse'):
+                    mesh = trimesh.load_mesh(output_filename, validate=True)
                 mesh.apply_scale(0.001)
             except:
                 logging.log(32, '\t\tUnable to load mesh file.')
@@ -378,31 +1028,26 @@ class Thing(object):
                 # Patch up the normals, if necessary
                 mesh.fix_normals()
                 # Split the mesh by connected components
-                ccs = mesh.split()
+                ccs = list(mesh.split())
             except:
                 logging.log(32, '\t\tUnable to process mesh file.')
                 continue
 
             # If only one CC, re-center it and save it
+            mesh.apply_translation(-mesh.center_mass)
             if len(ccs) == 1:
-                mesh.apply_translation(-mesh.center_mass)
-                models[file_id] = Model(file_id, base_name, mesh)
+                yield Model(file_id, base_name, mesh)
 
             # Otherwise, save each of the connected components separately
             else:
                 logging.log(31, '\t\tMesh had {} connected components, splitting.'.format(len(ccs)))
-                mesh.apply_translation(-mesh.center_mass)
-                models[file_id] = Model(file_id, base_name, mesh)
-                for i, cc in enumerate(ccs):
+                yield Model(file_id, base_name, mesh)
+                del mesh
+                for i in range(len(ccs)):
+                    # Drop each component once it's been handed over
+                    cc, ccs[i] = ccs[i], None
                     cc.apply_translation(-cc.center_mass)
                     file_id_str = '{}_cc_{}'.format(file_id, i)
-                    models[file_id_str] = Model(file_id_str, '{}_cc_{}'.format(base_name, i), cc)
-
-        if len(models) > 0:
-            return Thing(thing_id, thing_name, author_name,
-                        license_name, license_url, category,
-                        access_time, models)
-        else:
-            return None
+                    yield Model(file_id_str, '{}_cc_{}'.format(base_name, i), cc)
 
 
@@ -7,7 +7,7 @@ import logging
 from autolab_core import YamlConfig
 from visualization import Visualizer3D as vis
 
-from thingset import ThingiverseDataset
+from thingset import ThingiverseDataset, Prefetcher, AsyncWriter
 
 def good_label_callback(viewer, model, key, value):
     model.metadata[key] = value
@@ -32,27 +32,29 @@ def main():
     set_value = config['set_value']
     override = config['override']
 
-    ds = ThingiverseDataset(config['dataset_dir'])
+    ds = ThingiverseDataset(config['dataset_dir'], multiprocess=config['multiprocess'])
 
-    for i, thing_id in enumerate(ds.keys):
-        thing = None
+    # Find the models that need labels
+    candidates = []
+    for thing_id in ds.keys:
         thing_metadata = ds.metadata(thing_id)
-
         for model_id in thing_metadata['models']:
             model_data = thing_metadata['models'][model_id]
             if override or target_key not in model_data['metadata']:
-                if thing is None:
-                    thing = ds[thing_id]
-                model = thing[model_id]
-                logging.log(31, u"{} ({}): {} ({})".format(thing.name, thing.id, model.name, model.id).encode('utf-8'))
-                model.metadata[target_key] = default_value
-                vis.figure()
-                vis.mesh(model.mesh, style='surface')
-                vis.show(animate=True, registered_keys={'g' : (good_label_callback, [model, target_key, set_value])})
-
-        if thing:
-            ds.save(thing, only_metadata=True)
-        logging.log(31, '{}/{} things...'.format(i, len(ds.keys)))
+                candidates.append((thing_id, model_id))
+
+    # Load upcoming models and write labels in the background
+    prefetcher = Prefetcher(candidates, lambda key: ds.load_model(*key), config['prefetch'])
+    with AsyncWriter() as writer:
+        for i, ((thing_id, model_id), model) in enumerate(prefetcher):
+            thing_name = ds.metadata(thing_id)['name']
+            logging.log(31, u"{} ({}): {} ({})".format(thing_name, thing_id, model.name, model.id).encode('utf-8'))
+            model.metadata[target_key] = default_value
+            vis.figure()
+            vis.mesh(model.mesh, style='surface')
+            vis.show(animate=True, registered_keys={'g' : (good_label_callback, [model, target_key, set_value])})
+            writer.submit(ds.update_model_metadata, thing_id, model_id, {target_key : model.metadata[target_key]})
+            logging.log(31, '{}/{} models...'.format(i + 1, len(candidates)))
 
 if __name__ == "__main__":
     main()
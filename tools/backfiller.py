@@ -0,0 +1,44 @@
+#!/usr/bin/python
+"""A script for precomputing derived model data in a dataset.
+"""
+import argparse
+import logging
+
+from autolab_core import YamlConfig
+
+from thingset import ThingiverseDataset
+
+def main():
+    # initialize logging
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Precompute derived data for Thingiverse Dataset Models',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--config', help='config filename', default='cfg/tools/backfiller.yaml')
+    args = parser.parse_args()
+
+    config_filename = args.config
+    config = YamlConfig(config_filename)
+
+    ds = ThingiverseDataset(config['dataset_dir'])
+    workers = config['workers']
+
+    # Write each thing's metadata once, after every pass
+    with ds.batch():
+        if config['stable_poses']:
+            n_updated = ds.compute_stable_poses(workers=workers, verify=config['verify'])
+            logging.log(31, 'Updated stable poses for {} things.'.format(n_updated))
+
+        if config['n_points'] > 0:
+            n_sampled = ds.precompute_point_clouds(config['n_points'], seed=config['point_seed'], workers=workers)
+            logging.log(31, 'Sampled point clouds for {} models.'.format(n_sampled))
+
+        if len(config['voxel_resolutions']) > 0:
+            n_voxelized = ds.precompute_voxel_grids(config['voxel_resolutions'], kinds=config['voxel_kinds'],
+                                                    workers=workers)
+            logging.log(31, 'Computed voxel grids for {} models.'.format(n_voxelized))
+
+if __name__ == "__main__":
+    main()
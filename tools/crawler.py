@@ -1,12 +1,18 @@
 #!/usr/bin/python
 """A script for adding things to a dataset.
+
+By default, the configured searches are crawled by this process alone. To
+share a crawl between processes or machines, run the script once with
+--coordinate to fill the dataset's crawl queue, then run any number of
+processes with --worker.
 """
 import argparse
 import logging
+import os
 
 from autolab_core import YamlConfig
 
-from thingset import ThingiverseDataset
+from thingset import CrawlQueue, ThingiverseDataset
 
 def main():
     # initialize logging
@@ -17,13 +23,44 @@ def main():
         epilog='Written by Matthew Matl (mmatl)'
     )
     parser.add_argument('--config', help='config filename', default='cfg/tools/crawler.yaml')
+    parser.add_argument('--coordinate', help='queue the configured searches in the crawl queue', action='store_true')
+    parser.add_argument('--worker', help='retrieve things from the crawl queue until it is empty', action='store_true')
     args = parser.parse_args()
 
     config_filename = args.config
     config = YamlConfig(config_filename)
 
-    ds = ThingiverseDataset(config['dataset_dir'])
+    ds = ThingiverseDataset(config['dataset_dir'], multiprocess=config['multiprocess'])
     thing_ids = [str(s) for s in config['thing_ids']]
+
+    recovered = ds.recover()
+    if len(recovered) > 0:
+        logging.log(31, 'Recovered {} interrupted retrievals.'.format(len(recovered)))
+
+    if args.coordinate or args.worker:
+        queue = CrawlQueue(os.path.join(config['dataset_dir'], 'crawl.sqlite'),
+                           lease_seconds=config['lease_seconds'], max_attempts=config['max_attempts'])
+        if args.coordinate:
+            if len(thing_ids) > 0:
+                n_added = queue.add_things(thing_ids)
+                logging.log(31, 'Queued {} things.'.format(n_added))
+            else:
+                n_added = 0
+                for license in config['licenses']:
+                    for category in config['categories']:
+                        params = {
+                        #    'category' : category,
+                            'license' : license,
+                            'query' : ''
+                        }
+                        n_added += queue.add_search(params, config['base_url'], strides=config['search_strides'],
+                                                    max_pages=config['max_pages'])
+                logging.log(31, 'Queued {} search pages.'.format(n_added))
+        if args.worker:
+            ds.crawl(queue, config['cache_dir'], workers=config['workers'], delay=config['delay'],
+                     base_url=config['base_url'], max_task_seconds=config['max_task_seconds'])
+        return
+
     for license in config['licenses']:
         for category in config['categories']:
             params = {
@@ -31,7 +68,9 @@ def main():
                 'license' : license,
                 'query' : ''
             }
-            ds.retrieve_from_thingiverse(config['number'], config['cache_dir'], params, thing_ids)
+            ds.retrieve_from_thingiverse(config['number'], config['cache_dir'], params, thing_ids,
+                                         workers=config['workers'], delay=config['delay'],
+                                         base_url=config['base_url'])
 
 if __name__ == "__main__":
     main()
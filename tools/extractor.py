@@ -3,12 +3,8 @@
 """
 import argparse
 import logging
-import numpy as np
-import os
-import trimesh
 
-from autolab_core import YamlConfig, RigidTransform, SimilarityTransform
-from visualization import Visualizer3D as vis
+from autolab_core import YamlConfig
 
 from thingset import ThingiverseDataset
 
@@ -31,34 +27,21 @@ def main():
     # get metadata information
     identifier_key = config['identifier_key']
     identifier_value = config['identifier_value']
+    category = config['category'] if 'category' in config else None
+    file_type = config['file_type']
+    workers = config['workers']
 
-    dsold = ThingiverseDataset(config['dataset_dir'])
-    dsnew = ThingiverseDataset(config['output_dir'])
-    meshdir = None
-    if 'mesh_out_dir' in config:
-        meshdir = config['mesh_out_dir']
-        if not os.path.exists(meshdir):
-            os.makedirs(meshdir)
-
-    for i, thing_id in enumerate(dsold.keys):
-        thing_metadata = dsold.metadata(thing_id)
-
-        model_keys = []
-
-        for model_id in thing_metadata['models']:
-            model_data = thing_metadata['models'][model_id]
+    ds = ThingiverseDataset(config['dataset_dir'])
+    selection = ds.query(category=category, metadata={identifier_key : identifier_value})
+    logging.log(31, '{} matching models.'.format(len(selection)))
 
-            # If the identifier isn't in the model's metadata, skip it
-            if identifier_key in model_data['metadata'] and model_data['metadata'][identifier_key] == identifier_value:
-                model_keys.append(model_id)
-                if meshdir is not None:
-                    dsold[thing_id]._models[model_id].mesh.export(os.path.join(meshdir, '{}.obj'.format(model_id)))
+    if 'mesh_out_dir' in config:
+        stats = ds.extract(config['mesh_out_dir'], selection, file_type=file_type, workers=workers)
+        logging.log(31, 'Wrote {written} meshes ({bytes} bytes) in {seconds:.1f}s.'.format(**stats))
 
-        #if len(model_keys) > 0:
-        #    thing = dsold[thing_id]
-        #    dsnew.save(thing.copy(model_keys))
+    if 'output_dir' in config:
+        dsnew = ds.materialize_subset(config['output_dir'], selection)
+        logging.log(31, 'Created a dataset of {} things.'.format(len(dsnew.keys)))
 
 if __name__ == "__main__":
     main()
-
-
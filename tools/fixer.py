@@ -8,7 +8,7 @@ import re
 from autolab_core import YamlConfig, SimilarityTransform
 from visualization import Visualizer3D as vis
 
-from thingset import ThingiverseDataset, Thing
+from thingset import ThingiverseDataset, Thing, TRANSFORM_KEY
 
 def main():
     # initialize logging
@@ -100,9 +100,10 @@ def main():
                 old_id = mid_map[model.id]
                 old_metadata = thing[old_id].metadata
                 model.metadata.update(old_metadata)
-                if scale_key in old_metadata:
+                # Older models had their scale baked into the mesh
+                if scale_key in old_metadata and TRANSFORM_KEY not in old_metadata:
                     stf = SimilarityTransform(scale=old_metadata[scale_key])
-                    model.mesh.apply_transform(stf.matrix)
+                    model.set_transform(stf.matrix)
 
         ds.save(new_thing)
 
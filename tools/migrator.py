@@ -0,0 +1,32 @@
+#!/usr/bin/python
+"""A script for converting a dataset to a new directory layout.
+"""
+import argparse
+import logging
+
+from autolab_core import YamlConfig
+
+from thingset import ThingiverseDataset
+
+def main():
+    # initialize logging
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Convert a Thingiverse Dataset to a new directory layout',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--config', help='config filename', default='cfg/tools/migrator.yaml')
+    args = parser.parse_args()
+
+    config_filename = args.config
+    config = YamlConfig(config_filename)
+
+    ds = ThingiverseDataset(config['dataset_dir'], multiprocess=True)
+    layout = dict(config['layout'])
+    logging.log(31, 'Moving {} things to a {} layout...'.format(len(ds.keys), layout['type']))
+    ds.convert_layout(layout)
+    logging.log(31, 'Done.')
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,21 @@
+import argparse
+import json
+import logging
+import multiprocessing
 import os
+import time
+import zlib
+
 import numpy as np
+from scipy.spatial import ConvexHull
 import trimesh
 import triangle
 
 from autolab_core import RigidTransform, YamlConfig
 from visualization import Visualizer3D as vis
 
+from thingset import Model, ThingiverseDataset, STABLE_POSES_KEY
+
 class Packager(object):
 
     def __init__(self, config):
@@ -32,66 +42,123 @@ class Packager(object):
             The maximum depth of the cardboard backing.
         offset : float
             The offset of the packaging from the object.
+        orientation_resolution : float
+            The angular step, in radians, used when searching for the z-axis
+            rotation that minimizes the object's x extent. If zero or null, an
+            exact search over the edges of the object's footprint is used.
         """
         self._config = config
 
-    def package(self, mesh):
+    def package(self, mesh, random_state=None, stable_poses=None):
+        """Package a mesh on a randomly-sized cardboard backing.
+
+        Parameters
+        ----------
+        mesh : trimesh.Trimesh
+            A watertight mesh to package.
+        random_state : numpy.random.RandomState
+            The source of the packaging's random parameters. If None, the global
+            numpy random state is used.
+        stable_poses : (n,4,4) float
+            Precomputed stable poses of the mesh. If None, they are computed.
+
+        Returns
+        -------
+        trimesh.Trimesh
+            The packaged mesh, or None if the object exceeds the extent limits.
+        """
         if not mesh.is_watertight:
             print mesh.metadata
             raise ValueError('Must have a watertight mesh to package it!')
+        if random_state is None:
+            random_state = np.random
 
         # Sample values
-        border_width_pct = np.random.uniform(self._config['min_border_width_pct'],
-                                             self._config['max_border_width_pct'])
-        tab_height_pct = np.random.uniform(self._config['min_tab_height_pct'],
-                                           self._config['max_tab_height_pct'])
-        depth = np.random.uniform(self._config['min_depth'],
-                                  self._config['max_depth'])
+        border_width_pct = random_state.uniform(self._config['min_border_width_pct'],
+                                                self._config['max_border_width_pct'])
+        tab_height_pct = random_state.uniform(self._config['min_tab_height_pct'],
+                                              self._config['max_tab_height_pct'])
+        depth = random_state.uniform(self._config['min_depth'],
+                                     self._config['max_depth'])
         offset = self._config['offset']
         ext_limits = np.array(self._config['ext_limits'])
 
         # Determine if the object is packable
-        return self._package(mesh, border_width_pct, tab_height_pct, depth, offset, ext_limits)
+        return self._package(mesh, border_width_pct, tab_height_pct, depth, offset, ext_limits, stable_poses)
 
-    def _get_packaged_pose(self, mesh):
-        # Make copy of argument
-        mesh = mesh.copy()
+    def _get_packaged_pose(self, mesh, stable_poses=None):
+        """Find the pose in which the mesh should be packaged.
+
+        The mesh is put in the stable pose with the least z-axis height and then
+        rotated about the z axis to minimize its x extent. Extents are invariant
+        to everything but the convex hull, so only the hull's vertices are
+        transformed, and all candidate poses are evaluated in a single batch.
+
+        Parameters
+        ----------
+        mesh : trimesh.Trimesh
+            The mesh to package.
+        stable_poses : (n,4,4) float
+            Precomputed stable poses of the mesh. If None, they are computed.
+
+        Returns
+        -------
+        (4,4) float
+            The transform that puts the mesh in its packaged pose.
+        """
+        points = mesh.convex_hull.vertices
 
         # Compute stable pose with least z-axis height
-        tfs, _ = mesh.compute_stable_poses()
-        min_z, min_tf = np.infty, None
-        for tf in tfs:
-            m = mesh.copy().apply_transform(tf)
-            z_ext = m.extents[2]
-            if z_ext < min_z:
-                min_z = z_ext
-                min_tf = tf
-
-        # Put mesh in that stable pose
-        mesh.apply_transform(min_tf)
-
-        # Rotate the mesh about that stable pose, pick one that gives largest y extent
-        theta = 0
-        dtheta = 0.1
-        min_rot = np.eye(4)
-        min_x_ext = mesh.extents[0]
-        while theta < np.pi:
-            rot = np.eye(4)
-            rot[:3,:3] = RigidTransform.z_axis_rotation(theta)
-            m = mesh.copy()
-            m.apply_transform(rot)
-            x_ext = m.extents[0]
-            if x_ext < min_x_ext:
-                min_x_ext = x_ext
-                min_rot = rot
-            theta += dtheta
+        if stable_poses is None:
+            stable_poses, _ = mesh.compute_stable_poses()
+        tfs = np.asarray(stable_poses)
+        z = np.einsum('ij,kj->ki', points, tfs[:,2,:3]) + tfs[:,2,3][:,np.newaxis]
+        min_tf = tfs[np.argmin(z.max(axis=1) - z.min(axis=1))]
+
+        # Rotate the points about that stable pose, pick the one that gives least x extent
+        xy = points.dot(min_tf[:2,:3].T)
+        thetas = self._candidate_rotations(xy)
+        x = np.outer(np.cos(thetas), xy[:,0]) - np.outer(np.sin(thetas), xy[:,1])
+        theta = thetas[np.argmin(x.max(axis=1) - x.min(axis=1))]
 
+        min_rot = np.eye(4)
+        min_rot[:3,:3] = RigidTransform.z_axis_rotation(theta)
         return min_rot.dot(min_tf)
 
-    def _package(self, mesh, border_width_pct, tab_height_pct, depth, offset, ext_limits):
+    def _candidate_rotations(self, xy):
+        """Get the z-axis rotations to consider when minimizing the x extent.
+
+        Parameters
+        ----------
+        xy : (n,2) float
+            The xy-coordinates of the mesh's hull in its stable pose.
+
+        Returns
+        -------
+        (m,) float
+            Candidate rotation angles in [0, pi), starting with zero.
+
+        Notes
+        -----
+        If the ``orientation_resolution`` config value is positive, angles are
+        sampled on a grid with that spacing. Otherwise, the search is exact:
+        the minimum width of a convex polygon is attained with one of its edges
+        flush to a caliper, so only the angles that align an edge of the 2D hull
+        with the y axis are considered.
+        """
+        resolution = self._config['orientation_resolution'] if 'orientation_resolution' in self._config else 0.1
+        if resolution is not None and resolution > 0:
+            return np.arange(0.0, np.pi, resolution)
+
+        hull = xy[ConvexHull(xy).vertices]
+        edges = np.roll(hull, -1, axis=0) - hull
+        thetas = np.mod(np.arctan2(-edges[:,0], -edges[:,1]), np.pi)
+        return np.hstack(([0.0], thetas))
+
+    def _package(self, mesh, border_width_pct, tab_height_pct, depth, offset, ext_limits, stable_poses=None):
         mesh = mesh.copy()
 
-        pose = self._get_packaged_pose(mesh)
+        pose = self._get_packaged_pose(mesh, stable_poses)
         mesh.apply_transform(pose)
 
         # Determine if mesh should be packaged based on extents
@@ -193,23 +260,206 @@ class Packager(object):
         mesh.apply_translation(-mesh.center_mass)
         return mesh
 
-if __name__ == '__main__':
-    cfg = YamlConfig('cfg/tools/packager.yaml')
-    p = Packager(cfg)
-
-    if not os.path.exists(cfg['out_dir']):
-        os.makedirs(cfg['out_dir'])
-
-    for fn in os.listdir(cfg['in_dir']):
-        full_fn = os.path.join(cfg['in_dir'], fn)
-        fn = fn.split('.')[0]
-        #exp_fn = os.path.join(cfg['out_dir'], '{}_packaged.obj'.format(fn))
-        #os.rename(full_fn, exp_fn)
-        m = trimesh.load_mesh(full_fn)
-        m = p.package(m)
-        if m is not None:
-            if not m.is_watertight:
+_packager = None
+
+def _init_worker(config_filename):
+    global _packager
+    _packager = Packager(YamlConfig(config_filename))
+
+def file_seed(seed, filename):
+    """Derive a deterministic per-file seed that doesn't depend on processing order.
+
+    Parameters
+    ----------
+    seed : int
+        The base seed for the run.
+    filename : str
+        The basename of the input file.
+
+    Returns
+    -------
+    int
+        The seed for the given file.
+    """
+    return (seed + (zlib.crc32(filename.encode('utf-8')) & 0xffffffff)) & 0xffffffff
+
+def load_model(job):
+    """Load the model of a packaging job.
+
+    Models are loaded as the dataset loads them, so multi-part files such as
+    GLBs, which trimesh reads as scenes, become a single mesh.
+    """
+    model_dict = job.get('model_dict')
+    if model_dict is None:
+        model_dict = {'name' : job['name'], 'mesh' : os.path.basename(job['in']), 'metadata' : {}}
+    return Model.load(os.path.dirname(job['in']), job['name'], model_dict)
+
+def package_file(job):
+    """Package a single mesh file, writing the result to its output filename.
+
+    Any error packaging the file is recorded in its manifest record rather
+    than raised, so that one bad file doesn't stop a run.
+
+    Parameters
+    ----------
+    job : dict
+        The manifest name (``name``), input filename (``in``), output filename
+        (``out``) and seed (``seed``) for the file. Jobs from a dataset also
+        carry the model's metadata entry (``model_dict``), with its transform
+        and cached poses.
+
+    Returns
+    -------
+    dict
+        The manifest record for the file, with its ``status`` (``packaged`` or
+        ``rejected``), the ``reason`` for a rejection and the elapsed ``time``.
+    """
+    record = {
+        'file' : job['name'],
+        'seed' : job['seed'],
+    }
+    start = time.time()
+    try:
+        model = load_model(job)
+    except Exception as e:
+        record['reason'], record['error'] = 'load_failed', str(e)
+        model = None
+
+    if model is not None:
+        try:
+            _package_model(model, job, record)
+        except Exception as e:
+            record['reason'], record['error'] = 'package_failed', '{}: {}'.format(type(e).__name__, e)
+
+    record['status'] = 'rejected' if 'reason' in record else 'packaged'
+    record['time'] = time.time() - start
+    return record
+
+def _package_model(model, job, record):
+    """Package a loaded model, filling in its manifest record.
+    """
+    mesh = model.mesh
+    if not mesh.is_watertight:
+        record['reason'] = 'not_watertight'
+        return
+
+    # Stable pose sampling in trimesh draws from the global state
+    np.random.seed(job['seed'])
+    stable_poses = None
+    if 'model_dict' in job:
+        cached = model.metadata.get(STABLE_POSES_KEY)
+        stable_poses, _ = model.stable_poses()
+        record['cached_poses'] = model.metadata[STABLE_POSES_KEY] is cached
+    try:
+        packaged = _packager.package(mesh, np.random.RandomState(job['seed']), stable_poses)
+    except ValueError as e:
+        record['reason'], record['error'] = 'malformed_mesh', str(e)
+        return
+
+    if packaged is None:
+        record['reason'] = 'ext_limits'
+    elif not packaged.is_watertight:
+        record['reason'] = 'packaged_not_watertight'
+    else:
+        packaged.export(job['out'])
+        record['output'] = os.path.basename(job['out'])
+
+def file_jobs(cfg, seed):
+    """Create a packaging job for each mesh file in the input directory.
+    """
+    jobs = []
+    for fn in sorted(os.listdir(cfg['in_dir'])):
+        jobs.append({
+            'name' : fn,
+            'in' : os.path.join(cfg['in_dir'], fn),
+            'out' : os.path.join(cfg['out_dir'], '{}_packaged.obj'.format(fn.split('.')[0])),
+            'seed' : file_seed(seed, fn),
+        })
+    return jobs
+
+def dataset_jobs(cfg, seed):
+    """Create a packaging job for each model in the dataset with the target score.
+    """
+    ds = ThingiverseDataset(cfg['dataset_dir'])
+    score_key = cfg['score_key']
+    score_value = cfg['score_value']
+
+    jobs = []
+    for thing_id in sorted(ds.keys):
+        models = ds.metadata(thing_id)['models']
+        for model_id in sorted(models):
+            if models[model_id]['metadata'].get(score_key) != score_value:
                 continue
-            bn, ext = os.path.splitext(fn)
-            exp_fn = os.path.join(cfg['out_dir'], '{}_packaged.obj'.format(fn))
-            m.export(exp_fn)
+            jobs.append({
+                'name' : model_id,
+                'in' : ds.model_filename(thing_id, model_id),
+                'out' : os.path.join(cfg['out_dir'], '{}_packaged.obj'.format(model_id)),
+                'seed' : file_seed(seed, model_id),
+                'model_dict' : models[model_id],
+            })
+    return jobs
+
+def main():
+    # initialize logging
+    logging.getLogger().setLevel(31)
+
+    parser = argparse.ArgumentParser(
+        description='Package meshes on cardboard backings',
+        epilog='Written by Matthew Matl (mmatl)'
+    )
+    parser.add_argument('--config', help='config filename', default='cfg/tools/packager.yaml')
+    args = parser.parse_args()
+
+    config_filename = args.config
+    cfg = YamlConfig(config_filename)
+    out_dir = cfg['out_dir']
+    seed = cfg['seed'] if 'seed' in cfg else 0
+    workers = cfg['workers'] if 'workers' in cfg else 1
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    # Files already recorded in the manifest were either packaged or
+    # deterministically rejected, so a rerun resumes where the last one stopped.
+    manifest_filename = os.path.join(out_dir, 'manifest.jsonl')
+    done = set()
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    done.add(json.loads(line)['file'])
+
+    if 'source' in cfg and cfg['source'] == 'dataset':
+        jobs = dataset_jobs(cfg, seed)
+    else:
+        jobs = file_jobs(cfg, seed)
+    jobs = [j for j in jobs if j['name'] not in done and not os.path.exists(j['out'])]
+    logging.log(31, '{} files to package, {} already done.'.format(len(jobs), len(done)))
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_worker, (config_filename,))
+        records = pool.imap_unordered(package_file, jobs)
+    else:
+        _init_worker(config_filename)
+        records = (package_file(job) for job in jobs)
+
+    counts = {}
+    with open(manifest_filename, 'a') as manifest:
+        for i, record in enumerate(records):
+            manifest.write(json.dumps(record, sort_keys=True) + '\n')
+            manifest.flush()
+            key = record.get('reason', record['status'])
+            counts[key] = counts.get(key, 0) + 1
+            logging.log(31, '{}/{} files: {} {} ({:.2f}s)'.format(
+                i + 1, len(jobs), record['file'], key, record['time']
+            ))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    logging.log(31, 'Done: {}'.format(json.dumps(counts, sort_keys=True)))
+
+if __name__ == '__main__':
+    main()
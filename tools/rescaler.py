@@ -9,7 +9,7 @@ import trimesh
 from autolab_core import YamlConfig, RigidTransform, SimilarityTransform
 from visualization import Visualizer3D as vis
 
-from thingset import ThingiverseDataset
+from thingset import ThingiverseDataset, Prefetcher, AsyncWriter, TRANSFORM_KEY
 
 def rescale_callback(viewer, key, rot, stf, adder):
     if stf.scale + adder <= 0:
@@ -21,6 +21,18 @@ def rotate_callback(viewer, key, rot, stf):
     rot.rotation = RigidTransform.z_axis_rotation(np.pi / 2.0).dot(rot.rotation)
     vis.get_object(key).T_obj_world = rot.dot(stf)
 
+def load_unscaled_model(ds, thing_id, model_id, scale_key):
+    """Load a model with any previous rescaling undone.
+    """
+    model = ds.load_model(thing_id, model_id)
+    if TRANSFORM_KEY in model.metadata:
+        model.set_transform(np.eye(4))
+    elif scale_key in model.metadata:
+        # Older models had their scale baked into the mesh
+        model.set_transform(SimilarityTransform(scale=1.0 / model.metadata[scale_key]).matrix)
+    model.mesh
+    return model
+
 def main():
     # initialize logging
     logging.getLogger().setLevel(31)
@@ -45,17 +57,15 @@ def main():
     identifier_key = config['identifier_key']
     identifier_value = config['identifier_value']
     scale_key = config['scale_key']
-    default_scale = config['default_scale']
     override = config['override']
 
-    ds = ThingiverseDataset(config['dataset_dir'])
+    ds = ThingiverseDataset(config['dataset_dir'], multiprocess=config['multiprocess'])
 
-    for i, thing_id in enumerate(ds.keys):
-        thing = None
+    # Find the models that need scales
+    candidates = []
+    for thing_id in ds.keys:
         thing_metadata = ds.metadata(thing_id)
 
-        changed_model_keys = []
-
         for model_id in thing_metadata['models']:
             model_data = thing_metadata['models'][model_id]
 
@@ -65,42 +75,38 @@ def main():
 
             # If we're overriding or the scale key hasn't been set, modify the model
             if override or scale_key not in model_data['metadata']:
-
-                # Load the model
-                if thing is None:
-                    thing = ds[thing_id]
-                model = thing[model_id]
-                logging.log(31, u"{} ({}): {} ({})".format(thing.name, thing.id, model.name, model.id).encode('utf-8'))
-                changed_model_keys.append(model.id)
-
-                # Rescale back to original dimensions if overriding
-                if scale_key in model.metadata:
-                    model.mesh.apply_scale(1.0 / model.metadata[scale_key])
-
-                model.metadata[scale_key] = default_scale
-
-                # Visualize the model, registering the grow/shrink callbacks
-                stf = SimilarityTransform(from_frame='world', to_frame='world')
-                rot = RigidTransform(from_frame='world', to_frame='world')
-
-                registered_keys= {
-                    'j' : (rescale_callback, ['model', rot, stf, 0.1]),
-                    'k' : (rescale_callback, ['model', rot, stf, -0.1]),
-                    'u' : (rescale_callback, ['model', rot, stf, 1.0]),
-                    'i' : (rescale_callback, ['model', rot, stf, -1.0]),
-                    'h' : (rotate_callback,  ['model', rot, stf])
-                }
-                vis.figure()
-                vis.mesh(gripper_mesh, T_mesh_world=RigidTransform(translation=(0,0,-0.08), from_frame='obj', to_frame='world'), style='surface', color=(0.3, 0.3, 0.3), name='gripper')
-                vis.mesh(model.mesh, style='surface', name='model')
-                vis.show(animate=True, registered_keys=registered_keys)
-                # Transform the model and update its metadata
-                model.mesh.apply_transform(stf.matrix)
-                model.metadata[scale_key] = stf.scale
-
-        if thing:
-            ds.save(thing, only_metadata=False, model_keys=changed_model_keys)
-        logging.log(31, '{}/{} things...'.format(i, len(ds.keys)))
+                candidates.append((thing_id, model_id))
+
+    # Load upcoming models and write scales in the background
+    prefetcher = Prefetcher(candidates, lambda key: load_unscaled_model(ds, key[0], key[1], scale_key), config['prefetch'])
+    with AsyncWriter() as writer:
+        for i, ((thing_id, model_id), model) in enumerate(prefetcher):
+            thing_name = ds.metadata(thing_id)['name']
+            logging.log(31, u"{} ({}): {} ({})".format(thing_name, thing_id, model.name, model.id).encode('utf-8'))
+
+            # Visualize the model, registering the grow/shrink callbacks
+            stf = SimilarityTransform(from_frame='world', to_frame='world')
+            rot = RigidTransform(from_frame='world', to_frame='world')
+
+            registered_keys= {
+                'j' : (rescale_callback, ['model', rot, stf, 0.1]),
+                'k' : (rescale_callback, ['model', rot, stf, -0.1]),
+                'u' : (rescale_callback, ['model', rot, stf, 1.0]),
+                'i' : (rescale_callback, ['model', rot, stf, -1.0]),
+                'h' : (rotate_callback,  ['model', rot, stf])
+            }
+            vis.figure()
+            vis.mesh(gripper_mesh, T_mesh_world=RigidTransform(translation=(0,0,-0.08), from_frame='obj', to_frame='world'), style='surface', color=(0.3, 0.3, 0.3), name='gripper')
+            vis.mesh(model.mesh, style='surface', name='model')
+            vis.show(animate=True, registered_keys=registered_keys)
+
+            # Record the scale as a transform; the mesh file is left untouched
+            model.apply_transform(stf.matrix)
+            writer.submit(ds.update_model_metadata, thing_id, model_id, {
+                scale_key : stf.scale,
+                TRANSFORM_KEY : model.metadata[TRANSFORM_KEY]
+            })
+            logging.log(31, '{}/{} models...'.format(i + 1, len(candidates)))
 
 if __name__ == "__main__":
     main()